@@ -1,16 +1,162 @@
+import copy
+
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 # Assume other necessary imports for embedding, LLM interaction, etc.
 
 class SemanticMemory:
-    def __init__(self):
-        self.memory = []  # This will store tuples of (state_embedding, action, Q_value)
+    """
+    Stores (state_embedding, action, Q_value) entries.
+
+    Embeddings live in one pre-normalized float32 matrix that doubles when full,
+    so a similarity query is a single matrix-vector product plus argpartition.
+    Actions and Q-values are kept in arrays parallel to the matrix rows.
+    With a capacity bound, a new entry replaces the one with the lowest Q-value
+    (eviction="lowest_q") or the oldest one (eviction="oldest").
+
+    For large memories an approximate nearest-neighbour index can be plugged in
+    with index=...: any object with add(vectors, ids) and search(queries, k)
+    returning (scores, ids), such as BruteForceIndex / IVFIndex from
+    ch08agent_memory_and_knowledge/ann_index.py. Rows are handed to the index in
+    batches of index_batch; the index only proposes candidates, which are
+    re-scored exactly against the matrix together with the not-yet-indexed rows.
+
+    The ANN indexes have no delete, so with a capacity bound every eviction
+    leaves a stale row behind. Once the stale rows exceed index_stale_ratio of
+    the live ones, the index is rebuilt from a copy of the index as it was
+    passed in (so pass it empty, trained or not) and the live rows. That keeps
+    the index size and the over-fetch factor bounded, at an amortized cost of
+    about 1 / index_stale_ratio re-added rows per eviction.
+    """
+
+    def __init__(self, capacity=None, eviction="lowest_q", initial_size=64,
+                 index=None, index_batch=256, index_oversample=4, index_stale_ratio=0.5):
+        if eviction not in ("lowest_q", "oldest"):
+            raise ValueError(f"Unknown eviction policy: {eviction}")
+        self.capacity = capacity
+        self.eviction = eviction
+        self.initial_size = initial_size
+        self.size = 0
+        self._embeddings = None                 # (allocated, dim), unit-length rows
+        self._norms = np.empty(0, dtype=np.float32)
+        self._actions = np.empty(0, dtype=object)
+        self._q_values = np.empty(0, dtype=np.float64)
+        self._inserted = np.empty(0, dtype=np.int64)
+        self._counter = 0
+        self.index = index
+        self.index_batch = index_batch
+        self.index_oversample = index_oversample
+        self.index_stale_ratio = index_stale_ratio
+        self._index_template = copy.deepcopy(index) if index is not None else None
+        self._pending = []                      # slots written since the last index flush
+        self._indexed = 0                       # rows handed to the index, stale ones included
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def memory(self):
+        # Read-only view in the original (state_embedding, action, Q_value) form
+        return [self._entry(i) for i in range(self.size)]
+
+    def add(self, state_embedding, action, q_value):
+        vector = np.asarray(state_embedding, dtype=np.float32).ravel()
+        if self._embeddings is None:
+            self._allocate(len(vector))
+
+        if self.capacity is not None and self.size >= self.capacity:
+            # Full: overwrite the victim slot in place
+            if self.eviction == "lowest_q":
+                slot = int(np.argmin(self._q_values[:self.size]))
+            else:
+                slot = int(np.argmin(self._inserted[:self.size]))
+        else:
+            if self.size == len(self._embeddings):
+                self._grow()
+            slot = self.size
+            self.size += 1
 
-    def find_similar_states(self, state_embedding):
+        norm = np.linalg.norm(vector)
+        self._embeddings[slot] = vector / norm if norm > 0 else vector
+        self._norms[slot] = norm
+        self._actions[slot] = action
+        self._q_values[slot] = q_value
+        self._inserted[slot] = self._counter
+        self._counter += 1
+        if self.index is not None:
+            self._pending.append(slot)
+            if len(self._pending) >= self.index_batch:
+                self._flush_index()
+
+    def find_similar_states(self, state_embedding, k=3):
         # This function finds states in memory that are similar to the current state
-        similarities = [cosine_similarity([state_embedding], [mem[0]]) for mem in self.memory]
-        # Sort and return top matches
-        return sorted(zip(self.memory, similarities), key=lambda x: x[1], reverse=True)[:3]
+        if self.size == 0:
+            return []
+        query = np.asarray(state_embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        if self.index is not None:
+            candidates = self._index_candidates(query, k)
+            similarities = self._embeddings[candidates] @ query
+            top = np.argsort(-similarities, kind="stable")[:k]
+            return [(self._entry(candidates[i]), float(similarities[i])) for i in top]
+        similarities = self._embeddings[:self.size] @ query
+        k = min(k, self.size)
+        top = np.argpartition(-similarities, k - 1)[:k] if k < self.size else np.arange(self.size)
+        top = top[np.argsort(-similarities[top], kind="stable")]
+        # Return the top matches as ((state_embedding, action, Q_value), similarity)
+        return [(self._entry(i), float(similarities[i])) for i in top]
+
+    def _index_candidates(self, query, k):
+        # Overwritten slots keep their old vector in the index (the ANN indexes
+        # have no delete), so over-fetch in proportion to the stale rows and
+        # re-score against the live ones
+        stale_factor = -(-self._indexed // max(self.size, 1))
+        _, ids = self.index.search(query[None, :], k * self.index_oversample * stale_factor)
+        ids = ids[0]
+        ids = ids[(ids >= 0) & (ids < self.size)]
+        return np.unique(np.concatenate([ids, np.asarray(self._pending, dtype=np.int64)]))
+
+    def _flush_index(self):
+        if self._indexed + len(self._pending) - self.size > self.size * self.index_stale_ratio:
+            self._rebuild_index()
+            return
+        slots = np.asarray(self._pending, dtype=np.int64)
+        self.index.add(self._embeddings[slots], slots)
+        self._indexed += len(slots)
+        self._pending = []
+
+    def _rebuild_index(self):
+        # Start over from the index as passed in and add only the live rows
+        self.index = copy.deepcopy(self._index_template)
+        self.index.add(self._embeddings[:self.size], np.arange(self.size, dtype=np.int64))
+        self._indexed = self.size
+        self._pending = []
+
+    def _entry(self, i):
+        return (self._embeddings[i] * self._norms[i], self._actions[i], float(self._q_values[i]))
+
+    def _allocate(self, dim):
+        size = self.initial_size if self.capacity is None else min(self.initial_size, self.capacity)
+        self._embeddings = np.empty((size, dim), dtype=np.float32)
+        self._resize_columns(size)
+
+    def _grow(self):
+        # Amortized doubling, never past the capacity bound
+        size = len(self._embeddings) * 2
+        if self.capacity is not None:
+            size = min(size, self.capacity)
+        embeddings = np.empty((size, self._embeddings.shape[1]), dtype=np.float32)
+        embeddings[:self.size] = self._embeddings[:self.size]
+        self._embeddings = embeddings
+        self._resize_columns(size)
+
+    def _resize_columns(self, size):
+        for name in ("_norms", "_actions", "_q_values", "_inserted"):
+            old = getattr(self, name)
+            column = np.empty(size, dtype=old.dtype)
+            column[:len(old)] = old
+            setattr(self, name, column)
 
 class QLearningModel:
     def __init__(self, semantic_memory):
@@ -40,7 +186,7 @@ class QLearningModel:
         return np.random.rand()  # Random Q value for illustration
 
     def update_memory(self, state_embedding, action, q_value):
-        self.semantic_memory.memory.append((state_embedding, action, q_value))
+        self.semantic_memory.add(state_embedding, action, q_value)
 
     def process_query(self, query):
         state_embedding = self.embed_query(query)
@@ -52,6 +198,11 @@ class QLearningModel:
         return action
 
 # Usage example
+# For a large memory, pass an ANN index from ch08agent_memory_and_knowledge/ann_index.py
+# (with that directory on sys.path), e.g.:
+#   index = IVFIndex(dim=100, nlist=256, nprobe=16)
+#   index.train(sample_embeddings)
+#   semantic_memory = SemanticMemory(index=index)
 semantic_memory = SemanticMemory()
 ql_model = QLearningModel(semantic_memory)
 
@@ -0,0 +1,396 @@
+"""
+本地向量近邻索引：纯 NumPy 实现，不依赖 faiss / hnswlib。
+
+  BruteForceIndex  精确检索（矩阵乘法 + argpartition），用作基准和小数据集
+  IVFIndex         倒排文件（IVF）：k-means 把向量分到 nlist 个桶，查询只扫最近的 nprobe 个桶；
+                   pq_m > 0 时桶内向量相对桶中心的残差用乘积量化（PQ）压缩成 pq_m 个字节，用查表（ADC）算分；
+                   refine=r > 0 时再保留一份原向量，PQ 先取 k*r 个候选，再用精确内积重排出 k 个
+
+nprobe 越大召回越高、越慢；pq_m 越大越准、越占内存。纯 PQ 只存编码，适合内存放不下原向量的场景，
+但召回受量化误差限制，调大 nprobe 也提不上去（见基准里的 IVF-PQ 一栏），需要精确结果时加 refine。
+两种索引接口一致：
+
+    index = IVFIndex(dim=768, nlist=1024, nprobe=16)
+    index.train(vectors)
+    index.add(vectors, ids)
+    scores, ids = index.search(queries, k=10)      # 都是 (查询数, k)，不足 k 个时 id 为 -1
+    index.save("docs.ann.npz")
+    index = load_index("docs.ann.npz")
+
+metric 为 "cosine"（向量先归一化）或 "ip"（内积），分数越大越相似。
+
+基准测试（合成的聚簇 768 维向量）：
+    python ann_index.py
+    ANN_BENCH_N=100000 python ann_index.py
+默认 100 万条；IVF-flat 和 PQ 精排要再存一份向量，100 万 x 768 需约 7GB 内存，
+内存不够时设 ANN_BENCH_FLAT=0 只测纯 PQ。
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+ANN_BENCH_N = int(os.getenv("ANN_BENCH_N", "1000000"))
+ANN_BENCH_DIM = int(os.getenv("ANN_BENCH_DIM", "768"))
+ANN_BENCH_QUERIES = int(os.getenv("ANN_BENCH_QUERIES", "200"))
+ANN_BENCH_FLAT = os.getenv("ANN_BENCH_FLAT", "1") == "1"
+ANN_BENCH_REFINE = int(os.getenv("ANN_BENCH_REFINE", "10"))
+
+
+def prepare(vectors, metric):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    if metric == "cosine":
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+    return vectors
+
+
+def top_k(scores, ids, k):
+    """按行取分数最高的 k 个（argpartition + 只排这 k 个）"""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def pad(scores, ids, k):
+    missing = k - scores.shape[1]
+    if missing > 0:
+        scores = np.pad(scores, ((0, 0), (0, missing)), constant_values=-np.inf)
+        ids = np.pad(ids, ((0, 0), (0, missing)), constant_values=-1)
+    return scores, ids
+
+
+def kmeans(data, k, iterations=20, spherical=False, seed=0, chunk=65536):
+    """Lloyd k-means；spherical=True 时按内积分配并把中心归一化（适合 cosine）"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=len(data) < k)].copy()
+    for _ in range(iterations):
+        assign = assign_nearest(data, centroids, spherical, chunk)
+        counts = np.bincount(assign, minlength=k)
+        order = np.argsort(assign, kind="stable")
+        sums = np.zeros_like(centroids)
+        nonempty = np.flatnonzero(counts)
+        sums[nonempty] = np.add.reduceat(data[order], np.cumsum(counts)[nonempty] - counts[nonempty])
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # 空簇重新随机取点，避免中心浪费
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), size=int(empty.sum()))]
+        if spherical:
+            centroids = prepare(centroids, "cosine")
+    return centroids
+
+
+def assign_nearest(data, centroids, spherical, chunk=65536):
+    """分块计算每个向量最近的中心，避免一次性生成 (n, k) 的大矩阵"""
+    assign = np.empty(len(data), dtype=np.int64)
+    centroid_norms = None if spherical else (centroids ** 2).sum(axis=1)
+    for start in range(0, len(data), chunk):
+        block = data[start:start + chunk] @ centroids.T
+        if spherical:
+            assign[start:start + chunk] = block.argmax(axis=1)
+        else:
+            assign[start:start + chunk] = (centroid_norms - 2 * block).argmin(axis=1)
+    return assign
+
+
+class BruteForceIndex:
+    """精确检索：所有向量放在一个矩阵里，查询就是一次矩阵乘法"""
+
+    kind = "flat"
+
+    def __init__(self, dim, metric="cosine"):
+        self.dim = dim
+        self.metric = metric
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.ids = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def train(self, vectors):
+        pass
+
+    def add(self, vectors, ids=None):
+        vectors = prepare(vectors, self.metric)
+        ids = np.arange(len(self), len(self) + len(vectors)) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.vectors = vectors if not len(self) else np.vstack([self.vectors, vectors])
+        self.ids = np.concatenate([self.ids, ids])
+
+    def search(self, queries, k=10, chunk=1024):
+        queries = prepare(queries, self.metric)
+        all_scores, all_ids = [], []
+        for start in range(0, len(queries), chunk):
+            scores = queries[start:start + chunk] @ self.vectors.T
+            ids = np.broadcast_to(self.ids, scores.shape)
+            scores, ids = top_k(scores, ids, k)
+            all_scores.append(scores)
+            all_ids.append(ids)
+        if not all_scores:
+            return np.empty((0, k), dtype=np.float32), np.empty((0, k), dtype=np.int64)
+        return pad(np.vstack(all_scores), np.vstack(all_ids), k)
+
+    def _params(self):
+        return {"kind": self.kind, "dim": self.dim, "metric": self.metric}
+
+    def _arrays(self):
+        return {"vectors": self.vectors, "ids": self.ids}
+
+    def save(self, path):
+        np.savez(path, params=np.array(json.dumps(self._params())), **self._arrays())
+
+    @classmethod
+    def _restore(cls, params, arrays):
+        index = cls(params["dim"], params["metric"])
+        index.vectors, index.ids = arrays["vectors"], arrays["ids"]
+        return index
+
+
+class IVFIndex(BruteForceIndex):
+    """IVF-flat / IVF-PQ 近似检索"""
+
+    kind = "ivf"
+
+    def __init__(self, dim, nlist=1024, nprobe=8, pq_m=0, metric="cosine", train_size=100000, seed=0, refine=0):
+        super().__init__(dim, metric)
+        if pq_m and dim % pq_m:
+            raise ValueError(f"dim={dim} 不能被 pq_m={pq_m} 整除")
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.refine = refine if pq_m else 0
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None  # (pq_m, 256, dim // pq_m)
+        self.offsets = np.zeros(nlist + 1, dtype=np.int64)
+        self.codes = np.empty((0, pq_m), dtype=np.uint8)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    @property
+    def stores_vectors(self):
+        return not self.pq_m or self.refine > 0
+
+    def train(self, vectors):
+        vectors = prepare(vectors, self.metric)
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > self.train_size:
+            vectors = vectors[rng.choice(len(vectors), size=self.train_size, replace=False)]
+        self.centroids = kmeans(vectors, self.nlist, spherical=True, seed=self.seed)
+        if self.pq_m:
+            # 量化相对桶中心的残差，误差比直接量化原向量小得多
+            # 256 个码字的码本用 64 x 256 个随机样本训练已经足够（不能取前若干行，输入可能是有序的）
+            sample_size = min(len(vectors), 256 * 64)
+            sample = vectors[rng.choice(len(vectors), size=sample_size, replace=False)]
+            residuals = sample - self.centroids[assign_nearest(sample, self.centroids, spherical=True)]
+            sub_dim = self.dim // self.pq_m
+            self.codebooks = np.stack([
+                kmeans(residuals[:, m * sub_dim:(m + 1) * sub_dim], 256, iterations=10, seed=self.seed + m)
+                for m in range(self.pq_m)
+            ])
+
+    def encode(self, residuals):
+        sub_dim = self.dim // self.pq_m
+        codes = np.empty((len(residuals), self.pq_m), dtype=np.uint8)
+        for m in range(self.pq_m):
+            codes[:, m] = assign_nearest(residuals[:, m * sub_dim:(m + 1) * sub_dim], self.codebooks[m], spherical=False)
+        return codes
+
+    def add(self, vectors, ids=None):
+        if not self.is_trained:
+            self.train(vectors)
+        vectors = prepare(vectors, self.metric)
+        ids = np.arange(len(self), len(self) + len(vectors)) if ids is None else np.asarray(ids, dtype=np.int64)
+        lists = assign_nearest(vectors, self.centroids, spherical=True)
+
+        # 桶内连续存放：按桶号稳定排序后与已有数据合并，offsets[i]:offsets[i+1] 是第 i 个桶
+        old_lists = np.repeat(np.arange(self.nlist), np.diff(self.offsets))
+        all_lists = np.concatenate([old_lists, lists])
+        order = np.argsort(all_lists, kind="stable")
+        self.ids = np.concatenate([self.ids, ids])[order]
+        if self.pq_m:
+            self.codes = np.vstack([self.codes, self.encode(vectors - self.centroids[lists])])[order]
+        if self.stores_vectors:
+            self.vectors = (vectors if not len(old_lists) else np.vstack([self.vectors, vectors]))[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(all_lists, minlength=self.nlist))])
+
+    def search(self, queries, k=10, nprobe=None, refine=None):
+        """refine 覆盖建索引时的精排倍数（0 表示只用 PQ 分数；需要索引存了原向量）"""
+        queries = prepare(queries, self.metric)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        refine = self.refine if refine is None else refine
+        if refine and not (self.pq_m and self.refine):
+            refine = 0
+        n_queries = len(queries)
+        depth = k * refine if refine else k
+        # 桶内扫描时记录的是行号（桶内排序后的位置），最后再换成 id
+        best_scores = np.full((n_queries, depth), -np.inf, dtype=np.float32)
+        best_rows = np.full((n_queries, depth), -1, dtype=np.int64)
+        if not n_queries or not len(self):
+            return best_scores[:, :k], best_rows[:, :k]
+
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe] if nprobe < self.nlist \
+            else np.broadcast_to(np.arange(self.nlist), coarse.shape)
+        tables = self._distance_tables(queries) if self.pq_m else None
+
+        # 按桶分组：探查同一个桶的查询一起算分，一次矩阵乘法 / 一次查表
+        query_rows = np.repeat(np.arange(n_queries), nprobe)
+        probe_lists = probes.reshape(-1)
+        order = np.argsort(probe_lists, kind="stable")
+        probe_lists, query_rows = probe_lists[order], query_rows[order]
+        boundaries = np.flatnonzero(np.diff(probe_lists)) + 1
+        for rows, list_no in zip(np.split(query_rows, boundaries), probe_lists[np.r_[0, boundaries]]):
+            lo, hi = self.offsets[list_no], self.offsets[list_no + 1]
+            if lo == hi:
+                continue
+            if self.pq_m:
+                # q·x = q·中心 + q·残差
+                scores = coarse[rows, list_no][:, None] + self._adc(tables[rows], self.codes[lo:hi])
+            else:
+                scores = queries[rows] @ self.vectors[lo:hi].T
+            positions = np.broadcast_to(np.arange(lo, hi), scores.shape)
+            best_scores[rows], best_rows[rows] = top_k(
+                np.hstack([best_scores[rows], scores]), np.hstack([best_rows[rows], positions]), depth
+            )
+
+        if refine:
+            # 精排：候选的原向量与查询做精确内积，再取前 k
+            exact = np.einsum("qd,qcd->qc", queries, self.vectors[np.maximum(best_rows, 0)])
+            exact[best_rows < 0] = -np.inf
+            best_scores, best_rows = top_k(exact, best_rows, k)
+        return best_scores, np.where(best_rows >= 0, self.ids[np.maximum(best_rows, 0)], -1)
+
+    def _distance_tables(self, queries):
+        """每个查询在每个子空间对 256 个码字的内积：(查询数, pq_m, 256)"""
+        sub_dim = self.dim // self.pq_m
+        sub_queries = queries.reshape(len(queries), self.pq_m, sub_dim)
+        return np.einsum("qmd,mkd->qmk", sub_queries, self.codebooks)
+
+    def _adc(self, tables, codes):
+        scores = np.zeros((len(tables), len(codes)), dtype=np.float32)
+        for m in range(self.pq_m):
+            scores += tables[:, m, codes[:, m]]
+        return scores
+
+    def _params(self):
+        return {**super()._params(), "nlist": self.nlist, "nprobe": self.nprobe, "pq_m": self.pq_m,
+                "train_size": self.train_size, "seed": self.seed, "refine": self.refine}
+
+    def _arrays(self):
+        arrays = {"ids": self.ids, "offsets": self.offsets, "centroids": self.centroids}
+        if self.pq_m:
+            arrays.update(codes=self.codes, codebooks=self.codebooks)
+        if self.stores_vectors:
+            arrays["vectors"] = self.vectors
+        return arrays
+
+    @classmethod
+    def _restore(cls, params, arrays):
+        index = cls(params["dim"], params["nlist"], params["nprobe"], params["pq_m"], params["metric"],
+                    params["train_size"], params["seed"], params.get("refine", 0))
+        index.ids, index.offsets, index.centroids = arrays["ids"], arrays["offsets"], arrays["centroids"]
+        if index.pq_m:
+            index.codes, index.codebooks = arrays["codes"], arrays["codebooks"]
+        if index.stores_vectors:
+            index.vectors = arrays["vectors"]
+        return index
+
+
+INDEX_TYPES = {cls.kind: cls for cls in (BruteForceIndex, IVFIndex)}
+
+
+def load_index(path):
+    with np.load(path, allow_pickle=False) as data:
+        params = json.loads(str(data["params"]))
+        arrays = {name: data[name] for name in data.files if name != "params"}
+    return INDEX_TYPES[params["kind"]]._restore(params, arrays)
+
+
+def build_index(vectors, ids=None, kind="ivf", metric="cosine", **params):
+    """一步建索引：数据量小于 nlist 的 40 倍时 IVF 意义不大，直接用精确检索"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if kind == "ivf" and len(vectors) < 40 * params.get("nlist", 1024):
+        kind = "flat"
+    if kind == "flat":
+        index = BruteForceIndex(vectors.shape[1], metric)
+    else:
+        index = IVFIndex(vectors.shape[1], metric=metric, **params)
+        index.train(vectors)
+    index.add(vectors, ids)
+    return index
+
+
+# ========= 召回率 / 延迟基准 =============
+
+def synthetic_vectors(n, dim, n_clusters=1000, seed=0, chunk=100000):
+    """聚簇的高斯向量（比均匀随机更像真实 embedding 的分布）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    data = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, chunk):
+        size = min(chunk, n - start)
+        data[start:start + size] = centers[rng.integers(n_clusters, size=size)]
+        data[start:start + size] += 0.6 * rng.standard_normal((size, dim), dtype=np.float32)
+    return data
+
+
+def recall_at_k(found, truth):
+    return np.mean([len(np.intersect1d(f, t)) / len(t) for f, t in zip(found, truth)])
+
+
+def timed_search(index, queries, k, **kwargs):
+    started = time.perf_counter()
+    _, ids = index.search(queries, k, **kwargs)
+    return ids, (time.perf_counter() - started) * 1000 / len(queries)
+
+
+def run_benchmark(n=ANN_BENCH_N, dim=ANN_BENCH_DIM, n_queries=ANN_BENCH_QUERIES, k=10):
+    print(f"📦 生成 {n} x {dim} 合成向量 ...")
+    # 查询与数据同分布：一起生成，最后 n_queries 条留作查询
+    data = prepare(synthetic_vectors(n + n_queries, dim), "cosine")
+    data, queries = data[:n], data[n:]
+    nlist = max(16, int(4 * np.sqrt(n)) // 16 * 16)
+
+    exact = BruteForceIndex(dim)
+    exact.vectors, exact.ids = data, np.arange(n)
+    truth, exact_ms = timed_search(exact, queries, k)
+    print(f"🎯 精确检索: {exact_ms:.2f} ms/query")
+
+    # PQ 索引存了原向量时同一个索引分别测纯 PQ 和精排
+    refine = ANN_BENCH_REFINE if ANN_BENCH_FLAT else 0
+    configs = [("IVF-PQ", {"pq_m": dim // 8, "refine": refine})]
+    if ANN_BENCH_FLAT:
+        configs.insert(0, ("IVF-flat", {}))
+    for name, params in configs:
+        started = time.perf_counter()
+        index = IVFIndex(dim, nlist=nlist, **params)
+        index.train(data)
+        index.add(data)
+        print(f"\n🏗️  {name} nlist={nlist} 构建 {time.perf_counter() - started:.1f}s")
+        variants = [(name, {})]
+        if params.get("refine"):
+            variants = [(name, {"refine": 0}), (f"{name} + 精排 r={refine}", {})]
+        for label, search_kwargs in variants:
+            print(f"{label}")
+            print(f"{'nprobe':>8} {'recall@' + str(k):>10} {'ms/query':>10} {'加速比':>8}")
+            for nprobe in (1, 2, 4, 8, 16, 32, 64):
+                if nprobe > nlist:
+                    break
+                found, ms = timed_search(index, queries, k, nprobe=nprobe, **search_kwargs)
+                print(f"{nprobe:>8} {recall_at_k(found, truth):>10.3f} {ms:>10.2f} {exact_ms / ms:>8.1f}x")
+        del index
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,211 @@
+"""
+Embedding 本地缓存：按 (模型, 规范化文本的哈希) 寻址，ch08 的各个脚本共用。
+
+每个模型一个目录：
+  vectors.f32   float32 向量矩阵，np.memmap 映射，按槽位存放，按需倍增
+  index.json    维度、容量和 LRU 顺序的 {键: 槽位}
+
+用法：
+    cache = EmbeddingCache()
+    vectors = cache.get_or_compute("jina-embeddings-zh", documents, embed_batch)
+其中 embed_batch(texts) 一次返回 texts 对应的全部向量，只有未命中的文本才会送去计算。
+"""
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache")
+# 每个模型最多缓存多少条向量，超出后淘汰最久未使用的
+EMBEDDING_CACHE_CAPACITY = int(os.getenv("EMBEDDING_CACHE_CAPACITY", "100000"))
+
+
+def normalize_text(text):
+    """Unicode NFC + 折叠空白，换行和多余空格不影响命中"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class ModelStore:
+    """单个模型的向量文件 + LRU 索引（由 EmbeddingCache 加锁调用）"""
+
+    INITIAL_ROWS = 1024
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.index_path = os.path.join(directory, "index.json")
+        self.slots = OrderedDict()
+        self.dim = None
+        self.rows = 0
+        self.matrix = None
+        self.dirty = False
+
+        if os.path.exists(self.index_path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            dim, rows, slots = int(meta["dim"]), int(meta["rows"]), OrderedDict(meta["slots"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        # 向量文件丢失、被截断，或索引指向文件外的槽位：索引不可信，丢弃后从空缓存开始
+        if not os.path.exists(self.vectors_path) or os.path.getsize(self.vectors_path) < rows * dim * 4:
+            return
+        if any(not 0 <= slot < rows for slot in slots.values()):
+            return
+        self.dim, self.rows, self.slots = dim, rows, slots
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(rows, dim))
+
+    def get(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        self.slots.move_to_end(key)
+        return np.array(self.matrix[slot])
+
+    def put(self, key, vector):
+        self.put_many([(key, vector)])
+
+    def put_many(self, items):
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in items]
+        if not items:
+            return
+        if self.dim is None:
+            self._allocate(items[0][1].shape[0])
+        for _, vector in items:
+            if vector.shape != (self.dim,):
+                raise ValueError(f"向量维度 {vector.shape} 与缓存维度 {self.dim} 不一致")
+
+        # 先分配槽位，新键暂不进索引
+        writes = {}
+        added = OrderedDict()
+        evicted = False
+        for key, vector in items:
+            slot = self.slots.get(key)
+            if slot is not None:
+                self.slots.move_to_end(key)
+            elif key in added:
+                slot = added[key]
+                added.move_to_end(key)
+            elif len(self.slots) + len(added) < self.capacity:
+                slot = len(self.slots) + len(added)
+                if slot >= self.rows:
+                    self._grow()
+                added[key] = slot
+            else:
+                # 满了：复用最久未使用条目的槽位（本批新键比容量还多时挤掉本批最早的）
+                if self.slots:
+                    _, slot = self.slots.popitem(last=False)
+                    evicted = True
+                else:
+                    _, slot = added.popitem(last=False)
+                added[key] = slot
+            writes[slot] = vector
+
+        # 被淘汰的键先从磁盘索引里去掉，再覆盖它的槽位；
+        # 否则写到一半进程崩溃，重启后旧键会读到新文本的向量
+        if evicted:
+            self._write_index()
+        for slot, vector in writes.items():
+            self.matrix[slot] = vector
+        self.slots.update(added)
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty:
+            return
+        self._write_index()
+        self.dirty = False
+
+    def _write_index(self):
+        # 先落盘向量再写索引，索引里出现的槽位一定已经写好
+        self.matrix.flush()
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "rows": self.rows, "slots": list(self.slots.items())}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _allocate(self, dim):
+        os.makedirs(self.directory, exist_ok=True)
+        self.dim = dim
+        self.rows = min(self.INITIAL_ROWS, self.capacity)
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="w+", shape=(self.rows, dim))
+
+    def _grow(self):
+        self.matrix.flush()
+        self.rows = min(self.rows * 2, self.capacity)
+        with open(self.vectors_path, "r+b") as f:
+            f.truncate(self.rows * self.dim * 4)
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(self.rows, self.dim))
+
+
+class EmbeddingCache:
+    """按模型分目录的 Embedding 缓存，线程安全，支持批量查询"""
+
+    def __init__(self, root=EMBEDDING_CACHE_DIR, capacity=EMBEDDING_CACHE_CAPACITY):
+        self.root = root
+        self.capacity = capacity
+        self.stores = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, model):
+        if model not in self.stores:
+            directory = os.path.join(self.root, hashlib.sha1(model.encode("utf-8")).hexdigest()[:16])
+            self.stores[model] = ModelStore(directory, self.capacity)
+        return self.stores[model]
+
+    def get_many(self, model, texts):
+        """批量查询：返回与 texts 对齐的列表，未命中的位置为 None"""
+        with self.lock:
+            store = self._store(model)
+            results = [store.get(text_key(text)) for text in texts]
+        hits = sum(r is not None for r in results)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model, texts, vectors):
+        with self.lock:
+            store = self._store(model)
+            store.put_many([(text_key(text), vector) for text, vector in zip(texts, vectors)])
+            store.flush()
+
+    def get(self, model, text):
+        return self.get_many(model, [text])[0]
+
+    def put(self, model, text, vector):
+        self.put_many(model, [text], [vector])
+
+    def get_or_compute(self, model, texts, embed_batch):
+        """
+        命中的直接从缓存取，未命中的去重后一次交给 embed_batch 计算并写回缓存；
+        返回 (len(texts), dim) 的 float32 矩阵
+        """
+        results = self.get_many(model, texts)
+        missing = list(OrderedDict.fromkeys(
+            normalize_text(text) for text, vector in zip(texts, results) if vector is None
+        ))
+        if missing:
+            computed = dict(zip(missing, (np.asarray(v, dtype=np.float32) for v in embed_batch(missing))))
+            self.put_many(model, missing, [computed[text] for text in missing])
+            results = [computed[normalize_text(text)] if vector is None else vector
+                       for text, vector in zip(texts, results)]
+        return np.vstack(results) if results else np.empty((0, 0), dtype=np.float32)
+
+    def stats(self):
+        with self.lock:
+            entries = {model: len(store.slots) for model, store in self.stores.items()}
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
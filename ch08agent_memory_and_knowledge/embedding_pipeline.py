@@ -0,0 +1,101 @@
+"""
+批量 Embedding 流水线：按 batch_size 分批，asyncio 并发请求，瞬时错误带抖动退避重试。
+
+    client = OpenAI(api_key=api_key, base_url="http://10.248.10.54:5000/v1")
+    vectors = embed_many(texts, batch_size=64, concurrency=4, client=client)   # 与 texts 顺序一致
+
+大语料可以用 stream_embeddings 边算边处理（按完成顺序产出，带起始下标，需要 AsyncOpenAI）：
+
+    async for start, batch_vectors in stream_embeddings(async_client, texts):
+        ...
+"""
+import asyncio
+import itertools
+import random
+
+import openai
+
+DEFAULT_MODEL = "jina-embeddings-zh"
+
+# 这些错误多半是暂时的（网络抖动、限流、服务端 5xx），值得重试
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+def batched(texts, batch_size):
+    iterator = iter(texts)
+    start = 0
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield start, batch
+        start += len(batch)
+
+
+async def embed_batch_with_retry(client, batch, model=DEFAULT_MODEL, max_retries=5, base_delay=0.5, max_delay=20.0):
+    """请求一批向量；可重试的错误按指数退避 + 全抖动（full jitter）重试"""
+    for attempt in range(max_retries + 1):
+        try:
+            response = await client.embeddings.create(model=model, input=batch)
+            return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            print(f"⚠️  embedding 请求失败（第 {attempt + 1} 次），{delay:.2f}s 后重试: {e!r}")
+            await asyncio.sleep(delay)
+
+
+async def stream_embeddings(client, texts, model=DEFAULT_MODEL, batch_size=64, concurrency=4, max_retries=5):
+    """
+    并发计算 texts 的向量，每完成一批就产出 (起始下标, 向量列表)；
+    同时在途的请求不超过 concurrency 个，texts 可以是惰性的可迭代对象
+    """
+    batches = batched((text.replace("\n", " ") for text in texts), batch_size)
+    pending = {}
+
+    def submit():
+        for start, batch in itertools.islice(batches, concurrency - len(pending)):
+            task = asyncio.create_task(embed_batch_with_retry(client, batch, model, max_retries))
+            pending[task] = start
+
+    try:
+        submit()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                start = pending.pop(task)
+                yield start, task.result()
+            submit()
+    finally:
+        # 出错或调用方提前退出时，取消还在跑的批次
+        for task in pending:
+            task.cancel()
+
+
+async def aembed_many(texts, batch_size=64, concurrency=4, *, client, model=DEFAULT_MODEL, max_retries=5):
+    texts = list(texts)
+    vectors = [None] * len(texts)
+    async for start, batch_vectors in stream_embeddings(client, texts, model, batch_size, concurrency, max_retries):
+        vectors[start:start + len(batch_vectors)] = batch_vectors
+    return vectors
+
+
+def embed_many(texts, batch_size=64, concurrency=4, *, client, model=DEFAULT_MODEL, max_retries=5):
+    """
+    同步入口：返回与 texts 顺序一致的向量列表。
+    client 用脚本里现成的 OpenAI 客户端即可，这里按它的地址和 key 临时建一个 AsyncOpenAI
+    （重试由本流水线负责，所以关掉 SDK 自带的重试）
+    """
+    async def run():
+        async with openai.AsyncOpenAI(api_key=client.api_key, base_url=client.base_url, max_retries=0) as async_client:
+            return await aembed_many(
+                texts, batch_size, concurrency, client=async_client, model=model, max_retries=max_retries
+            )
+
+    return asyncio.run(run())
@@ -1,8 +1,15 @@
 from openai import OpenAI
-import chromadb
 
 from dotenv import load_dotenv
+import hashlib
 import os
+
+import numpy as np
+
+from ann_index import build_index, load_index
+from embedding_cache import EmbeddingCache
+from embedding_pipeline import embed_many
+
 # ========= 1. 使用本地 Embedding API =============
 
 # 这里假设你的本地服务地址是这个：
@@ -19,18 +26,30 @@ client = OpenAI(
     api_key=api_key,
     base_url="http://10.248.10.54:5000/v1"  # 注意带 /v1
 )
+
+# 本地向量缓存：重复运行脚本时，已经算过的文档不再请求 embedding 服务
+embedding_cache = EmbeddingCache()
+
+
+def embed_batch(texts, model="jina-embeddings-zh"):
+    """分批并发请求，失败自动重试，结果与 texts 顺序一致"""
+    return embed_many(texts, batch_size=64, concurrency=4, client=client, model=model)
+
+
+def get_embeddings(texts, model="jina-embeddings-zh"):
+    """批量取向量：命中本地缓存的直接返回，其余一次请求补齐"""
+    texts = [text.replace("\n", " ") for text in texts]
+    vectors = embedding_cache.get_or_compute(model, texts, lambda batch: embed_batch(batch, model))
+    return vectors.tolist()
+
+
 def get_embedding(text, model="jina-embeddings-zh"):
     """
-    调用本地的 embedding 接口。
+    调用本地的 embedding 接口（带本地缓存，同一段文本只算一次）。
     如果你的本地模型名字不同，比如 'bge-m3'、'mxbai-embed-large' 等，
     把上面的默认 model 改掉就可以。
     """
-    text = text.replace("\n", " ")
-    response = client.embeddings.create(
-        input=[text],
-        model=model,
-    )
-    return response.data[0].embedding
+    return get_embeddings([text], model)[0]
 
 # ========= 2. 示例文档 & 生成向量 =============
 
@@ -45,25 +64,99 @@ documents = [
     "The dog is lazy but the brown fox is quick!"
 ]
 
-embeddings = [get_embedding(doc) for doc in documents]
 ids = [f"id{i}" for i in range(len(documents))]
 
-# ========= 3. 创建 Chroma 集合 =============
+# ========= 3. 创建 / 增量同步 Chroma 集合 =============
 
-# 内存模式（进程结束就没了）
-chroma_client = chromadb.Client()
+EMBEDDING_MODEL = "jina-embeddings-zh"
+# 检索后端：chroma（默认）或 ann（本地 ann_index，不需要 Chroma）
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "chroma")
+# 落盘目录；设为空字符串则用内存模式（进程结束就没了，每次都要全量写入）
+CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./chroma_db")
+# 本地索引的落盘目录；文件名带文档指纹，文档或模型变了就重建
+ANN_INDEX_DIR = os.getenv("ANN_INDEX_DIR", "./ann_index")
 
-# 如果你想落盘持久化，可以用：
-# import chromadb
-# chroma_client = chromadb.PersistentClient(path="./chroma_db")
 
-collection = chroma_client.create_collection(name="documents")
+def content_hash(text, model=EMBEDDING_MODEL):
+    """文档内容 + embedding 模型的指纹，任一变化都需要重新写入"""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
 
-collection.add(
-    embeddings=embeddings,
-    documents=documents,    
-    ids=ids
-)
+
+def sync_documents(collection, documents, ids, model=EMBEDDING_MODEL):
+    """
+    按 id 增量同步：内容指纹没变的跳过，新增/修改的重新 embedding 后 upsert，
+    集合里有但本次没有的删除。返回 {added, updated, deleted, unchanged}
+    """
+    existing = collection.get(include=["metadatas"])
+    old_hashes = {
+        doc_id: (metadata or {}).get("content_hash")
+        for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+    }
+
+    diff = {"added": [], "updated": [], "deleted": [], "unchanged": []}
+    changed = []
+    for doc_id, text in zip(ids, documents):
+        digest = content_hash(text, model)
+        if doc_id not in old_hashes:
+            diff["added"].append(doc_id)
+        elif old_hashes[doc_id] != digest:
+            diff["updated"].append(doc_id)
+        else:
+            diff["unchanged"].append(doc_id)
+            continue
+        changed.append((doc_id, text, digest))
+
+    if changed:
+        changed_ids, changed_docs, digests = zip(*changed)
+        collection.upsert(
+            ids=list(changed_ids),
+            embeddings=get_embeddings(list(changed_docs), model),
+            documents=list(changed_docs),
+            metadatas=[{"content_hash": digest} for digest in digests]
+        )
+
+    diff["deleted"] = sorted(set(old_hashes) - set(ids))
+    if diff["deleted"]:
+        collection.delete(ids=diff["deleted"])
+    return diff
+
+
+def open_local_index(documents, model=EMBEDDING_MODEL):
+    """
+    本地 ANN 索引：按全部文档的内容指纹命名，存在就直接加载，否则用（带缓存的）向量构建并保存。
+    文档少时 build_index 自动退化为精确检索，大文档集才会用 IVF。
+    """
+    fingerprint = hashlib.sha256("".join(content_hash(text, model) for text in documents).encode()).hexdigest()
+    path = os.path.join(ANN_INDEX_DIR, f"documents-{fingerprint[:16]}.ann.npz")
+    if os.path.exists(path):
+        return load_index(path)
+    index = build_index(np.asarray(get_embeddings(documents, model), dtype=np.float32))
+    os.makedirs(ANN_INDEX_DIR, exist_ok=True)
+    index.save(path)
+    return index
+
+
+if SEARCH_BACKEND == "ann":
+    local_index = open_local_index(documents)
+    print(f"本地索引: {type(local_index).__name__}, {len(local_index)} 条")
+else:
+    import chromadb
+
+    if CHROMA_PERSIST_DIR:
+        chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+    else:
+        chroma_client = chromadb.Client()
+
+    collection = chroma_client.get_or_create_collection(name="documents")
+
+    sync_diff = sync_documents(collection, documents, ids)
+    print(
+        f"同步完成: 新增 {len(sync_diff['added'])}, 更新 {len(sync_diff['updated'])}, "
+        f"删除 {len(sync_diff['deleted'])}, 未变 {len(sync_diff['unchanged'])}"
+    )
+    for kind in ("added", "updated", "deleted"):
+        if sync_diff[kind]:
+            print(f"  {kind}: {', '.join(sync_diff[kind])}")
 
 # ========= 4. 查询函数 =============
 
@@ -84,6 +177,19 @@ def query_chromadb(query, top_n=2):
         )
     ]
 
+
+def query_local_index(query, top_n=2):
+    """同样的返回格式，用本地 ANN 索引检索；cosine 相似度换算成距离（1 - 相似度）"""
+    scores, rows = local_index.search(np.asarray([get_embedding(query)], dtype=np.float32), k=top_n)
+    return [
+        (ids[row], 1.0 - float(score), documents[row])
+        for score, row in zip(scores[0], rows[0])
+        if row >= 0
+    ]
+
+
+search = query_local_index if SEARCH_BACKEND == "ann" else query_chromadb
+
 # ========= 5. 交互式查询循环 =============
 
 if __name__ == "__main__":
@@ -92,7 +198,7 @@ if __name__ == "__main__":
         if query.lower() == "exit":
             break
         top_n = int(input("How many top matches do you want to see? "))
-        search_results = query_chromadb(query, top_n)
+        search_results = search(query, top_n)
         
         print("Top Matched Documents:")
         for id, score, text in search_results:
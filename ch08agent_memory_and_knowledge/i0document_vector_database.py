@@ -1,6 +1,6 @@
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 
 # Sample Documents
 documents = [
@@ -14,31 +14,67 @@ documents = [
     "The dog is lazy but the brown fox is quick!"
 ]
 
-# Step 1: Vectorize with TF-IDF Vectorizer
-vectorizer = TfidfVectorizer()
-X = vectorizer.fit_transform(documents)
+# Step 1 & 2: Vectorize with TF-IDF and keep the vectors sparse
+class TfidfSearchEngine:
+    """
+    稀疏 TF-IDF 检索：行向量预先 L2 归一化，余弦相似度就是一次稀疏矩阵乘法；
+    top-k 用 argpartition 只挑出前 k 个再排序。内存和耗时随非零元素数增长，而不是 词表 x 文档数。
+    """
+
+    def __init__(self, documents, query_block_size=256, **vectorizer_kwargs):
+        self.vectorizer = TfidfVectorizer(**vectorizer_kwargs)
+        self.matrix = normalize(self.vectorizer.fit_transform(documents)).tocsr()  # (文档数, 词表) 稀疏
+        self.matrix_t = self.matrix.T.tocsr()  # 预先转置，查询时走 CSR x CSR 乘法
+        self.query_block_size = query_block_size
+
+    def search_many(self, queries, top_n=5):
+        """批量查询：返回每个 query 的 [(文档下标, 相似度), ...]，按相似度降序"""
+        n_docs = self.matrix.shape[0]
+        top_n = min(top_n, n_docs)
+        results = []
+        if top_n <= 0:
+            return [[] for _ in queries]
+        query_matrix = normalize(self.vectorizer.transform(queries)).tocsr()
+        # 分块计算，(块大小 x 文档数) 的得分矩阵不会随查询数无限增长
+        for start in range(0, query_matrix.shape[0], self.query_block_size):
+            scores = (query_matrix[start:start + self.query_block_size] @ self.matrix_t).toarray()
+            if top_n < n_docs:
+                candidates = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+            else:
+                candidates = np.broadcast_to(np.arange(n_docs), scores.shape)
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1, kind="stable")
+            top_indices = np.take_along_axis(candidates, order, axis=1)
+            top_scores = np.take_along_axis(candidate_scores, order, axis=1)
+            results.extend(
+                [(int(idx), float(score)) for idx, score in zip(row_indices, row_scores)]
+                for row_indices, row_scores in zip(top_indices, top_scores)
+            )
+        return results
+
+    def search(self, query, top_n=5):
+        return self.search_many([query], top_n)[0]
+
+
+search_engine = TfidfSearchEngine(documents)
 
-# Step 2: Store vectors in a simple vector database (here, a list)
-vector_database = X.toarray()
 
 # Step 3: Cosine Similarity Search Function
-def cosine_similarity_search(query, database, vectorizer, top_n=5):
-    query_vec = vectorizer.transform([query]).toarray()
-    similarities = cosine_similarity(query_vec, database)[0]
-    top_indices = np.argsort(-similarities)[:top_n]  # Top n indices
-    return [(idx, similarities[idx]) for idx in top_indices]
+def cosine_similarity_search(query, engine=search_engine, top_n=5):
+    return engine.search(query, top_n)
+
 
 # Input Loop for Search Queries
-while True:
-    query = input("Enter a search query (or 'exit' to stop): ")
-    if query.lower() == 'exit':
-        break
-    top_n = int(input("How many top matches do you want to see? "))
-    search_results = cosine_similarity_search(query, vector_database, vectorizer, top_n)
-    
-    print("Top Matched Documents:")
-    for idx, score in search_results:
-        print(f"- {documents[idx]} (Score: {score:.4f})")
-
-    print("\n")
+if __name__ == "__main__":
+    while True:
+        query = input("Enter a search query (or 'exit' to stop): ")
+        if query.lower() == 'exit':
+            break
+        top_n = int(input("How many top matches do you want to see? "))
+        search_results = cosine_similarity_search(query, search_engine, top_n)
+
+        print("Top Matched Documents:")
+        for idx, score in search_results:
+            print(f"- {documents[idx]} (Score: {score:.4f})")
 
+        print("\n")
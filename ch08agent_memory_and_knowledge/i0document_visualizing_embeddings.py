@@ -1,10 +1,12 @@
 from openai import OpenAI
-import numpy as np
 from sklearn.decomposition import PCA
 import plotly.graph_objects as go
 from dotenv import load_dotenv
 import os
 
+from embedding_cache import EmbeddingCache
+from embedding_pipeline import embed_many
+
 # Load API key from .env file
 load_dotenv()
 
@@ -20,14 +22,22 @@ client = OpenAI(
     base_url="http://10.248.10.54:5000/v1"  # 注意带 /v1
 )
 
+embedding_cache = EmbeddingCache()
+
+
+def embed_batch(texts, model="jina-embeddings-zh"):
+    # 你的 proxy 的 embeddings 接口已经是 OpenAI 兼容格式：分批并发请求，失败自动重试，顺序不变
+    return embed_many(texts, batch_size=64, concurrency=4, client=client, model=model)
+
+
+def get_embeddings(texts, model="jina-embeddings-zh"):
+    # 命中本地缓存的直接返回，其余一次请求补齐；重复运行脚本几乎不再访问 embedding 服务
+    texts = [text.replace("\n", " ") for text in texts]
+    return embedding_cache.get_or_compute(model, texts, lambda batch: embed_batch(batch, model))
+
+
 def get_embedding(text, model="jina-embeddings-zh"):
-    # 你的 proxy 的 embeddings 接口已经是 OpenAI 兼容格式
-    text = text.replace("\n", " ")
-    resp = client.embeddings.create(
-        model=model,
-        input=[text],   # 这里用 list，拿 data[0] 就行
-    )
-    return resp.data[0].embedding
+    return get_embeddings([text], model)[0].tolist()
 
 # Sample documents（你也可以换成中文句子测试）
 documents = [
@@ -41,11 +51,8 @@ documents = [
     "The dog is lazy but the brown fox is quick!"
 ]
 
-# Generate embeddings for each document
-embeddings = [get_embedding(doc) for doc in documents]
-
-# Convert embeddings to a numpy array for PCA
-embeddings_array = np.array(embeddings)
+# Generate embeddings for all documents (float32 矩阵，可直接做 PCA)
+embeddings_array = get_embeddings(documents)
 
 print("embeddings shape:", embeddings_array.shape)  # 预期是 (8, 768)
 
@@ -3,250 +3,3327 @@
 DeepSeek V3.2-Exp Tool Calling 代理服务器 (支持流式)
 """
 
+import asyncio
+import atexit
+import bisect
+import contextvars
+import functools
+import hashlib
+import importlib.util
 import json
+import logging
 import os
+import queue
+import random
 import re
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import anyio
 import httpx
-from typing import Any, Dict, List, Optional, AsyncIterator
+from collections import Counter, OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, List, Optional, AsyncIterator, Tuple
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import uvicorn
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
+try:
+    import fcntl
+except ImportError:  # Windows 没有 flock：多 worker 时批次可能被多个 worker 同时续跑
+    fcntl = None
 
 
-app = FastAPI(title="DeepSeek Tool Calling Proxy")
+# 远程 DeepSeek API 配置
+DEEPSEEK_API_URL = os.getenv(
+    "DEEPSEEK_API_URL", 
+    "http://10.248.60.236:5000/v1/chat/completions"
+)
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_OPENAI_API_KEY")
+
+# 多后端：逗号分隔，可用 "|权重" 指定权重，未设置时只用 DEEPSEEK_API_URL
+# 例如: http://10.0.0.1:5000/v1/chat/completions|2,http://10.0.0.2:5000/v1/chat/completions
+DEEPSEEK_API_URLS = os.getenv("DEEPSEEK_API_URLS", DEEPSEEK_API_URL)
+# 选择策略: least_outstanding（最少在途请求）或 ewma（延迟指数滑动平均）
+UPSTREAM_LB_STRATEGY = os.getenv("UPSTREAM_LB_STRATEGY", "least_outstanding")
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "1"))
+UPSTREAM_HEALTH_INTERVAL = float(os.getenv("UPSTREAM_HEALTH_INTERVAL", "10"))
+UPSTREAM_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_FAILURE_THRESHOLD", "3"))
+UPSTREAM_CIRCUIT_COOLDOWN = float(os.getenv("UPSTREAM_CIRCUIT_COOLDOWN", "30"))
+
+# 启动时验证配置
+if not DEEPSEEK_API_KEY:
+    raise ValueError(
+        "❌ 环境变量 DEEPSEEK_OPENAI_API_KEY 未设置！\n"
+        "请运行: export DEEPSEEK_OPENAI_API_KEY='your-api-key'"
+    )
+
+# 上游连接池配置（整个进程共用一个 httpx.AsyncClient）
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "60"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+# HTTP/2 需要额外安装: pip install 'httpx[http2]'
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "0") == "1"
+
+# 流式转发：上游与客户端之间最多缓冲多少个 SSE 块（客户端读得慢时对上游施加背压）
+STREAM_RELAY_BUFFER = int(os.getenv("STREAM_RELAY_BUFFER", "64"))
+
+# 流式请求时向上游要 usage（stream_options.include_usage），上游不支持时自动关闭
+UPSTREAM_STREAM_USAGE = os.getenv("UPSTREAM_STREAM_USAGE", "1") == "1"
+# 上游没有返回 usage 时本地计数用的 tiktoken 编码（未安装 tiktoken 时按字符数估算）
+LOCAL_TOKENIZER = os.getenv("LOCAL_TOKENIZER", "cl100k_base")
+# 最近多少个请求的用量记录保留在内存环形缓冲区中（/admin/usage）
+USAGE_RING_SIZE = int(os.getenv("USAGE_RING_SIZE", "1000"))
+
+# 首轮工具请求是否走增量解析的流式通道（关闭则回退为非流式）
+STREAM_TOOL_CALLS = os.getenv("STREAM_TOOL_CALLS", "1") == "1"
+
+# 工具提示词缓存：按 tools 数组的稳定哈希记忆渲染结果
+TOOL_PROMPT_CACHE_SIZE = int(os.getenv("TOOL_PROMPT_CACHE_SIZE", "128"))
+# 紧凑模式：参数 schema 不缩进，减少提示词 token
+TOOL_SCHEMA_COMPACT = os.getenv("TOOL_SCHEMA_COMPACT", "0") == "1"
+# 工具调用参数按 schema 校验：warn（记录并照常返回）/ strict（丢弃不合规的调用）/ off
+TOOL_CALL_VALIDATION = os.getenv("TOOL_CALL_VALIDATION", "warn")
+
+# 前缀稳定布局：同一会话多轮之间保持字节级一致的前缀，便于上游 KV/radix 前缀缓存复用
+PREFIX_STABLE_LAYOUT = os.getenv("PREFIX_STABLE_LAYOUT", "0") == "1"
+
+# 精确匹配响应缓存（默认关闭）
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 只缓存确定性请求：temperature 不高于该值
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0"))
+# 可选的磁盘二级缓存，例如 ./proxy_cache.sqlite
+RESPONSE_CACHE_SQLITE = os.getenv("RESPONSE_CACHE_SQLITE")
+RESPONSE_CACHE_SQLITE_MAX_ROWS = int(os.getenv("RESPONSE_CACHE_SQLITE_MAX_ROWS", "100000"))
+
+# 合并同时在途的相同请求（single-flight），默认关闭
+REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "0") == "1"
+
+# 准入控制：全局/每个 API key/每个模型的并发上限、有界等待队列和 token 限速（默认关闭）
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "0") == "1"
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "32"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "128"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+# 0 表示不限制
+ADMISSION_PER_KEY_CONCURRENCY = int(os.getenv("ADMISSION_PER_KEY_CONCURRENCY", "8"))
+ADMISSION_PER_MODEL_CONCURRENCY = int(os.getenv("ADMISSION_PER_MODEL_CONCURRENCY", "0"))
+RATE_LIMIT_TOKENS_PER_MINUTE = int(os.getenv("RATE_LIMIT_TOKENS_PER_MINUTE", "0"))
+RATE_LIMIT_BURST_TOKENS = int(os.getenv("RATE_LIMIT_BURST_TOKENS", str(RATE_LIMIT_TOKENS_PER_MINUTE)))
+
+# 批量任务（/v1/batches）：输入、结果和进度落盘的目录，以及每个批次的并发数
+BATCH_DIR = os.getenv("BATCH_DIR", "batches")
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50000"))
+# 单条请求被准入控制拒绝（429）时最多重试几次
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "5"))
+# 执行中的批次最多每隔多少秒写一次 batch.json（进度以 output.jsonl 为准，batch.json 允许落后）
+BATCH_META_SAVE_INTERVAL = float(os.getenv("BATCH_META_SAVE_INTERVAL", "1"))
+
+# 历史压缩：对话超出 token 预算时，把较早的轮次换成滚动摘要（默认关闭）
+HISTORY_COMPACTION = os.getenv("HISTORY_COMPACTION", "0") == "1"
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))
+# 无论预算多紧都原样保留的最近消息条数
+HISTORY_KEEP_RECENT = int(os.getenv("HISTORY_KEEP_RECENT", "4"))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "400"))
+HISTORY_SUMMARY_CACHE_SIZE = int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "1024"))
+
+# Embedding 透传（/v1/embeddings）：上游默认是 ch08 示例用的向量服务
+EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "http://10.248.10.54:5000/v1/embeddings")
+EMBEDDING_API_KEY = os.getenv("EMBEDDING_API_KEY", DEEPSEEK_API_KEY)
+# 微批：窗口内到达的小请求合并成一次上游调用，最多合并多少条文本
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "64"))
+
+# 多进程：PROXY_WORKERS>1 时以多个 uvicorn worker 运行（也可以
+#   gunicorn -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:8000 i0deepseek_adapter_server:app）
+PROXY_HOST = os.getenv("PROXY_HOST", "0.0.0.0")
+PROXY_PORT = int(os.getenv("PROXY_PORT", "8000"))
+PROXY_WORKERS = int(os.getenv("PROXY_WORKERS", "1"))
+# 必须全局一致的状态（响应缓存二级层、限速令牌桶、指标）放在哪里：
+#   空                     进程内（单 worker 的默认行为）
+#   sqlite:///path         本机多个 worker 共享的 SQLite 文件，放在 /dev/shm 下即为共享内存
+#   redis://host:6379/0    Redis 或协议兼容的服务（需要 pip install redis）
+SHARED_STORE_URL = os.getenv("SHARED_STORE_URL", "")
+# 每个 worker 多久发布一次自己的指标；超过 TTL 没有更新的 worker 不再计入 /metrics
+SHARED_METRICS_INTERVAL = float(os.getenv("SHARED_METRICS_INTERVAL", "5"))
+SHARED_METRICS_TTL = float(os.getenv("SHARED_METRICS_TTL", "30"))
+
+# 日志：LOG_FORMAT=text（控制台可读）或 json（结构化，适合生产采集）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# 按请求采样 INFO/DEBUG 日志（WARNING 及以上始终输出）
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+# JSON 编解码后端: auto（装了 orjson 就用）/ orjson / stdlib
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+
+
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default="-")
+log_sampled_var: contextvars.ContextVar = contextvars.ContextVar("log_sampled", default=True)
+
+
+class RequestContextFilter(logging.Filter):
+    """附加请求 ID，并丢弃未被采样请求的 INFO/DEBUG 日志"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return record.levelno >= logging.WARNING or log_sampled_var.get()
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        current_time = datetime.fromtimestamp(record.created, timezone(timedelta(hours=8))).strftime("%H:%M:%S")
+        fields = getattr(record, "fields", None)
+        extra = " " + " ".join(f"{k}={v}" for k, v in fields.items()) if fields else ""
+        line = f"[{current_time}] [{getattr(record, 'request_id', '-')}] {record.getMessage()}{extra}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DeferredQueueHandler(QueueHandler):
+    """直接把 LogRecord 放入队列，格式化全部留给后台线程"""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging() -> logging.Logger:
+    logger = logging.getLogger("deepseek_proxy")
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    if logger.handlers:
+        return logger
+    
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    logger.addFilter(RequestContextFilter())
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    return logger
+
+
+log = setup_logging()
+
+
+# 请求/响应路径上的 JSON 编解码统一走这里：有 orjson 时用 orjson，否则用标准库的紧凑输出
+if JSON_BACKEND != "stdlib" and importlib.util.find_spec("orjson") is not None:
+    import orjson
+    
+    JSON_IMPL = "orjson"
+    json_loads = orjson.loads
+    
+    def json_dumps_bytes(obj: Any, sort_keys: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+else:
+    if JSON_BACKEND == "orjson":
+        log.warning("⚠️  未安装 orjson，JSON 回退到标准库 (pip install orjson)")
+    
+    JSON_IMPL = "stdlib"
+    json_loads = json.loads
+    
+    def json_dumps_bytes(obj: Any, sort_keys: bool = False) -> bytes:
+        return json.dumps(obj, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def json_dumps(obj: Any) -> str:
+    return json_dumps_bytes(obj).decode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """用 json_dumps_bytes 序列化的 JSONResponse"""
+    
+    def render(self, content: Any) -> bytes:
+        return json_dumps_bytes(content)
+
+
+def begin_request_logging(request: Request) -> str:
+    """为当前请求设置请求 ID（优先沿用客户端的 X-Request-ID）和采样标记"""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:12]
+    request_id_var.set(request_id)
+    log_sampled_var.set(LOG_SAMPLE_RATE >= 1.0 or random.random() < LOG_SAMPLE_RATE)
+    return request_id
+
+
+def create_upstream_client() -> httpx.AsyncClient:
+    """创建复用 TCP/TLS 连接的上游客户端"""
+    http2 = UPSTREAM_HTTP2 and importlib.util.find_spec("h2") is not None
+    if UPSTREAM_HTTP2 and not http2:
+        log.warning("⚠️  未安装 h2，HTTP/2 已回退为 HTTP/1.1 (pip install 'httpx[http2]')")
+    
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        headers={
+            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+            "Content-Type": "application/json"
+        },
+    )
+
+
+class Backend:
+    """一个上游推理节点及其负载、延迟和熔断状态"""
+    
+    EWMA_ALPHA = 0.3
+    
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url
+        self.models_url = re.sub(r"/chat/completions/?$", "/models", url)
+        self.weight = weight
+        self.outstanding = 0
+        self.ewma_latency = 1.0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.stream_usage = True
+    
+    def available(self, now: float) -> bool:
+        # 熔断冷却结束后进入半开状态，允许请求试探
+        return self.healthy and now >= self.circuit_open_until
+    
+    def score(self, strategy: str) -> float:
+        load = (self.outstanding + 1) / self.weight
+        if strategy == "ewma":
+            return self.ewma_latency * load
+        return load
+    
+    def begin(self) -> float:
+        self.outstanding += 1
+        self.requests += 1
+        return time.perf_counter()
+    
+    def end(self, started: float, ok: bool, record_latency: bool = True):
+        self.outstanding -= 1
+        if ok:
+            if record_latency:
+                latency = time.perf_counter() - started
+                self.ewma_latency += self.EWMA_ALPHA * (latency - self.ewma_latency)
+            self.consecutive_failures = 0
+            self.circuit_open_until = 0.0
+            return
+        
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= UPSTREAM_FAILURE_THRESHOLD:
+            self.circuit_open_until = time.time() + UPSTREAM_CIRCUIT_COOLDOWN
+            log.warning("⚠️  后端熔断 %.0fs: %s", UPSTREAM_CIRCUIT_COOLDOWN, self.url)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "healthy": self.healthy,
+            "circuit_open": time.time() < self.circuit_open_until,
+            "outstanding": self.outstanding,
+            "ewma_latency": round(self.ewma_latency, 4),
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class BackendPool:
+    """按 least-outstanding 或延迟 EWMA 选择后端，支持主动健康检查和熔断"""
+    
+    def __init__(self, spec: str, strategy: str):
+        self.strategy = strategy
+        self.backends: List[Backend] = []
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            url, _, weight = item.partition("|")
+            self.backends.append(Backend(url.strip(), float(weight) if weight else 1.0))
+        if not self.backends:
+            raise ValueError("❌ 未配置任何上游地址 (DEEPSEEK_API_URLS)")
+    
+    def pick(self, exclude: Optional[set] = None) -> Optional[Backend]:
+        exclude = exclude or set()
+        candidates = [b for b in self.backends if b.url not in exclude]
+        if not candidates:
+            return None
+        
+        now = time.time()
+        available = [b for b in candidates if b.available(now)]
+        # 全部不可用时仍然尝试（fail-open），避免健康检查误判导致完全不可用
+        pool = available or candidates
+        best = min(b.score(self.strategy) for b in pool)
+        return random.choice([b for b in pool if b.score(self.strategy) == best])
+    
+    async def check(self, client: httpx.AsyncClient, backend: Backend) -> bool:
+        try:
+            response = await client.get(backend.models_url, timeout=5.0)
+            response.raise_for_status()
+            ok = True
+        except httpx.HTTPError as e:
+            ok = False
+            if backend.healthy:
+                log.warning("⚠️  后端健康检查失败: %s (%r)", backend.url, e)
+        if ok and not backend.healthy:
+            log.warning("✅ 后端恢复: %s", backend.url)
+        backend.healthy = ok
+        return ok
+    
+    async def check_all(self, client: httpx.AsyncClient) -> List[bool]:
+        return await asyncio.gather(*(self.check(client, b) for b in self.backends))
+    
+    async def health_check_loop(self, client: httpx.AsyncClient):
+        while True:
+            await asyncio.sleep(UPSTREAM_HEALTH_INTERVAL)
+            await self.check_all(client)
+    
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [b.snapshot() for b in self.backends]
+
+
+backend_pool = BackendPool(DEEPSEEK_API_URLS, UPSTREAM_LB_STRATEGY)
+
+class MetricCounter:
+    """单调递增计数器；事件循环单线程，热路径上不加锁"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+    
+    def inc(self, labels: tuple, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{format_labels(self.labels, key)} {value:g}"
+            for key, value in self.values.items()
+        ]
+
+
+class MetricGauge(MetricCounter):
+    kind = "gauge"
+    
+    def dec(self, labels: tuple, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class MetricHistogram:
+    """固定桶直方图：每个 label 组合一个计数数组，observe 只做 bisect + 自增"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series: Dict[tuple, list] = {}
+    
+    def observe(self, labels: tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.labels + ('le',), key + (le,))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total:g}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def format_labels(names: Tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+class ProxyMetrics:
+    """代理的 Prometheus 指标"""
+    
+    def __init__(self):
+        self.requests = MetricCounter(
+            "proxy_requests_total", "Chat completion requests by outcome",
+            ("model", "stream", "status"))
+        self.in_flight = MetricGauge(
+            "proxy_requests_in_flight", "Chat completion requests currently being served",
+            ("model", "stream"))
+        self.duration = MetricHistogram(
+            "proxy_request_duration_seconds", "End-to-end request duration",
+            ("model", "stream"), LATENCY_BUCKETS)
+        self.upstream_latency = MetricHistogram(
+            "proxy_upstream_latency_seconds",
+            "Upstream latency (full response for non-stream, first chunk for stream)",
+            ("model", "stream"), LATENCY_BUCKETS)
+        self.ttft = MetricHistogram(
+            "proxy_time_to_first_token_seconds", "Time from request arrival to first streamed chunk",
+            ("model",), LATENCY_BUCKETS)
+        self.tokens_per_second = MetricHistogram(
+            "proxy_completion_tokens_per_second", "Completion tokens per second of generation",
+            ("model", "stream"), RATE_BUCKETS)
+        self.tool_requests = MetricCounter(
+            "proxy_tool_requests_total", "Tool-enabled responses by whether a tool call was extracted",
+            ("model", "extracted"))
+        self.tool_calls = MetricCounter(
+            "proxy_tool_calls_total", "Tool calls extracted from model output",
+            ("model",))
+        self.errors = MetricCounter(
+            "proxy_errors_total", "Request errors by class",
+            ("model", "error"))
+        self.tool_parse = MetricCounter(
+            "proxy_tool_call_parse_total",
+            "Tool call blocks by parse outcome (ok, repaired, coerced, invalid, failed)",
+            ("outcome",))
+    
+    def start(self, model: str, stream: str) -> "RequestMetrics":
+        return RequestMetrics(self, model, stream)
+    
+    def record_tool_extraction(self, model: str, count: int):
+        self.tool_requests.inc((model, "true" if count else "false"))
+        if count:
+            self.tool_calls.inc((model,), count)
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.__dict__.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        lines.extend(render_component_metrics())
+        return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=None)
+def get_local_tokenizer():
+    """tiktoken 可用时返回编码器，否则返回 None（按字符数估算）"""
+    if importlib.util.find_spec("tiktoken") is None:
+        return None
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(LOCAL_TOKENIZER)
+    except Exception as e:
+        log.warning("⚠️  本地 tokenizer 加载失败，改用字符数估算: %r", e)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_local_tokenizer()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[Dict[str, Any]]) -> int:
+    """按 OpenAI chat 格式估算：每条消息内容 token + 4 个格式 token"""
+    return sum(count_tokens(str(msg.get("content") or "")) + 4 for msg in messages)
+
+
+def sse_completion_text(chunks: List[bytes]) -> str:
+    """拼出 SSE 流里 delta 的文本（content 与工具调用的名称/参数），供本地 tokenizer 计数"""
+    parts = []
+    for event in b"".join(chunks).split(b"\n\n"):
+        event = event.strip()
+        if not event.startswith(b"data:"):
+            continue
+        data = event[5:].strip()
+        if data == b"[DONE]":
+            continue
+        try:
+            payload = json_loads(data)
+        except json.JSONDecodeError:
+            continue
+        for choice in payload.get("choices") or []:
+            delta = choice.get("delta") or {}
+            if delta.get("content"):
+                parts.append(delta["content"])
+            for tool_call in delta.get("tool_calls") or []:
+                function = tool_call.get("function") or {}
+                parts.append(function.get("name") or "")
+                parts.append(function.get("arguments") or "")
+    return "".join(parts)
+
+
+class UsageLog:
+    """最近请求的用量与时延记录（环形缓冲区）"""
+    
+    def __init__(self, size: int):
+        self.records: deque = deque(maxlen=size)
+        self.totals = {"requests": 0, "cache_hits": 0, "coalesced": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    
+    def add(self, record: Dict[str, Any]):
+        self.records.append(record)
+        self.totals["requests"] += 1
+        if record.get("cache") == "hit":
+            self.totals["cache_hits"] += 1
+        elif record.get("cache") == "coalesced":
+            self.totals["coalesced"] += 1
+        self.totals["prompt_tokens"] += record["prompt_tokens"] or 0
+        self.totals["completion_tokens"] += record["completion_tokens"] or 0
+    
+    def summary(self) -> Dict[str, Any]:
+        def percentiles(key: str) -> Dict[str, Optional[float]]:
+            values = sorted(r[key] for r in self.records if r.get(key) is not None)
+            if not values:
+                return {"p50": None, "p95": None}
+            return {
+                "p50": values[len(values) // 2],
+                "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+            }
+        
+        return {
+            "totals": dict(self.totals),
+            "window": len(self.records),
+            "ttft_seconds": percentiles("ttft"),
+            "inter_token_latency_seconds": percentiles("itl_mean"),
+            "tokens_per_second": percentiles("tokens_per_second"),
+        }
+
+
+usage_log = UsageLog(USAGE_RING_SIZE)
+
+
+class RequestMetrics:
+    """
+    单个请求的计时与用量；finish() 可重复调用，只记录第一次
+    
+    用量优先取上游返回的 usage，没有时用本地 tokenizer 计数：
+    prompt 按发给上游的消息计数，completion 按非流式的回复文本或流式转发的 delta 文本计数
+    （流式块先留着引用，只有结束时仍没有 usage 才解析）。
+    缓存命中（cache="HIT"）和合并到在途请求的跟随者（cache="COALESCED"）不是一次生成：
+    只计入请求数和耗时，不进 TTFT/token 速率统计，也不计 token（上游只为领头请求生成了一次）。
+    """
+    
+    def __init__(self, registry: ProxyMetrics, model: str, stream: str):
+        self.registry = registry
+        self.labels = (model, stream)
+        self.request_id = request_id_var.get()
+        self.started = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.events = 0
+        self.chunks: List[bytes] = []
+        self.prompt_messages: Optional[List[Dict[str, Any]]] = None
+        self.completion_text: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+        # 与响应头 X-Proxy-Cache 相同：OFF / BYPASS / MISS / HIT；合并的跟随者另记为 COALESCED
+        self.cache = "OFF"
+        self.finished = False
+        registry.in_flight.inc(self.labels)
+    
+    @property
+    def generated(self) -> bool:
+        """这次请求是否真的由上游生成（缓存命中和合并的跟随者都不是）"""
+        return self.cache not in ("HIT", "COALESCED")
+    
+    def first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            if self.generated:
+                self.registry.ttft.observe(self.labels[:1], self.first_token_at - self.started)
+    
+    def on_chunk(self, chunk: bytes):
+        self.first_token()
+        self.events += chunk.count(b"data:")
+        if self.generated:
+            self.chunks.append(chunk)
+        self.last_token_at = time.perf_counter()
+    
+    def set_usage(self, usage: Optional[Dict[str, Any]]):
+        if usage:
+            self.usage = usage
+    
+    def finish(self, status: str = "200", error: Optional[str] = None):
+        if self.finished:
+            return
+        self.finished = True
+        now = time.perf_counter()
+        model, stream = self.labels
+        self.registry.in_flight.dec(self.labels)
+        self.registry.requests.inc((model, stream, status))
+        self.registry.duration.observe(self.labels, now - self.started)
+        if error:
+            self.registry.errors.inc((model, error))
+        
+        if status != "200" and not self.events:
+            return
+        
+        if not self.generated:
+            usage_log.add({
+                "request_id": self.request_id,
+                "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "model": model,
+                "stream": stream,
+                "status": status,
+                "cache": self.cache.lower(),
+                "prompt_tokens": None,
+                "completion_tokens": None,
+                "usage_source": "cache" if self.cache == "HIT" else "coalesced",
+                "duration": round(now - self.started, 4),
+                "ttft": None,
+                "itl_mean": None,
+                "tokens_per_second": None,
+            })
+            return
+        
+        prompt_tokens, completion_tokens, source = self._token_counts()
+        generation = (self.last_token_at or now) - (self.first_token_at or self.started)
+        tokens_per_second = completion_tokens / generation if completion_tokens and generation > 0 else None
+        if tokens_per_second:
+            self.registry.tokens_per_second.observe(self.labels, tokens_per_second)
+        
+        itl_mean = None
+        if self.first_token_at is not None and self.last_token_at is not None and completion_tokens and completion_tokens > 1:
+            itl_mean = (self.last_token_at - self.first_token_at) / (completion_tokens - 1)
+        
+        usage_log.add({
+            "request_id": self.request_id,
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "model": model,
+            "stream": stream,
+            "status": status,
+            "cache": self.cache.lower(),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "usage_source": source,
+            "duration": round(now - self.started, 4),
+            "ttft": round(self.first_token_at - self.started, 4) if self.first_token_at else None,
+            "itl_mean": round(itl_mean, 5) if itl_mean else None,
+            "tokens_per_second": round(tokens_per_second, 2) if tokens_per_second else None,
+        })
+    
+    def _token_counts(self) -> Tuple[Optional[int], Optional[int], str]:
+        if self.usage:
+            return self.usage.get("prompt_tokens"), self.usage.get("completion_tokens"), "upstream"
+        prompt_tokens = count_message_tokens(self.prompt_messages) if self.prompt_messages else None
+        if self.completion_text is not None:
+            completion_tokens = count_tokens(self.completion_text)
+        else:
+            # 流式：SSE 事件数不等于 token 数（工具调用流会重新分块），按转发的 delta 文本计数
+            completion_tokens = count_tokens(sse_completion_text(self.chunks))
+        return prompt_tokens, completion_tokens, "local"
+
+
+def classify_error(error: BaseException) -> str:
+    """把异常归类为指标里的 error 标签"""
+    if isinstance(error, HTTPException):
+        return f"http_{error.status_code}"
+    if isinstance(error, httpx.TimeoutException):
+        return "upstream_timeout"
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"upstream_status_{error.response.status_code}"
+    if isinstance(error, httpx.TransportError):
+        return "upstream_connect"
+    if isinstance(error, httpx.HTTPError):
+        return "upstream_error"
+    return "internal"
+
+
+def render_component_metrics() -> List[str]:
+    """抓取时再读取缓存/合并/准入/后端池的计数，不在热路径上重复记录"""
+    lines = []
+    
+    def emit(name: str, kind: str, help_text: str, samples: List[Tuple[str, float]]):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{labels} {value:g}" for labels, value in samples)
+    
+    if response_cache is not None:
+        emit("proxy_cache_events_total", "counter", "Response cache events",
+             [(format_labels(("event",), (k,)), v) for k, v in response_cache.stats.items()])
+        emit("proxy_cache_entries", "gauge", "Response cache entries in memory",
+             [("", len(response_cache._entries))])
+    
+    if single_flight is not None:
+        emit("proxy_coalesced_requests_total", "counter", "Single-flight leaders and followers",
+             [(format_labels(("role",), (k,)), v) for k, v in single_flight.stats.items()])
+    
+    emit("proxy_embedding_events_total", "counter", "Embedding micro-batching events",
+         [(format_labels(("event",), (k,)), v) for k, v in embedding_batcher.stats.items()])
+    
+    if history_compactor is not None:
+        emit("proxy_history_compaction_total", "counter", "History compaction events",
+             [(format_labels(("event",), (k,)), v) for k, v in history_compactor.stats.items()])
+    
+    if admission is not None:
+        emit("proxy_admission_events_total", "counter", "Admission control events",
+             [(format_labels(("event",), (k,)), v) for k, v in admission.stats.items()])
+        emit("proxy_admission_queued", "gauge", "Requests waiting for admission",
+             [(format_labels(("lane",), (lane,)), len(q)) for lane, q in admission.lanes.items()])
+    
+    emit("proxy_backend_outstanding", "gauge", "In-flight requests per upstream backend",
+         [(format_labels(("backend",), (b.url,)), b.outstanding) for b in backend_pool.backends])
+    emit("proxy_backend_healthy", "gauge", "Whether the upstream backend passes health checks",
+         [(format_labels(("backend",), (b.url,)), int(b.available(time.time()))) for b in backend_pool.backends])
+    emit("proxy_backend_ewma_latency_seconds", "gauge", "Latency EWMA per upstream backend",
+         [(format_labels(("backend",), (b.url,)), b.ewma_latency) for b in backend_pool.backends])
+    return lines
+
+
+metrics = ProxyMetrics()
+
+
+USAGE_MARKERS = (b'"usage":{', b'"usage": {')
+
+
+def take_usage_events(chunk: bytes, rm: "RequestMetrics", strip: bool) -> bytes:
+    """从 SSE 块中取出 usage 事件；客户端没要 usage 时把 choices 为空的 usage 事件删掉"""
+    kept = []
+    for event in chunk.split(b"\n\n"):
+        if not event.strip():
+            continue
+        data = event.strip()[5:].strip() if event.strip().startswith(b"data:") else b""
+        if data and data != b"[DONE]" and any(marker in data for marker in USAGE_MARKERS):
+            try:
+                payload = json_loads(data)
+            except json.JSONDecodeError:
+                payload = {}
+            rm.set_usage(payload.get("usage"))
+            if strip and not payload.get("choices"):
+                continue
+        kept.append(event + b"\n\n")
+    return b"".join(kept)
+
+
+async def instrument_stream(
+    source: AsyncIterator[bytes],
+    rm: RequestMetrics,
+    client_wants_usage: bool = False
+) -> AsyncIterator[bytes]:
+    """流式响应：记录首块时间和 token 间隔，提取（必要时剥离）usage 事件，结束时收尾"""
+    status, error = "200", None
+    try:
+        async with aclosing(source):
+            async for chunk in source:
+                # 只有带 usage 对象的块才需要解析，其余字节原样转发
+                if any(marker in chunk for marker in USAGE_MARKERS):
+                    chunk = take_usage_events(chunk, rm, strip=not client_wants_usage)
+                    if not chunk:
+                        continue
+                rm.on_chunk(chunk)
+                yield chunk
+    except (GeneratorExit, asyncio.CancelledError):
+        status, error = "499", "client_disconnect"
+        raise
+    except Exception as e:
+        status, error = "502", classify_error(e)
+        raise
+    finally:
+        rm.finish(status, error)
+
+
+def rejects_stream_options(response: httpx.Response) -> bool:
+    """上游的 400/422 是否因为不认识 stream_options（而不是上下文超长、参数错误等普通错误）"""
+    if response.status_code not in (400, 422):
+        return False
+    try:
+        text = response.text
+    except httpx.ResponseNotRead:
+        return False
+    return "stream_options" in text or "include_usage" in text
+
+
+# 这些状态码说明节点暂时不可用，非流式请求可以换节点重试
+RETRYABLE_STATUS = {502, 503, 504}
+
+
+async def post_with_failover(client: httpx.AsyncClient, body: Dict[str, Any]) -> httpx.Response:
+    """非流式请求：选择后端发送，连接失败或 5xx 时换另一个后端重试"""
+    tried = set()
+    last_error: Optional[Exception] = None
+    
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        backend = backend_pool.pick(exclude=tried)
+        if backend is None:
+            break
+        tried.add(backend.url)
+        
+        started = backend.begin()
+        try:
+            response = await client.post(backend.url, content=json_dumps_bytes(body))
+            metrics.upstream_latency.observe((body.get("model"), "json"), time.perf_counter() - started)
+        except httpx.TransportError as e:
+            backend.end(started, ok=False)
+            last_error = e
+            log.warning("⚠️  后端请求失败 %s: %r", backend.url, e)
+            continue
+        
+        if response.status_code in RETRYABLE_STATUS and attempt < UPSTREAM_RETRIES:
+            backend.end(started, ok=False)
+            log.warning("⚠️  后端返回 %d，换节点重试: %s", response.status_code, backend.url)
+            continue
+        
+        backend.end(started, ok=response.status_code < 500)
+        return response
+    
+    raise last_error or httpx.ConnectError("No upstream backend available")
+
+
+async def stream_with_backend(upstream_stream, client: httpx.AsyncClient, body: Dict[str, Any]) -> AsyncIterator[bytes]:
+    """流式请求：选一个后端并在整个流期间计入它的在途请求数（流式不重试）"""
+    backend = backend_pool.pick()
+    if "stream_options" in body and not backend.stream_usage:
+        body = {k: v for k, v in body.items() if k != "stream_options"}
+    
+    started = backend.begin()
+    failed = False
+    first = True
+    try:
+        try:
+            async for chunk in upstream_stream(client, backend.url, body):
+                if first:
+                    first = False
+                    metrics.upstream_latency.observe((body.get("model"), "stream"), time.perf_counter() - started)
+                yield chunk
+        except httpx.HTTPStatusError as e:
+            # 上游不认识 stream_options：记住这个后端不支持，去掉后重发一次；其他 400 原样返回，不重发
+            if not (first and "stream_options" in body and rejects_stream_options(e.response)):
+                raise
+            log.warning("⚠️  后端不支持 stream_options，已关闭 usage 请求: %s", backend.url)
+            backend.stream_usage = False
+            body = {k: v for k, v in body.items() if k != "stream_options"}
+            async for chunk in upstream_stream(client, backend.url, body):
+                yield chunk
+    except httpx.HTTPError:
+        failed = True
+        raise
+    finally:
+        backend.end(started, ok=not failed, record_latency=False)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时建立连接池和后端健康检查，关闭时释放"""
+    app.state.upstream = create_upstream_client()
+    await shared_store.start()
+    health_task = None
+    if UPSTREAM_HEALTH_INTERVAL > 0:
+        # 先检查一轮再接请求：启动时就挂掉的后端不会在第一个间隔内被当成健康的
+        await backend_pool.check_all(app.state.upstream)
+        health_task = asyncio.create_task(backend_pool.health_check_loop(app.state.upstream))
+    metrics_task = asyncio.create_task(publish_metrics_loop()) if shared_store.shared else None
+    batch_manager.resume_all()
+    try:
+        yield
+    finally:
+        for task in (health_task, metrics_task):
+            if task is not None:
+                task.cancel()
+        # 未完成的批次保持 in_progress，下次启动时从断点继续（由先拿到锁的 worker 续跑）
+        await batch_manager.shutdown()
+        if shared_store.shared:
+            await shared_store.drop_metrics()
+        await shared_store.close()
+        await app.state.upstream.aclose()
+
+
+app = FastAPI(title="DeepSeek Tool Calling Proxy", lifespan=lifespan)
+
+
+def build_tool_prompt(tools: List[Dict[str, Any]], compact: Optional[bool] = None) -> str:
+    """构建工具调用的系统提示词（按 tools 内容记忆，相同工具列表只渲染一次）"""
+    if compact is None:
+        compact = TOOL_SCHEMA_COMPACT
+    tools_key = json_dumps_bytes(tools, sort_keys=True)
+    return _render_tool_prompt(tools_key, compact)
+
+
+@functools.lru_cache(maxsize=TOOL_PROMPT_CACHE_SIZE)
+def _render_tool_prompt(tools_key: bytes, compact: bool) -> str:
+    tools = json_loads(tools_key)
+    tool_descriptions = []
+    
+    for tool in tools:
+        func = tool["function"]
+        if compact:
+            parameters = json.dumps(func["parameters"], separators=(",", ":"), ensure_ascii=False)
+        else:
+            parameters = json.dumps(func["parameters"], indent=2)
+        tool_descriptions.append(
+            f"## {func['name']}\n"
+            f"Description: {func['description']}\n"
+            f"Parameters: {parameters}"
+        )
+    
+    tools_text = "\n\n".join(tool_descriptions)
+    
+    return f"""You are a helpful assistant with access to the following functions:
+
+{tools_text}
+
+CRITICAL WORKFLOW - FOLLOW EXACTLY:
+
+**FIRST TIME USER ASKS:**
+1. Output ONLY the XML function call:
+<function_call>
+{{"name": "function_name", "arguments": {{"param": "value"}}}}
+</function_call>
+
+**AFTER RECEIVING FUNCTION RESULT:**
+2. Respond in natural language with the result
+3. DO NOT output any XML
+4. DO NOT call the function again
+5. STOP after providing the result
+
+EXAMPLE - CORRECT BEHAVIOR:
+User: "call myecho with text HELLO"
+
+Your 1st response:
+<function_call>
+{{"name": "myecho", "arguments": {{"text": "HELLO"}}}}
+</function_call>
+
+System: Function myecho returned: <<ECHO: HELLO>>
+
+Your 2nd response:
+The function has been called and returned: <<ECHO: HELLO>>
+[STOP HERE - Do not call myecho again]
+
+REMEMBER: Call function ONCE, then provide natural language response."""
+
+
+class ToolSchemaError(ValueError):
+    """工具参数不符合 JSON schema"""
+    
+    def __init__(self, path: str, message: str):
+        super().__init__(f"{path}: {message}")
+
+
+JSON_TYPE_CHECKS = {
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "null": lambda v: v is None,
+}
+
+NO_COERCION = object()
+INTEGER_RE = re.compile(r"[-+]?\d+")
+NUMBER_RE = re.compile(r"[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+
+
+def coerce_value(value: Any, types: List[str]) -> Any:
+    """模型常把数字/布尔写成字符串（或反过来）：能无歧义转换时就地修正"""
+    if isinstance(value, str):
+        text = value.strip()
+        for t in types:
+            if t == "integer" and INTEGER_RE.fullmatch(text):
+                return int(text)
+            if t == "number" and NUMBER_RE.fullmatch(text):
+                return float(text) if any(c in text for c in ".eE") else int(text)
+            if t == "boolean" and text.lower() in ("true", "false"):
+                return text.lower() == "true"
+    elif isinstance(value, float) and "integer" in types and value.is_integer():
+        return int(value)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool) and "string" in types:
+        return json_dumps(value)
+    return NO_COERCION
+
+
+def compile_schema(schema: Any) -> Callable[[Any, str, Dict[str, int]], Any]:
+    """
+    把 JSON schema 编译成嵌套闭包，校验时不再解释 schema
+    
+    支持 type/enum/const/properties/required/additionalProperties/items/anyOf/oneOf/allOf
+    和常用的长度、数值范围约束；不认识的关键字（如 $ref、format）一律放行。
+    返回的函数 check(value, path, state) 返回（可能经过类型修正的）值，不符合时抛 ToolSchemaError。
+    """
+    if not isinstance(schema, dict):
+        return lambda value, path, state: value
+    
+    steps = []
+    types = schema.get("type")
+    types = [types] if isinstance(types, str) else list(types or [])
+    type_checks = [JSON_TYPE_CHECKS[t] for t in types if t in JSON_TYPE_CHECKS]
+    
+    if "enum" in schema:
+        allowed = schema["enum"]
+        
+        def check_enum(value, path, state):
+            if value not in allowed:
+                raise ToolSchemaError(path, f"{value!r} 不在 {allowed!r} 中")
+            return value
+        steps.append(check_enum)
+    
+    if "const" in schema:
+        expected = schema["const"]
+        
+        def check_const(value, path, state):
+            if value != expected:
+                raise ToolSchemaError(path, f"应为 {expected!r}")
+            return value
+        steps.append(check_const)
+    
+    if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+        properties = {name: compile_schema(sub) for name, sub in (schema.get("properties") or {}).items()}
+        required = tuple(schema.get("required") or ())
+        extra = schema.get("additionalProperties", True)
+        check_extra = compile_schema(extra) if isinstance(extra, dict) else None
+        
+        def check_object(value, path, state):
+            if not isinstance(value, dict):
+                return value
+            for name in required:
+                if name not in value:
+                    raise ToolSchemaError(path, f"缺少必需参数 {name!r}")
+            result = value
+            for key, item in value.items():
+                check = properties.get(key) or check_extra
+                if check is None:
+                    if extra is False:
+                        raise ToolSchemaError(path, f"不允许的参数 {key!r}")
+                    continue
+                checked = check(item, f"{path}.{key}", state)
+                if checked is not item:
+                    if result is value:
+                        result = dict(value)
+                    result[key] = checked
+            return result
+        steps.append(check_object)
+    
+    if "items" in schema or "minItems" in schema or "maxItems" in schema:
+        check_item = compile_schema(schema.get("items"))
+        min_items, max_items = schema.get("minItems"), schema.get("maxItems")
+        
+        def check_array(value, path, state):
+            if not isinstance(value, list):
+                return value
+            if min_items is not None and len(value) < min_items:
+                raise ToolSchemaError(path, f"至少需要 {min_items} 项")
+            if max_items is not None and len(value) > max_items:
+                raise ToolSchemaError(path, f"最多 {max_items} 项")
+            checked = [check_item(item, f"{path}[{i}]", state) for i, item in enumerate(value)]
+            return value if all(a is b for a, b in zip(checked, value)) else checked
+        steps.append(check_array)
+    
+    if any(k in schema for k in ("minLength", "maxLength", "pattern")):
+        min_length, max_length = schema.get("minLength"), schema.get("maxLength")
+        pattern = re.compile(schema["pattern"]) if "pattern" in schema else None
+        
+        def check_string(value, path, state):
+            if not isinstance(value, str):
+                return value
+            if min_length is not None and len(value) < min_length:
+                raise ToolSchemaError(path, f"长度至少 {min_length}")
+            if max_length is not None and len(value) > max_length:
+                raise ToolSchemaError(path, f"长度最多 {max_length}")
+            if pattern is not None and not pattern.search(value):
+                raise ToolSchemaError(path, f"不匹配 {pattern.pattern!r}")
+            return value
+        steps.append(check_string)
+    
+    bounds = [(k, schema[k]) for k in ("minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum")
+              if isinstance(schema.get(k), (int, float)) and not isinstance(schema.get(k), bool)]
+    if bounds:
+        compare = {
+            "minimum": lambda v, b: v >= b,
+            "maximum": lambda v, b: v <= b,
+            "exclusiveMinimum": lambda v, b: v > b,
+            "exclusiveMaximum": lambda v, b: v < b,
+        }
+        
+        def check_range(value, path, state):
+            if JSON_TYPE_CHECKS["number"](value):
+                for keyword, bound in bounds:
+                    if not compare[keyword](value, bound):
+                        raise ToolSchemaError(path, f"{value} 不满足 {keyword}={bound}")
+            return value
+        steps.append(check_range)
+    
+    for keyword in ("anyOf", "oneOf"):
+        if isinstance(schema.get(keyword), list):
+            options = [compile_schema(sub) for sub in schema[keyword]]
+            
+            def check_any(value, path, state, options=options, keyword=keyword):
+                for option in options:
+                    trial = dict(state)
+                    try:
+                        value = option(value, path, trial)
+                    except ToolSchemaError:
+                        continue
+                    state.update(trial)
+                    return value
+                raise ToolSchemaError(path, f"不符合 {keyword} 中任何一个 schema")
+            steps.append(check_any)
+    
+    if isinstance(schema.get("allOf"), list):
+        parts = [compile_schema(sub) for sub in schema["allOf"]]
+        
+        def check_all(value, path, state):
+            for part in parts:
+                value = part(value, path, state)
+            return value
+        steps.append(check_all)
+    
+    def check(value, path, state):
+        if type_checks and not any(type_check(value) for type_check in type_checks):
+            coerced = coerce_value(value, types)
+            if coerced is NO_COERCION:
+                raise ToolSchemaError(path, f"应为 {'/'.join(types)}，实际是 {type(value).__name__}")
+            value = coerced
+            state["coerced"] = state.get("coerced", 0) + 1
+        for step in steps:
+            value = step(value, path, state)
+        return value
+    
+    return check
+
+
+def tool_validators(tools: Optional[List[Dict[str, Any]]]) -> Optional[Dict[str, Callable]]:
+    """按工具名取参数校验器；同一工具列表只编译一次"""
+    if not tools or TOOL_CALL_VALIDATION == "off":
+        return None
+    return _compile_tool_validators(json_dumps_bytes(tools, sort_keys=True))
+
+
+@functools.lru_cache(maxsize=TOOL_PROMPT_CACHE_SIZE)
+def _compile_tool_validators(tools_key: bytes) -> Dict[str, Callable]:
+    validators = {}
+    for tool in json_loads(tools_key):
+        func = tool.get("function") if isinstance(tool, dict) else None
+        if isinstance(func, dict) and func.get("name"):
+            validators[func["name"]] = compile_schema(func.get("parameters") or {})
+    return validators
+
+
+FUNCTION_CALL_OPEN = "<function_call>"
+FUNCTION_CALL_CLOSE = "</function_call>"
+
+
+def make_tool_call(call_data: Dict[str, Any], raw: str, idx: int) -> Dict[str, Any]:
+    """
+    把模型输出的 {"name", "arguments"} 转成 OpenAI tool_call 结构
+    
+    arguments 是客户端直接看到的字符串，保持 json.dumps 的默认格式（带空格、非 ASCII 转义），不走快速 JSON 层。
+    """
+    return {
+        "id": f"call_{abs(hash(raw)) % 100000}_{idx}",
+        "type": "function",
+        "function": {
+            "name": call_data["name"],
+            "arguments": json.dumps(call_data["arguments"])
+        }
+    }
+
+
+JSON_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def repair_json(raw: str) -> str:
+    """
+    一遍扫描修复模型常见的 JSON 错误：
+    单引号字符串、字符串里未转义的换行/控制字符、尾随逗号、
+    Python 的 True/False/None、没加引号的键，以及被截断时缺少的引号和括号
+    """
+    out: List[str] = []
+    closers: List[str] = []
+    quote = None
+    pending_comma = False
+    i, n = 0, len(raw)
+    while i < n:
+        ch = raw[i]
+        if quote:
+            if ch == "\\" and i + 1 < n:
+                nxt = raw[i + 1]
+                out.append("'" if quote == "'" and nxt == "'" else ch + nxt)
+                i += 2
+                continue
+            if ch == quote:
+                out.append('"')
+                quote = None
+            elif ch == '"':
+                out.append('\\"')
+            elif ch < " ":
+                out.append(JSON_CONTROL_ESCAPES.get(ch) or f"\\u{ord(ch):04x}")
+            else:
+                out.append(ch)
+            i += 1
+            continue
+        
+        if ch in " \t\r\n":
+            out.append(ch)
+            i += 1
+            continue
+        if pending_comma:
+            # 逗号后面紧跟 } 或 ] 就是尾随逗号，丢掉
+            pending_comma = False
+            if ch not in "}]":
+                out.append(",")
+        
+        if ch in "\"'":
+            quote = ch
+            out.append('"')
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            if closers:
+                closers.pop()
+            out.append(ch)
+        elif ch == ",":
+            pending_comma = True
+        elif ch.isalpha() or ch == "_":
+            j = i
+            while j < n and (raw[j].isalnum() or raw[j] == "_"):
+                j += 1
+            word = raw[i:j]
+            rest = raw[j:j + 32].lstrip()
+            if rest.startswith(":"):
+                out.append(f'"{word}"')
+            else:
+                out.append(PYTHON_LITERALS.get(word, word))
+            i = j
+            continue
+        else:
+            out.append(ch)
+        i += 1
+    
+    if quote:
+        out.append('"')
+    out.extend(reversed(closers))
+    return "".join(out)
+
+
+def parse_json_lenient(raw: str) -> Tuple[Any, bool]:
+    """先按严格 JSON 解析，失败再修复后解析；返回 (数据, 是否经过修复)，都失败时抛 JSONDecodeError"""
+    try:
+        return json_loads(raw), False
+    except json.JSONDecodeError:
+        return json_loads(repair_json(raw)), True
+
+
+# JSON 扫描只需要停在这些字符上，其余字符用正则整段跳过
+JSON_SCAN_RE = re.compile(r"[{}\"'\\<]")
+
+
+def extract_xml_tool_calls(
+    content: str,
+    tools: Optional[List[Dict[str, Any]]] = None
+) -> Optional[List[Dict[str, Any]]]:
+    """从完整响应中提取 XML 格式的工具调用（与流式共用同一个单遍扫描器）"""
+    return split_xml_tool_calls(content, tools)[1]
+
+
+def split_xml_tool_calls(
+    content: str,
+    tools: Optional[List[Dict[str, Any]]] = None
+) -> Tuple[str, Optional[List[Dict[str, Any]]]]:
+    """
+    返回 (文本, 工具调用)：文本与流式路径发给客户端的 content 完全相同
+    （第一个调用之前的文字保留，调用块和之后的文字去掉）；没有工具调用时文本就是原文
+    """
+    if not content or FUNCTION_CALL_OPEN not in content:
+        return content, None
+    parser = StreamingToolCallParser(tools)
+    events = parser.feed(content) + parser.finish()
+    if not parser.tool_calls:
+        return content, None
+    return "".join(value for kind, value in events if kind == "text"), parser.tool_calls
+
+
+class StreamingToolCallParser:
+    """
+    增量解析流式输出中的 <function_call> 块
+    
+    状态机：
+    - text: 普通文本直接透传，只保留可能是 "<function_call>" 前缀的尾巴
+    - json: 已看到开始标签，按括号深度（忽略单/双引号字符串内的括号）扫描 JSON 对象，
+            对象一闭合就产出工具调用
+    - close: 等待并丢弃 "</function_call>" 结束标签；先遇到下一个开始标签时视为缺少结束标签
+    
+    解析失败的 JSON 会先经过 repair_json 修复；传入 tools 时按各工具的参数 schema 校验
+    （校验器按工具列表编译并缓存）。
+    feed() / finish() 返回 (kind, value) 列表，kind 为 "text" 或 "tool_call"。
+    """
+    
+    def __init__(self, tools: Optional[List[Dict[str, Any]]] = None):
+        self.state = "text"
+        self.buffer = ""
+        self.tool_calls: List[Dict[str, Any]] = []
+        self.validators = tool_validators(tools)
+        # JSON 扫描状态
+        self._depth = 0
+        self._quote: Optional[str] = None
+        self._scan_pos = 0
+    
+    def feed(self, text: str) -> List[tuple]:
+        self.buffer += text
+        events = []
+        
+        while True:
+            if self.state == "text":
+                start = self.buffer.find(FUNCTION_CALL_OPEN)
+                if start >= 0:
+                    if start and not self.tool_calls:
+                        events.append(("text", self.buffer[:start]))
+                    self.buffer = self.buffer[start + len(FUNCTION_CALL_OPEN):]
+                    self._start_json()
+                    continue
+                
+                keep = self._partial_tag_length(self.buffer, FUNCTION_CALL_OPEN)
+                emit = self.buffer[:len(self.buffer) - keep]
+                # 工具调用之后的文本与非流式路径一致：不再返回给客户端
+                if emit and not self.tool_calls:
+                    events.append(("text", emit))
+                self.buffer = self.buffer[len(self.buffer) - keep:]
+                return events
+            
+            if self.state == "json":
+                if self._scan_pos == 0 and self._depth == 0:
+                    # 快速路径：整个块已经到齐且是合法 JSON（最常见的情况），不必逐字符扫描
+                    close = self.buffer.find(FUNCTION_CALL_CLOSE)
+                    if close >= 0:
+                        raw = self.buffer[:close].strip()
+                        try:
+                            call_data = json_loads(raw) if raw.startswith("{") else None
+                        except json.JSONDecodeError:
+                            call_data = None
+                        if call_data is not None:
+                            self.buffer = self.buffer[close + len(FUNCTION_CALL_CLOSE):]
+                            self.state = "text"
+                            tool_call = self._build_call(call_data, raw, repaired=False)
+                            if tool_call:
+                                events.append(("tool_call", tool_call))
+                            continue
+                end = self._scan_json()
+                if end < 0:
+                    return events
+                raw = self.buffer[:end].strip()
+                self.buffer = self.buffer[end:]
+                self.state = "close"
+                tool_call = self._parse_call(raw)
+                if tool_call:
+                    events.append(("tool_call", tool_call))
+                continue
+            
+            if self.state == "close":
+                end = self.buffer.find(FUNCTION_CALL_CLOSE)
+                start = self.buffer.find(FUNCTION_CALL_OPEN)
+                if start >= 0 and (end < 0 or start < end):
+                    # 模型漏了结束标签，直接开始了下一个调用
+                    self.state = "text"
+                    continue
+                if end < 0:
+                    return events
+                self.buffer = self.buffer[end + len(FUNCTION_CALL_CLOSE):]
+                self.state = "text"
+    
+    def finish(self) -> List[tuple]:
+        """上游结束时调用：未闭合的调用尝试修复，修不好的按普通文本返回"""
+        events = []
+        if self.state == "text" and self.buffer and not self.tool_calls:
+            events.append(("text", self.buffer))
+        elif self.state == "json" and self.buffer:
+            # 被截断或缺少右括号：截到结束标签（如果有）为止补全后再解析
+            end = self.buffer.find(FUNCTION_CALL_CLOSE)
+            raw = self.buffer[:end if end >= 0 else len(self.buffer)].strip()
+            tool_call = self._parse_call(raw) if raw.startswith("{") else None
+            if tool_call:
+                events.append(("tool_call", tool_call))
+            else:
+                log.warning("⚠️  流式工具调用未闭合，按文本返回: %s", self.buffer[:100])
+                if not self.tool_calls:
+                    events.append(("text", FUNCTION_CALL_OPEN + self.buffer))
+        self.buffer = ""
+        return events
+    
+    def _start_json(self):
+        self.state = "json"
+        self._depth = 0
+        self._quote = None
+        self._scan_pos = 0
+    
+    def _scan_json(self) -> int:
+        """继续扫描 buffer，返回 JSON 对象结束位置（未结束返回 -1）"""
+        buf = self.buffer
+        pos = self._scan_pos
+        while True:
+            match = JSON_SCAN_RE.search(buf, pos)
+            if match is None:
+                self._scan_pos = len(buf)
+                return -1
+            i = match.start()
+            ch = buf[i]
+            pos = i + 1
+            if self._quote:
+                if ch == "\\":
+                    if i + 1 == len(buf):
+                        # 转义符在块末尾：等下一块到了再看它转义的是什么
+                        self._scan_pos = i
+                        return -1
+                    pos = i + 2
+                elif ch == self._quote:
+                    self._quote = None
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    return i + 1
+            elif ch == "<":
+                if self._depth == 0:
+                    # 还没遇到 "{" 就碰到标签，说明块内没有 JSON
+                    self._scan_pos = 0
+                    return i
+                tail = buf[i:i + len(FUNCTION_CALL_CLOSE)]
+                if tail.startswith(FUNCTION_CALL_OPEN) or tail == FUNCTION_CALL_CLOSE:
+                    # 对象没闭合就遇到了标签：模型漏了右括号，截到这里交给 repair_json 补全
+                    self._scan_pos = 0
+                    return i
+                if i + len(tail) == len(buf) and (
+                    FUNCTION_CALL_CLOSE.startswith(tail) or FUNCTION_CALL_OPEN.startswith(tail)
+                ):
+                    # 可能是被切开的标签：等下一块到了再判断
+                    self._scan_pos = i
+                    return -1
+            elif ch in "\"'" and self._depth:
+                self._quote = ch
+    
+    def _parse_call(self, raw: str) -> Optional[Dict[str, Any]]:
+        try:
+            call_data, repaired = parse_json_lenient(raw)
+        except json.JSONDecodeError as e:
+            metrics.tool_parse.inc(("failed",))
+            log.warning("❌ JSON 解析失败: %s 原始: %s", e, raw)
+            return None
+        return self._build_call(call_data, raw, repaired)
+    
+    def _build_call(self, call_data: Any, raw: str, repaired: bool) -> Optional[Dict[str, Any]]:
+        if isinstance(call_data, dict) and "arguments" not in call_data and "parameters" in call_data:
+            call_data["arguments"] = call_data.pop("parameters")
+        if not isinstance(call_data, dict) or "name" not in call_data or "arguments" not in call_data:
+            metrics.tool_parse.inc(("failed",))
+            log.warning("⚠️  工具调用缺少必需字段: %s", call_data)
+            return None
+        
+        arguments = call_data["arguments"]
+        if isinstance(arguments, str):
+            # 有的模型把 arguments 写成 JSON 字符串
+            try:
+                parsed, _ = parse_json_lenient(arguments)
+                if isinstance(parsed, dict):
+                    arguments = parsed
+            except json.JSONDecodeError:
+                pass
+        
+        outcome = "repaired" if repaired else "ok"
+        if self.validators is not None:
+            validator = self.validators.get(call_data["name"])
+            state: Dict[str, int] = {}
+            try:
+                if validator is None:
+                    raise ToolSchemaError(call_data["name"], "未声明的工具")
+                arguments = validator(arguments, "arguments", state)
+                if state:
+                    outcome = "coerced"
+            except ToolSchemaError as e:
+                metrics.tool_parse.inc(("invalid",))
+                log.warning("⚠️  工具调用不符合 schema: %s", e)
+                if TOOL_CALL_VALIDATION == "strict":
+                    return None
+                outcome = None
+        if outcome:
+            metrics.tool_parse.inc((outcome,))
+        if repaired:
+            log.info("🩹 已修复工具调用 JSON: %s", raw[:100])
+        
+        tool_call = make_tool_call({"name": call_data["name"], "arguments": arguments}, raw, len(self.tool_calls))
+        self.tool_calls.append(tool_call)
+        return tool_call
+    
+    @staticmethod
+    def _partial_tag_length(text: str, tag: str) -> int:
+        """text 末尾与 tag 前缀重合的最大长度"""
+        for n in range(min(len(text), len(tag) - 1), 0, -1):
+            if text.endswith(tag[:n]):
+                return n
+        return 0
+
+
+def render_xml_tool_call(tool_call: Dict[str, Any]) -> str:
+    """
+    把 OpenAI tool_call 渲染回 <function_call> XML
+    
+    这是按 name/arguments 重新生成的规范形式，不是模型当时的原文（空白、键顺序、引号都可能不同），
+    所以不保证与上一轮的输出逐字节相同；保证的是同一个 tool_call 每次渲染结果都一样。
+    """
+    func = tool_call.get("function", {})
+    arguments = func.get("arguments", "{}")
+    try:
+        arguments = json_loads(arguments) if isinstance(arguments, str) else arguments
+    except json.JSONDecodeError:
+        pass
+    call = json.dumps({"name": func.get("name"), "arguments": arguments}, ensure_ascii=False)
+    return f"{FUNCTION_CALL_OPEN}\n{call}\n{FUNCTION_CALL_CLOSE}"
+
+
+def filter_messages_for_deepseek(
+    messages: List[Dict[str, Any]],
+    stable_prefix: Optional[bool] = None
+) -> List[Dict[str, Any]]:
+    """
+    过滤和转换消息，使其适合 DeepSeek 模型
+    
+    stable_prefix=True 时（默认取 PREFIX_STABLE_LAYOUT）：
+    - 所有消息只保留 role/content，去掉客户端附带的其他字段
+    - 空 content 的 assistant 工具调用消息不再丢弃，而是用 render_xml_tool_call 渲染成固定的 XML。
+      渲染结果不是模型原文，调用之前的文本也只有客户端把它作为 content 发回来时才会保留，
+      因此第 N+1 轮的前缀与第 N 轮的"提示词 + 输出"并不逐字节相同；
+      但之后每一轮的前缀都与上一轮请求的提示词一致（第 N+1 轮起前缀缓存可以命中）
+    - tool 消息缺少 name 时按 tool_call_id 从前面的 assistant 消息中找回函数名
+    """
+    if stable_prefix is None:
+        stable_prefix = PREFIX_STABLE_LAYOUT
+    
+    filtered = []
+    tool_names: Dict[str, str] = {}
+    
+    for msg in messages:
+        role = msg.get("role")
+        
+        if role == "system":
+            filtered.append(
+                {"role": "system", "content": msg.get("content", "")} if stable_prefix else msg
+            )
+        
+        elif role == "user":
+            filtered.append(
+                {"role": "user", "content": msg.get("content", "")} if stable_prefix else msg
+            )
+        
+        elif role == "assistant":
+            content = msg.get("content", "")
+            tool_calls = msg.get("tool_calls")
+            
+            if stable_prefix and tool_calls:
+                for tc in tool_calls:
+                    tool_names[tc.get("id")] = tc.get("function", {}).get("name")
+                xml_calls = "\n".join(render_xml_tool_call(tc) for tc in tool_calls)
+                content = f"{content}{xml_calls}" if content else xml_calls
+            
+            elif tool_calls and not content:
+                log.debug("⚠️  跳过空的 assistant 工具调用消息")
+                continue
+            
+            filtered.append({
+                "role": "assistant",
+                "content": content
+            })
+        
+        elif role == "tool":
+            tool_name = msg.get("name") or (
+                tool_names.get(msg.get("tool_call_id")) if stable_prefix else None
+            ) or "unknown"
+            tool_content = msg.get("content", "")
+            
+            filtered.append({
+                "role": "user",
+                "content": f"Function {tool_name} returned: {tool_content}"
+            })
+            log.debug("🔄 转换 tool 消息为 user 消息: %s", tool_name)
+    
+    return filtered
+
+
+def inject_tool_prompt(
+    messages: List[Dict[str, Any]],
+    tools: List[Dict[str, Any]],
+    stable_prefix: Optional[bool] = None
+) -> List[Dict[str, Any]]:
+    """
+    把工具调用提示词注入系统消息
+    
+    默认行为：用工具提示词替换第一条 system 消息（没有则插到最前面）。
+    stable_prefix=True 时：工具按函数名排序，工具提示词固定放在最前面，
+    客户端原有的 system 文本追加在工具块之后，保证同一工具集合的前缀逐字节相同。
+    """
+    if stable_prefix is None:
+        stable_prefix = PREFIX_STABLE_LAYOUT
+    
+    if stable_prefix:
+        tools = sorted(tools, key=lambda t: t.get("function", {}).get("name", ""))
+    tool_prompt = build_tool_prompt(tools)
+    
+    for i, msg in enumerate(messages):
+        if msg.get("role") == "system":
+            if stable_prefix:
+                client_system = msg.get("content") or ""
+                rest = messages[:i] + messages[i + 1:]
+                content = f"{tool_prompt}\n\n{client_system}" if client_system else tool_prompt
+                return [{"role": "system", "content": content}] + rest
+            
+            messages[i] = {
+                "role": "system",
+                "content": tool_prompt
+            }
+            return messages
+    
+    messages.insert(0, {
+        "role": "system",
+        "content": tool_prompt
+    })
+    return messages
+
+
+def should_use_streaming(messages: List[Dict[str, Any]], tools: Optional[List]) -> bool:
+    """
+    判断是否应该使用流式响应
+    
+    规则：
+    1. 如果没有工具定义 → 可以流式
+    2. 如果有工具，但历史消息中已有 tool role → 不需要流式（这是第二轮回复）
+    3. 如果有工具，且是首次请求 → 通过 StreamingToolCallParser 增量解析 XML 后流式；
+       STREAM_TOOL_CALLS=0 时回退为非流式
+    """
+    # 没有工具定义，直接流式
+    if not tools:
+        return True
+    
+    # 检查消息中是否有 tool role
+    has_tool_result = any(msg.get("role") == "tool" for msg in messages)
+    
+    # 如果有工具结果，说明这是第二轮回复，可以流式
+    if has_tool_result:
+        log.debug("ℹ️  检测到工具结果，第二轮回复可以使用流式")
+        return True
+    
+    if STREAM_TOOL_CALLS:
+        log.debug("ℹ️  首次工具调用请求，使用增量解析流式")
+        return True
+    
+    # 否则，这是首次工具调用请求，必须非流式
+    log.debug("ℹ️  首次工具调用请求，使用非流式")
+    return False
+
+
+async def stream_response(
+    client: httpx.AsyncClient,
+    url: str,
+    body: Dict[str, Any]
+) -> AsyncIterator[bytes]:
+    """
+    流式转发响应
+    
+    不解码也不重新编码：要求上游不压缩，直接转发原始字节，并按 SSE 事件边界（空行）切分，
+    保证下游、缓存和合并流拿到的都是完整事件。块恰好落在边界上时原样转发，不做拷贝。
+    """
+    headers = {"Accept-Encoding": "identity"}
+    async with client.stream("POST", url, content=json_dumps_bytes(body), headers=headers) as response:
+        if response.is_error:
+            # 读出错误体（通常很短），流关闭后上层仍能查看错误原因
+            await response.aread()
+        response.raise_for_status()
+        pending = b""
+        async for chunk in response.aiter_raw():
+            if pending:
+                chunk = pending + chunk
+                pending = b""
+            cut = chunk.rfind(b"\n\n")
+            if cut < 0:
+                pending = chunk
+                continue
+            cut += 2
+            if cut == len(chunk):
+                yield chunk
+            else:
+                yield chunk[:cut]
+                pending = chunk[cut:]
+        if pending:
+            yield pending
+
+
+async def relay_with_buffer(source: AsyncIterator[bytes], maxsize: int) -> AsyncIterator[bytes]:
+    """
+    在独立任务中读取上游，通过有界队列交给客户端
+    
+    客户端读得慢时最多缓冲 maxsize 块，满了就暂停读取上游；
+    客户端断开（生成器被关闭）时立即取消读取任务并等它退出，然后关闭 source，从而关闭上游连接、停止生成。
+    """
+    buffer: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+    done = object()
+    
+    async def produce():
+        try:
+            async for chunk in source:
+                await buffer.put(chunk)
+            await buffer.put(done)
+        except Exception as e:
+            await buffer.put(e)
+    
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        if not producer.done():
+            producer.cancel()
+            log.info("🔌 客户端已断开，取消上游流")
+        # 等读取任务真正退出，再显式关闭上游生成器（关闭 client.stream 连接），不留给垃圾回收
+        # （gather 吞掉读取任务自己的 CancelledError，外层任务被取消时仍照常抛出）
+        await asyncio.gather(producer, return_exceptions=True)
+        await source.aclose()
+
+
+class RelayStreamingResponse(StreamingResponse):
+    """
+    响应结束后（包括客户端断开导致的取消）立即关闭 body_iterator
+    
+    StreamingResponse 本身不会关闭迭代器，生成器要等到被垃圾回收才执行 finally，
+    期间上游会继续生成到 max_tokens。
+    """
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                with anyio.CancelScope(shield=True):
+                    await aclose()
+
+
+def canonical_request_hash(body: Dict[str, Any], tools: Optional[List] = None) -> str:
+    """对发往上游的请求体做规范化哈希（缓存与合并请求共用的 key）"""
+    canonical = json_dumps_bytes({"body": body, "tools": tools or []}, sort_keys=True)
+    return hashlib.sha256(canonical).hexdigest()
+
+
+class LocalStore:
+    """
+    进程内的共享状态存储（单 worker 的默认实现）
+    
+    多 worker 时换成 SQLiteStore / RedisStore，接口相同：
+      get/set           响应缓存的二级层（值为 bytes，带 TTL）
+      take_tokens       限速令牌桶，返回需要等待的秒数（amount 为负数时退还，不超过桶容量）
+      publish_metrics   每个 worker 发布自己的指标文本，collect_metrics 汇总各 worker 的最新一份
+    """
+    
+    shared = False
+    
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.buckets: Dict[str, "TokenBucket"] = {}
+    
+    async def start(self):
+        # 在 worker 进程里调用：fork/spawn 之后再建立连接
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    
+    async def close(self):
+        pass
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        return None
+    
+    async def set(self, key: str, value: bytes, ttl: float):
+        pass
+    
+    async def take_tokens(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, capacity)
+        return bucket.take(amount)
+    
+    async def publish_metrics(self, text: str):
+        pass
+    
+    async def collect_metrics(self) -> List[str]:
+        return []
+    
+    async def drop_metrics(self):
+        pass
+    
+    def describe(self) -> str:
+        return "local"
+
+
+class SQLiteStore(LocalStore):
+    """
+    本机多 worker 共享的 SQLite 文件（WAL 模式），不需要额外服务；
+    路径放在 /dev/shm 下就是共享内存。令牌桶用 BEGIN IMMEDIATE 串行化读改写。
+    """
+    
+    shared = True
+    CLEANUP_EVERY = 256
+    
+    def __init__(self, path: str, max_rows: int = 100000):
+        super().__init__()
+        self.path = path
+        self.max_rows = max_rows
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._writes = 0
+    
+    async def start(self):
+        await super().start()
+        await asyncio.to_thread(self._connect)
+    
+    async def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
+    
+    def _connect(self):
+        with self._lock:
+            self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, expires_at REAL, value BLOB)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS worker_metrics (worker TEXT PRIMARY KEY, updated REAL, body TEXT)")
+    
+    def _run(self, fn, *args):
+        with self._lock:
+            return fn(self._db, *args)
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        def query(db, key, now):
+            row = db.execute("SELECT value FROM kv WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            return row[0] if row is not None else None
+        return await asyncio.to_thread(self._run, query, key, time.time())
+    
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._writes += 1
+        cleanup = self._writes % self.CLEANUP_EVERY == 0
+        
+        def store(db, key, value, expires_at):
+            db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, expires_at, value))
+            if cleanup:
+                db.execute("DELETE FROM kv WHERE expires_at <= ?", (time.time(),))
+                db.execute(
+                    "DELETE FROM kv WHERE key IN ("
+                    "SELECT key FROM kv ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,)
+                )
+        await asyncio.to_thread(self._run, store, key, value, time.time() + ttl)
+    
+    async def take_tokens(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        def take(db, key, amount):
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                amount = min(amount, capacity)
+                wait = 0.0
+                if tokens >= amount:
+                    tokens = min(capacity, tokens - amount)
+                else:
+                    wait = (amount - tokens) / rate
+                db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, now))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            return wait
+        return await asyncio.to_thread(self._run, take, key, amount)
+    
+    async def publish_metrics(self, text: str):
+        await asyncio.to_thread(
+            self._run,
+            lambda db: db.execute(
+                "INSERT OR REPLACE INTO worker_metrics VALUES (?, ?, ?)", (self.worker_id, time.time(), text)
+            )
+        )
+    
+    async def collect_metrics(self) -> List[str]:
+        rows = await asyncio.to_thread(
+            self._run,
+            lambda db: db.execute(
+                "SELECT body FROM worker_metrics WHERE updated > ?", (time.time() - SHARED_METRICS_TTL,)
+            ).fetchall()
+        )
+        return [row[0] for row in rows]
+    
+    async def drop_metrics(self):
+        await asyncio.to_thread(
+            self._run, lambda db: db.execute("DELETE FROM worker_metrics WHERE worker = ?", (self.worker_id,))
+        )
+    
+    def describe(self) -> str:
+        return f"sqlite:///{self.path}"
+
+
+class RedisStore(LocalStore):
+    """Redis 或协议兼容的服务（KeyDB、Dragonfly 等）；令牌桶用 Lua 脚本在服务端原子执行"""
+    
+    shared = True
+    
+    TAKE_TOKENS_SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local amount = math.min(tonumber(ARGV[3]), capacity)
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= amount then
+        tokens = math.min(capacity, tokens - amount)
+    else
+        wait = (amount - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+    return tostring(wait)
+    """
+    
+    def __init__(self, url: str, prefix: str = "proxy:"):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self._redis = None
+        self._take_tokens = None
+    
+    async def start(self):
+        await super().start()
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("SHARED_STORE_URL 指向 Redis，但没有安装 redis 包：pip install redis")
+        self._redis = redis_asyncio.from_url(self.url)
+        self._take_tokens = self._redis.register_script(self.TAKE_TOKENS_SCRIPT)
+    
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._redis.get(self.prefix + key)
+    
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self._redis.set(self.prefix + key, value, px=max(1, int(ttl * 1000)))
+    
+    async def take_tokens(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        wait = await self._take_tokens(keys=[self.prefix + key], args=[rate, capacity, amount])
+        return float(wait)
+    
+    async def publish_metrics(self, text: str):
+        await self._redis.hset(
+            self.prefix + "metrics", self.worker_id, json_dumps_bytes({"updated": time.time(), "body": text})
+        )
+    
+    async def collect_metrics(self) -> List[str]:
+        entries = await self._redis.hgetall(self.prefix + "metrics")
+        cutoff = time.time() - SHARED_METRICS_TTL
+        bodies, stale = [], []
+        for worker, raw in entries.items():
+            entry = json_loads(raw)
+            if entry["updated"] > cutoff:
+                bodies.append(entry["body"])
+            else:
+                stale.append(worker)
+        if stale:
+            await self._redis.hdel(self.prefix + "metrics", *stale)
+        return bodies
+    
+    async def drop_metrics(self):
+        await self._redis.hdel(self.prefix + "metrics", self.worker_id)
+    
+    def describe(self) -> str:
+        return re.sub(r"//[^@/]*@", "//***@", self.url)
+
+
+def create_shared_store(url: str) -> LocalStore:
+    if not url:
+        return LocalStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):], RESPONSE_CACHE_SQLITE_MAX_ROWS)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(url)
+    raise ValueError(f"不支持的 SHARED_STORE_URL: {url}")
+
+
+shared_store = create_shared_store(SHARED_STORE_URL)
+
+
+# 合并各 worker 指标时不能相加的 gauge：取最大值
+MAX_MERGED_GAUGES = ("proxy_backend_healthy", "proxy_backend_ewma_latency_seconds")
+
+
+def merge_metrics_texts(texts: List[str]) -> str:
+    """
+    把多个 worker 的 Prometheus 文本合并成一份：同名同标签的样本相加
+    （计数器、直方图桶、在途请求数等），MAX_MERGED_GAUGES 里的取最大值
+    """
+    families: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split(" ", 3)[2]
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = {"name": name, "help": line, "type": "", "samples": {}}
+            elif line.startswith("# TYPE "):
+                family["type"] = line
+            elif line and family is not None:
+                series, _, raw = line.rpartition(" ")
+                value = float(raw)
+                samples = family["samples"]
+                if series not in samples:
+                    samples[series] = value
+                elif family["name"] in MAX_MERGED_GAUGES:
+                    samples[series] = max(samples[series], value)
+                else:
+                    samples[series] += value
+    
+    lines = [
+        "# HELP proxy_workers Worker processes included in this scrape",
+        "# TYPE proxy_workers gauge",
+        f"proxy_workers {len(texts)}",
+    ]
+    for family in families.values():
+        lines.append(family["help"])
+        lines.append(family["type"])
+        lines.extend(
+            f"{series} {int(value) if value.is_integer() else repr(value)}"
+            for series, value in family["samples"].items()
+        )
+    return "\n".join(lines) + "\n"
+
+
+async def publish_metrics_loop():
+    """定期发布本 worker 的指标，这样无论哪个 worker 接到抓取都能看到全体"""
+    while True:
+        try:
+            await shared_store.publish_metrics(metrics.render())
+        except Exception as e:
+            log.warning("⚠️  发布指标到共享存储失败: %r", e)
+        await asyncio.sleep(SHARED_METRICS_INTERVAL)
+
+
+class ResponseCache:
+    """
+    精确匹配的响应缓存：内存 LRU + 可选 SQLite 磁盘层
+    
+    条目为 (kind, payload)：kind="json" 是完整的非流式响应体，
+    kind="sse" 是完整的 SSE 字节流，命中时按事件回放。
+    多 worker 时传入共享存储作为二级层，一个 worker 写入的响应其他 worker 也能命中。
+    """
+    
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int,
+        max_bytes: int,
+        sqlite_path: Optional[str] = None,
+        sqlite_max_rows: int = 100000,
+        store: Optional[LocalStore] = None
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sqlite_max_rows = sqlite_max_rows
+        self.store = store if store is not None and store.shared else None
+        self._entries: "OrderedDict[str, Tuple[float, str, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.stats = {
+            "hits": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "bypass": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expired": 0,
+        }
+        
+        self._db = None
+        self._db_lock = threading.Lock()
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, expires_at REAL, kind TEXT, payload BLOB)"
+            )
+            self._db.commit()
+    
+    async def get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, kind, payload = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                return kind, payload
+            self._remove(key)
+            self.stats["expired"] += 1
+        
+        if self._db is not None:
+            row = await asyncio.to_thread(self._db_get, key, now)
+            if row is not None:
+                expires_at, kind, payload = row
+                self._put_memory(key, expires_at, kind, payload)
+                self.stats["hits"] += 1
+                self.stats["disk_hits"] += 1
+                return kind, payload
+        
+        if self.store is not None:
+            value = await self.store.get("cache:" + key)
+            if value is not None:
+                kind, _, payload = value.partition(b"\n")
+                kind = kind.decode()
+                self._put_memory(key, now + self.ttl, kind, payload)
+                self.stats["hits"] += 1
+                self.stats["shared_hits"] += 1
+                return kind, payload
+        
+        self.stats["misses"] += 1
+        return None
+    
+    async def set(self, key: str, kind: str, payload: bytes):
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, expires_at, kind, payload)
+        self.stats["stores"] += 1
+        if self._db is not None:
+            await asyncio.to_thread(self._db_set, key, expires_at, kind, payload)
+        if self.store is not None:
+            await self.store.set("cache:" + key, kind.encode() + b"\n" + payload, self.ttl)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "disk": self._db is not None,
+            "shared": self.store.describe() if self.store is not None else None,
+        }
+    
+    def _put_memory(self, key: str, expires_at: float, kind: str, payload: bytes):
+        if len(payload) > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (expires_at, kind, payload)
+        self._bytes += len(payload)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+    
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[2])
+    
+    def _db_get(self, key: str, now: float) -> Optional[Tuple[float, str, bytes]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT expires_at, kind, payload FROM response_cache WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is not None and row[0] <= now:
+                self._db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+        return row
+    
+    def _db_set(self, key: str, expires_at: float, kind: str, payload: bytes):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, expires_at, kind, payload)
+            )
+            self._db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+            self._db.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (self.sqlite_max_rows,)
+            )
+            self._db.commit()
+
+
+response_cache = ResponseCache(
+    ttl=RESPONSE_CACHE_TTL,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    sqlite_path=RESPONSE_CACHE_SQLITE,
+    sqlite_max_rows=RESPONSE_CACHE_SQLITE_MAX_ROWS,
+    store=shared_store
+) if RESPONSE_CACHE else None
+
+
+def is_cacheable(body: Dict[str, Any]) -> bool:
+    """只有确定性（低温度）请求才进入缓存"""
+    temperature = body.get("temperature")
+    return temperature is not None and temperature <= RESPONSE_CACHE_MAX_TEMPERATURE
+
+
+class StreamFanout:
+    """把一个上游流广播给多个订阅者；后加入的订阅者先补发已有的块"""
+    
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Future] = None
+        self._event = asyncio.Event()
+    
+    def publish(self, chunk: bytes):
+        self.chunks.append(chunk)
+        self._wake()
+    
+    def close(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._wake()
+    
+    async def subscribe(self) -> AsyncIterator[bytes]:
+        self.subscribers += 1
+        try:
+            i = 0
+            while True:
+                if i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._event.wait()
+        finally:
+            self.subscribers -= 1
+            # 所有订阅者都断开后取消上游，不再为没人看的流继续生成
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self.task.cancel()
+    
+    def _wake(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+
+class SingleFlight:
+    """
+    相同 key 的在途请求只向上游发一次
+    
+    领头请求在独立的 task 中执行，跟随者共享结果；
+    某个客户端断开不会取消其他人正在等待的上游调用。
+    do() 和 stream() 同时返回调用方是否为领头请求，跟随者不应再按一次上游生成计量。
+    """
+    
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, StreamFanout] = {}
+        self.stats = {"leaders": 0, "followers": 0}
+    
+    async def do(self, key: str, fn) -> Tuple[Any, bool]:
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            self.stats["leaders"] += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.stats["followers"] += 1
+            log.info("🔗 合并到在途请求 %s", key[:12])
+        return await asyncio.shield(task), leader
+    
+    def stream(self, key: str, factory) -> Tuple[AsyncIterator[bytes], bool]:
+        fanout = self._streams.get(key)
+        leader = fanout is None
+        if leader:
+            self.stats["leaders"] += 1
+            fanout = StreamFanout()
+            self._streams[key] = fanout
+            fanout.task = asyncio.ensure_future(self._pump(key, fanout, factory()))
+        else:
+            self.stats["followers"] += 1
+            log.info("🔗 合并到在途流式请求 %s", key[:12])
+        return fanout.subscribe(), leader
+    
+    async def _pump(self, key: str, fanout: StreamFanout, source: AsyncIterator[bytes]):
+        error = None
+        try:
+            async for chunk in source:
+                fanout.publish(chunk)
+        except Exception as e:
+            log.error("❌ 合并流上游错误: %r", e)
+            error = e
+        finally:
+            self._streams.pop(key, None)
+            fanout.close(error)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "in_flight": len(self._calls) + len(self._streams)
+        }
+
+
+single_flight = SingleFlight() if REQUEST_COALESCING else None
+
+
+def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    """粗略估算消息的 token 数（约 4 字符 1 token，每条消息额外 4 token）"""
+    chars = sum(len(str(msg.get("content") or "")) for msg in messages)
+    return chars // 4 + 4 * len(messages)
+
+
+class AdmissionRejected(Exception):
+    """请求被准入控制拒绝，对应 HTTP 429"""
+    
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class TokenBucket:
+    """按估算 token 数限速的令牌桶"""
+    
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def take(self, amount: float) -> float:
+        """扣除 amount，成功返回 0，否则返回需要等待的秒数；amount 为负数时退还"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # 单个请求超过桶容量时按容量计，避免永远无法通过
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens = min(self.capacity, self.tokens - amount)
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class AdmissionTicket:
+    """一次已准入的请求，release() 可重复调用"""
+    
+    def __init__(self, controller: "AdmissionController", key: str, model: str):
+        self.controller = controller
+        self.key = key
+        self.model = model
+        self.released = False
+    
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    有界的异步准入队列
+    
+    - 全局、每个 API key、每个模型分别限制并发（多 worker 时是每个 worker 的上限）
+    - 交互（流式）请求走优先通道，批量（非流式）请求在其后
+    - 队列满、排队超时或 token 桶不足时抛出 AdmissionRejected
+    """
+    
+    LANES = ("interactive", "batch")
+    
+    def __init__(self):
+        self.active = 0
+        self.active_by_key: Counter = Counter()
+        self.active_by_model: Counter = Counter()
+        self.lanes = {lane: deque() for lane in self.LANES}
+        self.stats = {"admitted": 0, "enqueued": 0, "rejected": 0, "timeouts": 0, "rate_limited": 0}
+    
+    async def acquire(self, key: str, model: str, interactive: bool, tokens: int) -> AdmissionTicket:
+        lane = "interactive" if interactive else "batch"
+        # 先看队列：注定被拒的请求不扣限速 token
+        if not self._admits_now(key, model, lane) and self.queued() >= ADMISSION_QUEUE_SIZE:
+            self.stats["rejected"] += 1
+            raise AdmissionRejected("admission queue full", 1)
+        
+        if RATE_LIMIT_TOKENS_PER_MINUTE > 0:
+            # 令牌桶放在共享存储里，多 worker 时同一个 key 的限额是全局的
+            wait = await self._take_tokens(key, tokens)
+            if wait > 0:
+                self.stats["rate_limited"] += 1
+                raise AdmissionRejected("token rate limit exceeded", wait)
+        
+        ticket = AdmissionTicket(self, key, model)
+        
+        if self._admits_now(key, model, lane):
+            self._grant(ticket)
+            return ticket
+        
+        if self.queued() >= ADMISSION_QUEUE_SIZE:
+            # 扣 token 期间队列被其他请求占满：没有访问上游，把 token 退回去
+            self.stats["rejected"] += 1
+            await self._refund_tokens(key, tokens)
+            raise AdmissionRejected("admission queue full", 1)
+        
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (ticket, waiter)
+        self.lanes[lane].append(entry)
+        self.stats["enqueued"] += 1
+        try:
+            await asyncio.wait_for(waiter, ADMISSION_QUEUE_TIMEOUT)
+        except BaseException as e:
+            if entry in self.lanes[lane]:
+                self.lanes[lane].remove(entry)
+            elif waiter.done() and not waiter.cancelled():
+                # 超时/取消与放行同时发生：名额已分配，归还给下一个等待者
+                ticket.release()
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["timeouts"] += 1
+                await self._refund_tokens(key, tokens)
+                raise AdmissionRejected("timed out waiting in admission queue", 1)
+            raise
+        
+        return ticket
+    
+    async def _take_tokens(self, key: str, tokens: float) -> float:
+        return await shared_store.take_tokens(
+            "ratelimit:" + key, tokens, RATE_LIMIT_TOKENS_PER_MINUTE / 60.0, RATE_LIMIT_BURST_TOKENS
+        )
+    
+    async def _refund_tokens(self, key: str, tokens: float):
+        if RATE_LIMIT_TOKENS_PER_MINUTE > 0:
+            # 扣的时候按桶容量封顶，退的时候也一样
+            await self._take_tokens(key, -min(tokens, RATE_LIMIT_BURST_TOKENS))
+    
+    def queued(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "active": self.active,
+            "queued": {lane: len(q) for lane, q in self.lanes.items()},
+            "active_by_model": dict(self.active_by_model),
+            "keys": len(self.active_by_key),
+        }
+    
+    def _fits(self, key: str, model: str) -> bool:
+        if self.active >= ADMISSION_MAX_CONCURRENCY:
+            return False
+        if ADMISSION_PER_KEY_CONCURRENCY and self.active_by_key[key] >= ADMISSION_PER_KEY_CONCURRENCY:
+            return False
+        if ADMISSION_PER_MODEL_CONCURRENCY and self.active_by_model[model] >= ADMISSION_PER_MODEL_CONCURRENCY:
+            return False
+        return True
+    
+    def _admits_now(self, key: str, model: str, lane: str) -> bool:
+        return self._fits(key, model) and not self._has_waiters(lane)
+    
+    def _has_waiters(self, lane: str) -> bool:
+        # 优先通道只需要看自己；批量请求还要让交互请求先走
+        lanes = self.LANES[:self.LANES.index(lane) + 1]
+        return any(self.lanes[name] for name in lanes)
+    
+    def _grant(self, ticket: AdmissionTicket):
+        self.active += 1
+        self.active_by_key[ticket.key] += 1
+        self.active_by_model[ticket.model] += 1
+        self.stats["admitted"] += 1
+    
+    def _release(self, ticket: AdmissionTicket):
+        self.active -= 1
+        self.active_by_key[ticket.key] -= 1
+        if self.active_by_key[ticket.key] <= 0:
+            del self.active_by_key[ticket.key]
+        self.active_by_model[ticket.model] -= 1
+        if self.active_by_model[ticket.model] <= 0:
+            del self.active_by_model[ticket.model]
+        self._dispatch()
+    
+    def _dispatch(self):
+        """按通道优先级唤醒能放行的等待者（被 per-key/per-model 上限卡住的会被跳过）"""
+        for lane in self.LANES:
+            queue = self.lanes[lane]
+            for entry in list(queue):
+                if self.active >= ADMISSION_MAX_CONCURRENCY:
+                    return
+                ticket, waiter = entry
+                if waiter.done():
+                    queue.remove(entry)
+                    continue
+                if self._fits(ticket.key, ticket.model):
+                    queue.remove(entry)
+                    self._grant(ticket)
+                    waiter.set_result(True)
 
-# 远程 DeepSeek API 配置
-DEEPSEEK_API_URL = os.getenv(
-    "DEEPSEEK_API_URL", 
-    "http://10.248.60.236:5000/v1/chat/completions"
-)
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_OPENAI_API_KEY")
 
-# 启动时验证配置
-if not DEEPSEEK_API_KEY:
-    raise ValueError(
-        "❌ 环境变量 DEEPSEEK_OPENAI_API_KEY 未设置！\n"
-        "请运行: export DEEPSEEK_OPENAI_API_KEY='your-api-key'"
-    )
+admission = AdmissionController() if ADMISSION_CONTROL else None
 
 
-def build_tool_prompt(tools: List[Dict[str, Any]]) -> str:
-    """构建工具调用的系统提示词"""
-    tool_descriptions = []
+class HistoryCompactor:
+    """
+    对话历史压缩：开头的 system 消息和最近的轮次原样保留，超出预算的较早轮次换成一条摘要。
     
-    for tool in tools:
-        func = tool["function"]
-        tool_descriptions.append(
-            f"## {func['name']}\n"
-            f"Description: {func['description']}\n"
-            f"Parameters: {json.dumps(func['parameters'], indent=2)}"
-        )
+    摘要按"对话前缀"的链式哈希缓存：客户端每轮都会重发完整历史，同一段前缀只总结一次；
+    前缀变长时从缓存里最长的已总结前缀出发，只把新增的几条并进旧摘要（滚动摘要）。
+    """
     
-    tools_text = "\n\n".join(tool_descriptions)
+    SUMMARY_PROMPT = (
+        "请把下面这段对话压缩成一份简洁的摘要，保留用户的目标、已确认的事实、做出的决定、"
+        "工具调用的关键结果和尚未解决的问题，省略寒暄和重复内容。只输出摘要正文。"
+    )
     
-    return f"""You are a helpful assistant with access to the following functions:
+    def __init__(self, budget: int, keep_recent: int, summary_max_tokens: int, cache_size: int):
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self.summary_max_tokens = summary_max_tokens
+        self.cache_size = cache_size
+        self.summaries: OrderedDict = OrderedDict()  # 前缀哈希 -> 摘要
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {"checked": 0, "compacted": 0, "summaries": 0, "summary_hits": 0, "truncated": 0}
+    
+    @staticmethod
+    def prefix_hashes(messages: List[Dict[str, Any]]) -> List[str]:
+        """hashes[i] 是前 i 条消息的链式哈希（hashes[0] 为空前缀）"""
+        hashes = [""]
+        for msg in messages:
+            digest = hashlib.sha256(hashes[-1].encode())
+            digest.update(json_dumps_bytes(msg, sort_keys=True))
+            hashes.append(digest.hexdigest())
+        return hashes
+    
+    async def compact(self, client: httpx.AsyncClient, messages: List[Dict[str, Any]], model: str) -> List[Dict[str, Any]]:
+        self.stats["checked"] += 1
+        costs = [count_tokens(str(msg.get("content") or "")) + 4 for msg in messages]
+        if sum(costs) <= self.budget:
+            return messages
+        
+        head = 0
+        while head < len(messages) and messages[head].get("role") == "system":
+            head += 1
+        system, turns, turn_costs = messages[:head], messages[head:], costs[head:]
+        limit = self.budget - sum(costs[:head]) - self.summary_max_tokens
+        suffix_costs = [0] * (len(turns) + 1)
+        for i in range(len(turns) - 1, -1, -1):
+            suffix_costs[i] = suffix_costs[i + 1] + turn_costs[i]
+        hashes = self.prefix_hashes(turns)
+        # 至少保留最新的一条（keep_recent=0 时也不能把当前问题本身总结掉）
+        latest_cut = len(turns) - max(self.keep_recent, 1)
+        
+        # 优先沿用已有摘要的切分点：最近部分还放得下就不重新总结，前缀也保持不变
+        cut = next((j for j in range(1, latest_cut + 1)
+                    if hashes[j] in self.summaries and suffix_costs[j] <= limit), None)
+        if cut is None:
+            # 重新切分时只保留半个预算的最近消息，留出余量，后面几轮可以继续复用这份摘要
+            cut = len(turns)
+            while cut > 0 and (cut > latest_cut or suffix_costs[cut - 1] <= limit // 2):
+                cut -= 1
+            # 保留部分从 user 消息开始，不把一问一答拆开
+            aligned = next((j for j in range(cut, latest_cut + 1) if turns[j].get("role") == "user"), None)
+            if aligned is None:
+                aligned = next((j for j in range(cut, 0, -1) if turns[j].get("role") == "user"), cut)
+            cut = aligned
+        if cut == 0:
+            return messages
+        
+        self.stats["compacted"] += 1
+        older, recent = turns[:cut], turns[cut:]
+        try:
+            summary = await self.summarize(client, older, hashes[:cut + 1], model)
+        except Exception as e:
+            # 摘要失败时退化为直接丢弃较早的轮次，请求本身不受影响
+            self.stats["truncated"] += 1
+            log.warning("⚠️  历史摘要失败，直接截断 %d 条较早消息: %r", len(older), e)
+            return system + recent
+        
+        log.info("🗜️  历史压缩: %d 条较早消息 -> 摘要, 保留最近 %d 条", len(older), len(recent))
+        return system + [{"role": "system", "content": f"以下是之前对话的摘要：\n{summary}"}] + recent
+    
+    async def summarize(
+        self,
+        client: httpx.AsyncClient,
+        older: List[Dict[str, Any]],
+        hashes: List[str],
+        model: str
+    ) -> str:
+        key = hashes[-1]
+        if key in self.summaries:
+            self.summaries.move_to_end(key)
+            self.stats["summary_hits"] += 1
+            return self.summaries[key]
+        
+        # 并发的同一对话共享一次摘要调用
+        task = self.inflight.get(key)
+        if task is None:
+            start = next((i for i in range(len(older) - 1, 0, -1) if hashes[i] in self.summaries), 0)
+            previous = self.summaries.get(hashes[start]) if start else None
+            task = self.inflight[key] = asyncio.create_task(
+                self._generate(client, previous, older[start:], model)
+            )
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        summary = await asyncio.shield(task)
+        
+        self.summaries[key] = summary
+        while len(self.summaries) > self.cache_size:
+            self.summaries.popitem(last=False)
+        return summary
+    
+    async def _generate(
+        self,
+        client: httpx.AsyncClient,
+        previous: Optional[str],
+        messages: List[Dict[str, Any]],
+        model: str
+    ) -> str:
+        self.stats["summaries"] += 1
+        transcript = "\n".join(f"[{msg.get('role')}] {msg.get('content') or ''}" for msg in messages)
+        if previous:
+            transcript = f"[之前的摘要] {previous}\n{transcript}"
+        response = await post_with_failover(client, {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": self.SUMMARY_PROMPT},
+                {"role": "user", "content": transcript}
+            ],
+            "temperature": 0.3,
+            "max_tokens": self.summary_max_tokens,
+            "stream": False
+        })
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"].strip()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "cached_summaries": len(self.summaries), "budget": self.budget}
 
-{tools_text}
 
-CRITICAL WORKFLOW - FOLLOW EXACTLY:
+history_compactor = HistoryCompactor(
+    HISTORY_TOKEN_BUDGET,
+    HISTORY_KEEP_RECENT,
+    HISTORY_SUMMARY_MAX_TOKENS,
+    HISTORY_SUMMARY_CACHE_SIZE
+) if HISTORY_COMPACTION else None
 
-**FIRST TIME USER ASKS:**
-1. Output ONLY the XML function call:
-<function_call>
-{{"name": "function_name", "arguments": {{"param": "value"}}}}
-</function_call>
 
-**AFTER RECEIVING FUNCTION RESULT:**
-2. Respond in natural language with the result
-3. DO NOT output any XML
-4. DO NOT call the function again
-5. STOP after providing the result
+def client_key(request: Request) -> str:
+    """按 API key 区分调用方；没有 key 时退化为客户端地址"""
+    auth = request.headers.get("authorization", "")
+    if auth.lower().startswith("bearer "):
+        return auth[7:].strip()
+    return request.client.host if request.client else "anonymous"
 
-EXAMPLE - CORRECT BEHAVIOR:
-User: "call myecho with text HELLO"
 
-Your 1st response:
-<function_call>
-{{"name": "myecho", "arguments": {{"text": "HELLO"}}}}
-</function_call>
+async def release_after(source: AsyncIterator[bytes], ticket: AdmissionTicket) -> AsyncIterator[bytes]:
+    """流式响应结束（包括客户端断开）时释放准入名额"""
+    try:
+        async with aclosing(source):
+            async for chunk in source:
+                yield chunk
+    finally:
+        ticket.release()
 
-System: Function myecho returned: <<ECHO: HELLO>>
 
-Your 2nd response:
-The function has been called and returned: <<ECHO: HELLO>>
-[STOP HERE - Do not call myecho again]
+async def replay_sse(payload: bytes) -> AsyncIterator[bytes]:
+    """把缓存的 SSE 字节流按事件逐条回放"""
+    for event in payload.split(b"\n\n"):
+        if event.strip():
+            yield event + b"\n\n"
 
-REMEMBER: Call function ONCE, then provide natural language response."""
 
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
 
-def extract_xml_tool_calls(content: str) -> Optional[List[Dict[str, Any]]]:
-    """从响应中提取 XML 格式的工具调用"""
-    if not content or "<function_call>" not in content:
-        return None
+
+def sse_event(data: Dict[str, Any]) -> bytes:
+    """编码一条 SSE data 事件"""
+    return b"data: " + json_dumps_bytes(data) + b"\n\n"
+
+
+async def stream_tool_call_response(
+    client: httpx.AsyncClient,
+    url: str,
+    body: Dict[str, Any],
+    tools: Optional[List[Dict[str, Any]]] = None
+) -> AsyncIterator[bytes]:
+    """
+    流式转发，并把 <function_call> 块即时转换为 OpenAI tool_calls delta
     
-    pattern = r'<function_call>\s*(\{.*?\})\s*</function_call>'
-    matches = re.findall(pattern, content, re.DOTALL)
+    普通文本立即透传；工具调用在 JSON 闭合时作为一个完整的 tool_calls delta 发出。
+    """
+    parser = StreamingToolCallParser(tools)
+    template: Dict[str, Any] = {}
+    finish_reason = None
+    usage = None
     
-    if not matches:
-        return None
+    def chunk(delta: Dict[str, Any], finish: Optional[str] = None) -> bytes:
+        return sse_event({
+            "id": template.get("id", "chatcmpl-proxy"),
+            "object": "chat.completion.chunk",
+            "created": template.get("created", int(datetime.utcnow().timestamp())),
+            "model": template.get("model", body.get("model")),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]
+        })
     
-    tool_calls = []
-    for idx, match in enumerate(matches):
-        try:
-            call_data = json.loads(match)
+    def render(events: List[tuple]) -> List[bytes]:
+        out = []
+        for kind, value in events:
+            if kind == "text":
+                out.append(chunk({"content": value}))
+            else:
+                out.append(chunk({"tool_calls": [{
+                    "index": len(parser.tool_calls) - 1,
+                    **value
+                }]}))
+        return out
+    
+    async with client.stream("POST", url, content=json_dumps_bytes(body)) as response:
+        if response.is_error:
+            await response.aread()
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                event = json_loads(data)
+            except json.JSONDecodeError:
+                continue
             
-            if "name" not in call_data or "arguments" not in call_data:
-                print(f"⚠️  工具调用缺少必需字段: {call_data}")
+            if event.get("usage"):
+                usage = event["usage"]
+            if not event.get("choices"):
                 continue
             
-            tool_calls.append({
-                "id": f"call_{abs(hash(match)) % 100000}_{idx}",
-                "type": "function",
-                "function": {
-                    "name": call_data["name"],
-                    "arguments": json.dumps(call_data["arguments"])
-                }
-            })
+            if not template:
+                template = {k: event.get(k) for k in ("id", "created", "model")}
+                yield chunk({"role": "assistant", "content": ""})
             
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON 解析失败: {e}\n   原始: {match}")
-            continue
+            for choice in event.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    for out in render(parser.feed(content)):
+                        yield out
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+    
+    for out in render(parser.finish()):
+        yield out
     
-    return tool_calls if tool_calls else None
+    metrics.record_tool_extraction(body.get("model"), len(parser.tool_calls))
+    if parser.tool_calls:
+        log.info("✅ 流式提取到 %d 个工具调用", len(parser.tool_calls))
+        finish_reason = "tool_calls"
+    
+    yield chunk({}, finish_reason or "stop")
+    if usage:
+        yield sse_event({
+            "id": template.get("id", "chatcmpl-proxy"),
+            "object": "chat.completion.chunk",
+            "created": template.get("created", int(datetime.utcnow().timestamp())),
+            "model": template.get("model", body.get("model")),
+            "choices": [],
+            "usage": usage
+        })
+    yield b"data: [DONE]\n\n"
 
 
-def filter_messages_for_deepseek(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """过滤和转换消息，使其适合 DeepSeek 模型"""
-    filtered = []
+class BatchManager:
+    """
+    JSONL 批量任务：每行一个 chat 请求，以有限并发回环调用本代理的 /v1/chat/completions，
+    因此工具调用、响应缓存、准入控制（batch 通道）和指标都与单个请求一致。
     
-    for msg in messages:
-        role = msg.get("role")
+    BATCH_DIR/<batch_id>/ 下：
+      input.jsonl   规范化后的请求（custom_id + body）
+      output.jsonl  每完成一条追加一行；重启后跳过其中已有的 custom_id
+      batch.json    批次状态与计数
+      lock          执行中的 worker 持有它的 flock，多 worker 时每个批次只有一个执行者
+      cancel        其他 worker 收到取消请求时留下的标记，执行者在下一条前停止
+    
+    每个批次记录提交者 key 的摘要（owner），查询、取消和读取结果只对同一个 key 可见，其他人得到 404。
+    """
+    
+    ACTIVE = ("in_progress",)
+    
+    def __init__(self, root: str, concurrency: int):
+        self.root = root
+        self.concurrency = concurrency
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.changed: Dict[str, asyncio.Event] = {}
+        self.locks: Dict[str, Any] = {}
+    
+    def _path(self, batch_id: str, name: str) -> str:
+        return os.path.join(self.root, batch_id, name)
+    
+    @staticmethod
+    def owner_hash(key: str) -> str:
+        # 只落盘调用方 key 的摘要：重启续跑时仍按同一个调用方做准入限额
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+    
+    def _append(self, batch_id: str, line: str):
+        """在线程里执行：每次单独打开追加，取消时不会和正在关闭的文件句柄冲突"""
+        with open(self._path(batch_id, "output.jsonl"), "a", encoding="utf-8") as f:
+            f.write(line)
+    
+    def _save(self, meta: Dict[str, Any]):
+        path = self._path(meta["id"], "batch.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    
+    def _notify(self, batch_id: str):
+        event = self.changed.pop(batch_id, None)
+        if event is not None:
+            event.set()
+    
+    def _claim(self, batch_id: str) -> bool:
+        """拿到批次的执行锁；已被其他 worker（或本进程）持有时返回 False"""
+        if fcntl is None:
+            return batch_id not in self.tasks
+        handle = open(self._path(batch_id, "lock"), "a")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            handle.close()
+            return False
+        self.locks[batch_id] = handle
+        return True
+    
+    def _unclaim(self, batch_id: str):
+        self.tasks.pop(batch_id, None)
+        handle = self.locks.pop(batch_id, None)
+        if handle is not None:
+            handle.close()
+    
+    def is_running(self, batch_id: str) -> bool:
+        """批次是否正在某个 worker 上执行（进程退出时 flock 自动释放）"""
+        if batch_id in self.tasks or fcntl is None:
+            return batch_id in self.tasks
+        with open(self._path(batch_id, "lock"), "a") as handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        return False
+    
+    def get(self, batch_id: str, owner: Optional[str] = None) -> Dict[str, Any]:
+        """owner 为调用方的 key 时只返回它自己的批次，别人的批次与不存在一样返回 404"""
+        # 本 worker 在执行的批次以内存为准，其余的每次读盘（可能由其他 worker 在更新）
+        if batch_id not in self.tasks:
+            if not re.fullmatch(r"batch_[0-9a-f]+", batch_id) or not os.path.exists(self._path(batch_id, "batch.json")):
+                raise HTTPException(status_code=404, detail=f"批次不存在: {batch_id}")
+            with open(self._path(batch_id, "batch.json"), encoding="utf-8") as f:
+                self.batches[batch_id] = json.load(f)
+        meta = self.batches[batch_id]
+        if owner is not None and meta["owner"] != self.owner_hash(owner):
+            raise HTTPException(status_code=404, detail=f"批次不存在: {batch_id}")
+        return meta
+    
+    def list_all(self, owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        if not os.path.isdir(self.root):
+            return []
+        ids = [name for name in os.listdir(self.root) if os.path.exists(self._path(name, "batch.json"))]
+        batches = (self.get(batch_id) for batch_id in ids)
+        if owner is not None:
+            owner_hash = self.owner_hash(owner)
+            batches = (meta for meta in batches if meta["owner"] == owner_hash)
+        return sorted(batches, key=lambda m: m["created_at"], reverse=True)
+    
+    def create(self, payload: bytes, owner: str) -> Dict[str, Any]:
+        requests, seen = [], set()
+        for lineno, line in enumerate(payload.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise HTTPException(status_code=400, detail=f"第 {lineno} 行不是合法 JSON: {e}")
+            if not isinstance(item, dict):
+                raise HTTPException(status_code=400, detail=f"第 {lineno} 行必须是 JSON 对象")
+            # 兼容 OpenAI 批量格式 {"custom_id", "method", "url", "body"} 和直接的 chat 请求体
+            body = item["body"] if isinstance(item.get("body"), dict) else {k: v for k, v in item.items() if k != "custom_id"}
+            custom_id = str(item.get("custom_id") or f"request-{lineno}")
+            if not isinstance(body.get("messages"), list):
+                raise HTTPException(status_code=400, detail=f"第 {lineno} 行缺少 messages")
+            if custom_id in seen:
+                raise HTTPException(status_code=400, detail=f"第 {lineno} 行 custom_id 重复: {custom_id}")
+            seen.add(custom_id)
+            requests.append({"custom_id": custom_id, "body": body})
         
-        if role == "system":
-            filtered.append(msg)
+        if not requests:
+            raise HTTPException(status_code=400, detail="批次为空")
+        if len(requests) > BATCH_MAX_REQUESTS:
+            raise HTTPException(status_code=400, detail=f"单个批次最多 {BATCH_MAX_REQUESTS} 条请求")
         
-        elif role == "user":
-            filtered.append(msg)
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        os.makedirs(os.path.join(self.root, batch_id))
+        with open(self._path(batch_id, "input.jsonl"), "w", encoding="utf-8") as f:
+            for item in requests:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        open(self._path(batch_id, "output.jsonl"), "w").close()
         
-        elif role == "assistant":
-            content = msg.get("content", "")
-            
-            if msg.get("tool_calls") and not content:
-                print(f"   ⚠️  跳过空的 assistant 工具调用消息")
-                continue
-            
-            filtered.append({
-                "role": "assistant",
-                "content": content
-            })
+        meta = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "status": "in_progress",
+            "owner": self.owner_hash(owner),
+            "created_at": int(time.time()),
+            "completed_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": len(requests), "completed": 0, "failed": 0}
+        }
+        self.batches[batch_id] = meta
+        self._save(meta)
+        self.start(batch_id)
+        return meta
+    
+    def start(self, batch_id: str) -> bool:
+        if not self._claim(batch_id):
+            return False
+        self.tasks[batch_id] = asyncio.create_task(self.run(batch_id))
+        self.tasks[batch_id].add_done_callback(lambda _: self._unclaim(batch_id))
+        return True
+    
+    def resume_all(self):
+        for meta in self.list_all():
+            if meta["status"] in self.ACTIVE and self.start(meta["id"]):
+                log.info("🔁 续跑批次 %s (%d/%d 已完成)", meta["id"],
+                         meta["request_counts"]["completed"] + meta["request_counts"]["failed"],
+                         meta["request_counts"]["total"])
+    
+    async def shutdown(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def cancel(self, batch_id: str, owner: Optional[str] = None) -> Dict[str, Any]:
+        meta = self.get(batch_id, owner)
+        if meta["status"] in self.ACTIVE:
+            meta["status"] = "cancelled"
+            meta["cancelled_at"] = int(time.time())
+            self._save(meta)
+            task = self.tasks.get(batch_id)
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            else:
+                open(self._path(batch_id, "cancel"), "w").close()
+            self._notify(batch_id)
+        return meta
+    
+    async def run(self, batch_id: str):
+        meta = self.get(batch_id)
+        # 进度以 output.jsonl 为准：batch.json 可能落后于崩溃前的最后几条；
+        # 崩溃时最后一行可能只写了一半，截掉后这一条会重跑
+        done = set()
+        counts = meta["request_counts"]
+        counts["completed"] = counts["failed"] = 0
+        with open(self._path(batch_id, "output.jsonl"), "rb+") as f:
+            data = f.read()
+            f.truncate(data.rfind(b"\n") + 1)
+        for line in data.splitlines()[:data.count(b"\n")]:
+            result = json.loads(line)
+            done.add(result["custom_id"])
+            counts["failed" if result["error"] else "completed"] += 1
         
-        elif role == "tool":
-            tool_name = msg.get("name", "unknown")
-            tool_content = msg.get("content", "")
-            
-            filtered.append({
-                "role": "user",
-                "content": f"Function {tool_name} returned: {tool_content}"
-            })
-            print(f"   🔄 转换 tool 消息为 user 消息: {tool_name}")
+        def pending():
+            with open(self._path(batch_id, "input.jsonl"), encoding="utf-8") as f:
+                for line in f:
+                    item = json.loads(line)
+                    if item["custom_id"] not in done:
+                        yield item
+        
+        items = pending()
+        cancel_marker = self._path(batch_id, "cancel")
+        headers = {"Authorization": f"Bearer batch-{meta['owner']}", "X-Batch-ID": batch_id}
+        transport = httpx.ASGITransport(app=app)
+        started = time.perf_counter()
+        
+        # 结果追加放到线程里并串行化；batch.json 按时间间隔合并写，不再每条都重写
+        write_lock = asyncio.Lock()
+        last_saved = time.monotonic()
+        
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://batch", timeout=None, headers=headers) as client:
+                async def worker():
+                    nonlocal last_saved
+                    for item in items:
+                        if os.path.exists(cancel_marker):
+                            return
+                        result = await self.execute(client, item)
+                        line = json.dumps(result, ensure_ascii=False) + "\n"
+                        async with write_lock:
+                            await asyncio.to_thread(self._append, batch_id, line)
+                        counts["failed" if result["error"] else "completed"] += 1
+                        if time.monotonic() - last_saved >= BATCH_META_SAVE_INTERVAL:
+                            last_saved = time.monotonic()
+                            self._save(meta)
+                        self._notify(batch_id)
+                
+                await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        except Exception:
+            log.exception("❌ 批次 %s 执行失败", batch_id)
+            meta["status"] = "failed"
+            self._save(meta)
+            self._notify(batch_id)
+            return
+        
+        if os.path.exists(cancel_marker):
+            # 其他 worker 转来的取消：停在当前位置，已完成的结果保留
+            meta["status"] = "cancelled"
+            meta["cancelled_at"] = int(time.time())
+            self._save(meta)
+            self._notify(batch_id)
+            log.info("🛑 批次已取消 %s", batch_id)
+            return
+        
+        meta["status"] = "completed"
+        meta["completed_at"] = int(time.time())
+        self._save(meta)
+        self._notify(batch_id)
+        log.info("📦 批次完成 %s: %d 成功 / %d 失败, %.1fs", batch_id,
+                 counts["completed"], counts["failed"], time.perf_counter() - started)
     
-    return filtered
+    async def execute(self, client: httpx.AsyncClient, item: Dict[str, Any]) -> Dict[str, Any]:
+        body = {**item["body"], "stream": False}
+        result = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": item["custom_id"], "response": None, "error": None}
+        try:
+            for attempt in range(BATCH_MAX_RETRIES + 1):
+                response = await client.post("/v1/chat/completions", json=body)
+                if response.status_code != 429 or attempt == BATCH_MAX_RETRIES:
+                    break
+                # 被准入控制挡回：按 Retry-After 退避后重试
+                await asyncio.sleep(float(response.headers.get("retry-after", "1")) * (1 + random.random()))
+            try:
+                response_body = response.json()
+            except ValueError:
+                response_body = response.text
+            result["response"] = {
+                "status_code": response.status_code,
+                "request_id": response.headers.get("x-request-id"),
+                "body": response_body
+            }
+            if response.status_code >= 400:
+                result["error"] = {"code": str(response.status_code), "message": str(response_body)[:500]}
+        except httpx.HTTPError as e:
+            result["error"] = {"code": "proxy_error", "message": repr(e)}
+        return result
+    
+    async def follow(self, batch_id: str, wait: bool) -> AsyncIterator[bytes]:
+        """按 JSONL 输出已完成的结果；wait=True 时一直跟随到批次结束"""
+        offset = 0
+        while True:
+            changed = self.changed.setdefault(batch_id, asyncio.Event())
+            local = batch_id in self.tasks
+            finished = self.get(batch_id)["status"] not in self.ACTIVE or not self.is_running(batch_id)
+            with open(self._path(batch_id, "output.jsonl"), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end:
+                offset += end
+                yield data[:end]
+            if not wait or finished:
+                return
+            try:
+                # 在其他 worker 上执行的批次收不到通知，缩短轮询间隔
+                await asyncio.wait_for(changed.wait(), timeout=5 if local else 1)
+            except asyncio.TimeoutError:
+                pass
 
 
-def should_use_streaming(messages: List[Dict[str, Any]], tools: Optional[List]) -> bool:
+batch_manager = BatchManager(BATCH_DIR, BATCH_CONCURRENCY)
+
+
+class EmbeddingBatcher:
     """
-    判断是否应该使用流式响应
-    
-    规则：
-    1. 如果没有工具定义 → 可以流式
-    2. 如果有工具，但历史消息中已有 tool role → 不需要流式（这是第二轮回复）
-    3. 如果有工具，且是首次请求 → 不能流式（需要解析 XML）
+    Embedding 微批：同一模型/参数的请求在 window 秒内到达的合并成一次上游调用，
+    结果按每个调用方的输入区间切回。输入本身已经很大或不是文本时直接透传。
     """
-    # 没有工具定义，直接流式
-    if not tools:
-        return True
     
-    # 检查消息中是否有 tool role
-    has_tool_result = any(msg.get("role") == "tool" for msg in messages)
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: Dict[bytes, Dict[str, Any]] = {}
+        self.stats = {"requests": 0, "upstream_calls": 0, "inputs": 0, "passthrough": 0}
     
-    # 如果有工具结果，说明这是第二轮回复，可以流式
-    if has_tool_result:
-        print(f"   ℹ️  检测到工具结果，第二轮回复可以使用流式")
-        return True
+    @staticmethod
+    def batchable(inputs: Any) -> bool:
+        return isinstance(inputs, list) and bool(inputs) and all(isinstance(t, str) for t in inputs)
     
-    # 否则，这是首次工具调用请求，必须非流式
-    print(f"   ℹ️  首次工具调用请求，使用非流式")
-    return False
+    async def embed(self, client: httpx.AsyncClient, body: Dict[str, Any]) -> Dict[str, Any]:
+        self.stats["requests"] += 1
+        inputs = body.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if self.window <= 0 or not self.batchable(inputs) or len(inputs) >= self.max_batch:
+            self.stats["passthrough"] += 1
+            self.stats["upstream_calls"] += 1
+            return await self._post(client, body)
+        
+        # 除 input 外的参数完全相同才能合并
+        key = json_dumps_bytes({k: v for k, v in body.items() if k != "input"}, sort_keys=True)
+        group = self.pending.get(key)
+        if group is None or len(group["inputs"]) + len(inputs) > self.max_batch:
+            if group is not None:
+                self._flush(client, key)
+            group = self.pending[key] = {"inputs": [], "waiters": [], "params": {k: v for k, v in body.items() if k != "input"}}
+            group["timer"] = asyncio.get_running_loop().call_later(self.window, self._flush, client, key)
+        
+        future = asyncio.get_running_loop().create_future()
+        start = len(group["inputs"])
+        group["inputs"].extend(inputs)
+        group["waiters"].append((future, start, len(inputs)))
+        if len(group["inputs"]) >= self.max_batch:
+            self._flush(client, key)
+        return await future
+    
+    def _flush(self, client: httpx.AsyncClient, key: bytes):
+        group = self.pending.pop(key, None)
+        if group is None:
+            return
+        group["timer"].cancel()
+        asyncio.create_task(self._run(client, group))
+    
+    async def _run(self, client: httpx.AsyncClient, group: Dict[str, Any]):
+        self.stats["upstream_calls"] += 1
+        self.stats["inputs"] += len(group["inputs"])
+        try:
+            result = await self._post(client, {**group["params"], "input": group["inputs"]})
+            data = sorted(result.get("data", []), key=lambda d: d.get("index", 0))
+            if len(data) != len(group["inputs"]):
+                raise HTTPException(status_code=502, detail=f"上游返回 {len(data)} 个向量，期望 {len(group['inputs'])} 个")
+        except Exception as e:
+            for future, _, _ in group["waiters"]:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        # usage 按各调用方文本长度占比拆分
+        total_tokens = (result.get("usage") or {}).get("prompt_tokens")
+        total_chars = sum(len(t) for t in group["inputs"]) or 1
+        for future, start, count in group["waiters"]:
+            if future.done():
+                continue
+            tokens = None
+            if total_tokens is not None:
+                tokens = round(total_tokens * sum(len(t) for t in group["inputs"][start:start + count]) / total_chars)
+            future.set_result({
+                "object": "list",
+                "data": [{**d, "index": i} for i, d in enumerate(data[start:start + count])],
+                "model": result.get("model", group["params"].get("model")),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+            })
+    
+    async def _post(self, client: httpx.AsyncClient, body: Dict[str, Any]) -> Dict[str, Any]:
+        response = await client.post(
+            EMBEDDING_API_URL,
+            content=json_dumps_bytes(body),
+            headers={"Authorization": f"Bearer {EMBEDDING_API_KEY}"}
+        )
+        if response.status_code != 200:
+            log.error("❌ Embedding 上游错误: %s - %s", response.status_code, response.text[:500])
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        return json_loads(response.content)
 
 
-async def stream_response(
-    client: httpx.AsyncClient,
-    url: str,
-    headers: Dict[str, str],
-    body: Dict[str, Any]
-) -> AsyncIterator[str]:
-    """流式转发响应"""
-    async with client.stream("POST", url, json=body, headers=headers, timeout=60.0) as response:
-        response.raise_for_status()
-        async for chunk in response.aiter_bytes():
-            yield chunk
+embedding_batcher = EmbeddingBatcher(EMBEDDING_BATCH_WINDOW_MS / 1000, EMBEDDING_MAX_BATCH)
 
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     """处理聊天补全请求（支持流式和非流式）"""
+    rm: Optional[RequestMetrics] = None
+    request_id = begin_request_logging(request)
     try:
-        body = await request.json()
+        body = json_loads(await request.body())
         
         messages = body.get("messages", [])
         tools = body.get("tools")
         is_stream = body.get("stream", False)  # ⭐ 获取客户端的流式请求
+        rm = metrics.start(body.get("model", "deepseek-chat"), "stream" if is_stream else "json")
         
-        print(f"\n{'='*60}")
-
-        if messages:
+        log.info("📨 收到请求", extra={"fields": {
+            "model": body.get("model"),
+            "messages": len(messages),
+            "tools": len(tools) if tools else 0,
+            "stream": is_stream
+        }})
+        
+        # 内容预览和消息类型只在 DEBUG 级别计算，生产环境没有额外开销
+        if messages and log.isEnabledFor(logging.DEBUG):
             first_msg = messages[0]
-            role = first_msg.get("role", "unknown")
-            content = first_msg.get("content", "")
+            content = str(first_msg.get("content") or "")
             content_preview = content[:150] + "..." if len(content) > 150 else content
-            
-            current_time = (datetime.utcnow() + timedelta(hours=8)).strftime("%H:%M:%S")
-            print(f"   [{current_time}] 首条消息: [{role}] {content_preview}")
-
-
-        print(f"   消息数: {len(messages)}")
-        print(f"   工具数: {len(tools) if tools else 0}")
-        print(f"   客户端请求流式: {is_stream}")
-        
-        msg_types = [msg.get("role") for msg in messages]
-        print(f"   消息类型: {msg_types}")
+            log.debug("首条消息: [%s] %s", first_msg.get("role", "unknown"), content_preview)
+            log.debug("消息类型: %s", [msg.get("role") for msg in messages])
         
         # 过滤消息
         filtered_messages = filter_messages_for_deepseek(messages)
         
         # 如果有工具，修改系统提示词
         if tools:
-            tool_prompt = build_tool_prompt(tools)
-            
-            system_found = False
-            for i, msg in enumerate(filtered_messages):
-                if msg.get("role") == "system":
-                    filtered_messages[i] = {
-                        "role": "system",
-                        "content": tool_prompt
-                    }
-                    system_found = True
-                    break
-            
-            if not system_found:
-                filtered_messages.insert(0, {
-                    "role": "system",
-                    "content": tool_prompt
-                })
-            
-            print(f"   ✅ 已注入工具调用提示词")
+            filtered_messages = inject_tool_prompt(filtered_messages, tools)
+            log.debug("✅ 已注入工具调用提示词")
+        
+        client: httpx.AsyncClient = request.app.state.upstream
         
         # ⭐ 智能判断是否使用流式
         use_streaming = is_stream and should_use_streaming(messages, tools)
@@ -259,98 +3336,224 @@ async def chat_completions(request: Request):
             "max_tokens": body.get("max_tokens", 2000),
             "stream": use_streaming  # ⭐ 根据判断决定是否流式
         }
+        if use_streaming and UPSTREAM_STREAM_USAGE:
+            deepseek_body["stream_options"] = {"include_usage": True}
+        client_wants_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        rm.prompt_messages = filtered_messages
+        
+        # ⭐ 响应缓存（Cache-Control: no-cache 跳过查找，no-store 不写入）
+        cache_key = None
+        cache_status = "OFF"
+        if response_cache is not None and is_cacheable(deepseek_body):
+            cache_key = canonical_request_hash(deepseek_body, tools)
+            cache_control = request.headers.get("cache-control", "").lower()
+            
+            if "no-cache" in cache_control:
+                response_cache.stats["bypass"] += 1
+                cache_status = "BYPASS"
+            else:
+                cached = await response_cache.get(cache_key)
+                if cached is not None:
+                    kind, payload = cached
+                    rm.cache = "HIT"
+                    log.info("💾 缓存命中 (%s, %d 字节)", kind, len(payload))
+                    if kind == "sse":
+                        return RelayStreamingResponse(
+                            instrument_stream(replay_sse(payload), rm, client_wants_usage),
+                            media_type="text/event-stream",
+                            headers={**SSE_HEADERS, "X-Proxy-Cache": "HIT", "X-Request-ID": request_id}
+                        )
+                    rm.finish("200")
+                    return Response(
+                        content=payload,
+                        media_type="application/json",
+                        headers={"X-Proxy-Cache": "HIT", "X-Request-ID": request_id}
+                    )
+                cache_status = "MISS"
+            rm.cache = cache_status
+            
+            if "no-store" in cache_control:
+                cache_key = None
+        
+        # ⭐ 合并在途的相同请求（与缓存使用同一个规范化哈希）
+        flight_key = None
+        if single_flight is not None:
+            flight_key = cache_key or canonical_request_hash(deepseek_body, tools)
+        
+        # ⭐ 准入控制：拿到名额才访问上游（缓存命中不占名额）
+        ticket = None
+        if admission is not None:
+            try:
+                ticket = await admission.acquire(
+                    client_key(request),
+                    deepseek_body["model"],
+                    interactive=use_streaming,
+                    tokens=estimate_tokens(filtered_messages) + deepseek_body["max_tokens"]
+                )
+            except AdmissionRejected as e:
+                log.warning("🚦 拒绝请求: %s", e)
+                raise HTTPException(
+                    status_code=429,
+                    detail=str(e),
+                    headers={"Retry-After": str(e.retry_after), "X-Request-ID": request_id}
+                )
         
-        print(f"   🔄 调用远程 API: {DEEPSEEK_API_URL}")
-        print(f"   📡 使用{'流式' if use_streaming else '非流式'}传输")
+        async def upstream_body() -> Dict[str, Any]:
+            """
+            历史过长时把较早的轮次换成滚动摘要。只在真正访问上游时（准入名额内、合并的领头请求里）执行，
+            缓存命中和合并的跟随者不付摘要的代价；缓存键按压缩前的消息计算，不受摘要状态影响。
+            """
+            if history_compactor is None:
+                return deepseek_body
+            messages = await history_compactor.compact(client, deepseek_body["messages"], deepseek_body["model"])
+            rm.prompt_messages = messages
+            return {**deepseek_body, "messages": messages}
+        
+        log.debug("🔄 调用远程 API: %d 个后端 (%s)，%s传输",
+                  len(backend_pool.backends), backend_pool.strategy,
+                  "流式" if use_streaming else "非流式")
         
         # ⭐ 流式响应
         if use_streaming:
+            upstream_stream = (
+                functools.partial(stream_tool_call_response, tools=tools) if tools else stream_response
+            )
+            
             async def generate():
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    async for chunk in stream_response(
-                        client,
-                        DEEPSEEK_API_URL,
-                        {
-                            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-                            "Content-Type": "application/json"
-                        },
-                        deepseek_body
-                    ):
+                captured = [] if cache_key else None
+                upstream = relay_with_buffer(
+                    stream_with_backend(upstream_stream, client, await upstream_body()),
+                    STREAM_RELAY_BUFFER
+                )
+                async with aclosing(upstream):
+                    async for chunk in upstream:
+                        if captured is not None:
+                            captured.append(chunk)
                         yield chunk
+                
+                # 只缓存完整结束的流
+                if captured:
+                    payload = b"".join(captured)
+                    if payload.rstrip().endswith(b"[DONE]"):
+                        await response_cache.set(cache_key, "sse", payload)
+            
+            if single_flight is not None:
+                source, leader = single_flight.stream(flight_key, generate)
+                if not leader:
+                    rm.cache = "COALESCED"
+            else:
+                source = generate()
             
-            print(f"   ✅ 返回流式响应")
-            print(f"{'='*60}\n")
+            if ticket is not None:
+                source = release_after(source, ticket)
+                # 生成器还没开始就被丢弃时 finally 不会执行，由 finalizer 兜底释放
+                weakref.finalize(source, ticket.release)
             
-            return StreamingResponse(
-                generate(),
+            source = instrument_stream(source, rm, client_wants_usage)
+            weakref.finalize(source, rm.finish, "499", "client_disconnect")
+            
+            log.info("✅ 返回流式响应")
+            
+            return RelayStreamingResponse(
+                source,
                 media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                }
+                headers={**SSE_HEADERS, "X-Proxy-Cache": cache_status, "X-Request-ID": request_id}
             )
         
         # ⭐ 非流式响应（工具调用）
         else:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    DEEPSEEK_API_URL,
-                    json=deepseek_body,
-                    headers={
-                        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-                        "Content-Type": "application/json"
-                    }
-                )
-                
+            async def fetch_completion() -> Tuple[bytes, Dict[str, Any]]:
+                response = await post_with_failover(client, await upstream_body())
                 response.raise_for_status()
-                result = response.json()
-            
-            # 验证响应
-            if "choices" not in result or not result["choices"]:
-                raise HTTPException(
-                    status_code=502,
-                    detail="Invalid response from DeepSeek API"
-                )
-            
-            # 提取响应
-            choice = result["choices"][0]
-            message = choice.get("message", {})
-            content = message.get("content", "")
-            
-            print(f"   📥 收到响应 ({len(content)} 字符)")
-            
-            # 解析工具调用
-            tool_calls = None
-            finish_reason = choice.get("finish_reason", "stop")
-            
-            if tools and content:
-                tool_calls = extract_xml_tool_calls(content)
+                payload = response.content
+                result = json_loads(payload)
                 
-                if tool_calls:
-                    print(f"   ✅ 提取到 {len(tool_calls)} 个工具调用:")
-                    for tc in tool_calls:
-                        print(f"      - {tc['function']['name']}({tc['function']['arguments']})")
+                # 验证响应
+                if "choices" not in result or not result["choices"]:
+                    raise HTTPException(
+                        status_code=502,
+                        detail="Invalid response from DeepSeek API"
+                    )
+                
+                # 提取响应
+                choice = result["choices"][0]
+                message = choice.get("message", {})
+                content = message.get("content", "")
+                
+                log.debug("📥 收到响应 (%d 字符)", len(content))
+                
+                # 解析工具调用
+                tool_calls = None
+                finish_reason = choice.get("finish_reason")
+                
+                if tools:
+                    text, tool_calls = split_xml_tool_calls(content, tools)
+                    metrics.record_tool_extraction(deepseek_body["model"], len(tool_calls or []))
                     
-                    message["tool_calls"] = tool_calls
-                    message["content"] = ""
-                    finish_reason = "tool_calls"
+                    if tool_calls:
+                        log.info("✅ 提取到 %d 个工具调用", len(tool_calls))
+                        if log.isEnabledFor(logging.DEBUG):
+                            for tc in tool_calls:
+                                log.debug("   - %s(%s)", tc["function"]["name"], tc["function"]["arguments"])
+                        
+                        message["tool_calls"] = tool_calls
+                        # 与流式一致：调用前模型写的文字作为 content 保留
+                        message["content"] = text
+                        finish_reason = "tool_calls"
+                
+                # 响应没有被改动时直接转发上游的原始字节，省掉一次重新编码
+                if tool_calls or not finish_reason:
+                    choice["finish_reason"] = finish_reason or "stop"
+                    choice["message"] = message
+                    payload = json_dumps_bytes(result)
+                
+                if cache_key:
+                    await response_cache.set(cache_key, "json", payload)
+                
+                return payload, {
+                    "finish_reason": choice["finish_reason"],
+                    "usage": result.get("usage"),
+                    "content": message.get("content") or ""
+                }
             
-            choice["finish_reason"] = finish_reason
-            choice["message"] = message
+            try:
+                if single_flight is not None:
+                    (payload, summary), leader = await single_flight.do(flight_key, fetch_completion)
+                    if not leader:
+                        rm.cache = "COALESCED"
+                else:
+                    payload, summary = await fetch_completion()
+            finally:
+                if ticket is not None:
+                    ticket.release()
             
-            print(f"   ✅ 返回结果 (finish_reason: {finish_reason})")
-            print(f"{'='*60}\n")
+            log.info("✅ 返回结果 (finish_reason: %s)", summary["finish_reason"])
             
-            return JSONResponse(content=result)
+            rm.set_usage(summary["usage"])
+            rm.completion_text = summary["content"]
+            rm.finish("200")
+            
+            return Response(
+                content=payload,
+                media_type="application/json",
+                headers={"X-Proxy-Cache": cache_status, "X-Request-ID": request_id}
+            )
         
+    except HTTPException as e:
+        if rm is not None:
+            rm.finish(str(e.status_code), classify_error(e))
+        raise
+    
     except httpx.HTTPError as e:
-        print(f"❌ HTTP 错误: {e}")
+        if rm is not None:
+            rm.finish("502", classify_error(e))
+        log.error("❌ HTTP 错误: %r", e)
         raise HTTPException(status_code=502, detail=f"DeepSeek API error: {str(e)}")
     
     except Exception as e:
-        print(f"❌ 服务器错误: {e}")
-        import traceback
-        traceback.print_exc()
+        if rm is not None:
+            rm.finish("500", classify_error(e))
+        log.exception("❌ 服务器错误: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -371,21 +3574,112 @@ async def list_models():
 
 
 @app.get("/health")
-async def health():
-    """健康检查"""
+async def health(request: Request):
+    """健康检查：探测所有后端，任一可达即视为健康"""
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"http://10.248.60.236:5000/v1/models")
-            response.raise_for_status()
+        client: httpx.AsyncClient = request.app.state.upstream
+        results = await backend_pool.check_all(client)
         return {
-            "status": "healthy",
-            "deepseek_api": "reachable",
-            "streaming_support": True
+            "status": "healthy" if any(results) else "unhealthy",
+            "deepseek_api": "reachable" if any(results) else "unreachable",
+            "streaming_support": True,
+            "backends": backend_pool.snapshot()
         }
     except Exception as e:
         return {"status": "unhealthy", "error": str(e)}
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """响应缓存命中与请求合并统计"""
+    return {
+        "response_cache": (
+            {"enabled": True, **response_cache.snapshot()}
+            if response_cache is not None else {"enabled": False}
+        ),
+        "coalescing": (
+            {"enabled": True, **single_flight.snapshot()}
+            if single_flight is not None else {"enabled": False}
+        ),
+        "tool_prompt": _render_tool_prompt.cache_info()._asdict(),
+        "history_compaction": (
+            {"enabled": True, **history_compactor.snapshot()}
+            if history_compactor is not None else {"enabled": False}
+        )
+    }
+
+
+@app.get("/admission/stats")
+async def admission_stats():
+    """准入控制队列与并发统计"""
+    if admission is None:
+        return {"enabled": False}
+    return {"enabled": True, **admission.snapshot()}
+
+
+@app.get("/admin/usage")
+async def admin_usage(limit: int = 50):
+    """最近请求的 token 用量、TTFT、token 间隔和吞吐"""
+    records = list(usage_log.records)[-limit:] if limit > 0 else []
+    return {**usage_log.summary(), "recent": records}
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    """Embedding 透传：并发的小请求在几毫秒窗口内合并成一次上游批量调用"""
+    begin_request_logging(request)
+    try:
+        body = json_loads(await request.body())
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="请求体不是合法 JSON")
+    if not body.get("input"):
+        raise HTTPException(status_code=400, detail="缺少 input")
+    try:
+        return FastJSONResponse(await embedding_batcher.embed(request.app.state.upstream, body))
+    except httpx.HTTPError as e:
+        log.error("❌ Embedding 上游连接失败: %r", e)
+        raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
+
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """提交批量任务：请求体为 JSONL，每行一个 chat 请求（可带 custom_id）"""
+    return batch_manager.create(await request.body(), client_key(request))
+
+
+@app.get("/v1/batches")
+async def list_batches(request: Request):
+    """只列出调用方自己提交的批次"""
+    return {"object": "list", "data": batch_manager.list_all(client_key(request))}
+
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    return batch_manager.get(batch_id, client_key(request))
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    return await batch_manager.cancel(batch_id, client_key(request))
+
+
+@app.get("/v1/batches/{batch_id}/results")
+async def batch_results(batch_id: str, request: Request, wait: bool = False):
+    """以 JSONL 流式返回已完成的结果（完成顺序）；wait=true 时跟随到批次结束"""
+    batch_manager.get(batch_id, client_key(request))
+    return StreamingResponse(batch_manager.follow(batch_id, wait), media_type="application/x-ndjson")
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 文本格式指标；多 worker 时汇总所有 worker 最近发布的指标"""
+    text = metrics.render()
+    if shared_store.shared:
+        await shared_store.publish_metrics(text)
+        text = merge_metrics_texts(await shared_store.collect_metrics())
+    return Response(content=text, media_type="text/plain; version=0.0.4")
+
+
 @app.get("/")
 async def root():
     """根路径信息"""
@@ -395,11 +3689,72 @@ async def root():
         "features": [
             "Tool calling via XML parsing",
             "Streaming support for non-tool requests",
-            "Intelligent stream/non-stream switching"
+            "Incremental streaming tool-call parsing",
+            "Intelligent stream/non-stream switching",
+            "Pooled keep-alive upstream connections",
+            "Opt-in exact-match response cache",
+            "Opt-in coalescing of identical in-flight requests",
+            "Multi-backend load balancing with health checks and failover",
+            "Opt-in admission control with per-key limits and priority lanes",
+            "Prometheus metrics at /metrics",
+            "Queue-backed structured logging with request IDs",
+            "Per-request token usage and streaming stats at /admin/usage",
+            "Resumable JSONL batch jobs at /v1/batches",
+            "Micro-batched embeddings passthrough at /v1/embeddings",
+            "Opt-in history compaction with cached rolling summaries",
+            "Multi-worker mode with shared cache, rate limits and metrics",
+            f"Fast JSON layer ({JSON_IMPL}) with raw-bytes passthrough"
         ],
         "config": {
             "api_url": DEEPSEEK_API_URL,
-            "api_key_set": bool(DEEPSEEK_API_KEY)
+            "backends": [b.url for b in backend_pool.backends],
+            "lb_strategy": UPSTREAM_LB_STRATEGY,
+            "api_key_set": bool(DEEPSEEK_API_KEY),
+            "upstream_pool": {
+                "max_connections": UPSTREAM_MAX_CONNECTIONS,
+                "max_keepalive": UPSTREAM_MAX_KEEPALIVE,
+                "keepalive_expiry": UPSTREAM_KEEPALIVE_EXPIRY,
+                "http2": UPSTREAM_HTTP2
+            },
+            "response_cache": {
+                "enabled": RESPONSE_CACHE,
+                "ttl": RESPONSE_CACHE_TTL,
+                "max_entries": RESPONSE_CACHE_MAX_ENTRIES,
+                "sqlite": RESPONSE_CACHE_SQLITE
+            },
+            "request_coalescing": REQUEST_COALESCING,
+            "tool_schema_compact": TOOL_SCHEMA_COMPACT,
+            "prefix_stable_layout": PREFIX_STABLE_LAYOUT,
+            "admission_control": {
+                "enabled": ADMISSION_CONTROL,
+                "max_concurrency": ADMISSION_MAX_CONCURRENCY,
+                "queue_size": ADMISSION_QUEUE_SIZE,
+                "per_key_concurrency": ADMISSION_PER_KEY_CONCURRENCY,
+                "per_model_concurrency": ADMISSION_PER_MODEL_CONCURRENCY,
+                "tokens_per_minute": RATE_LIMIT_TOKENS_PER_MINUTE
+            },
+            "upstream_stream_usage": UPSTREAM_STREAM_USAGE,
+            "usage_ring_size": USAGE_RING_SIZE,
+            "batch": {
+                "dir": BATCH_DIR,
+                "concurrency": BATCH_CONCURRENCY
+            },
+            "json_backend": JSON_IMPL,
+            "workers": {
+                "count": PROXY_WORKERS,
+                "shared_store": shared_store.describe(),
+                "worker_id": shared_store.worker_id
+            },
+            "history_compaction": {
+                "enabled": HISTORY_COMPACTION,
+                "token_budget": HISTORY_TOKEN_BUDGET,
+                "keep_recent": HISTORY_KEEP_RECENT
+            },
+            "embeddings": {
+                "api_url": EMBEDDING_API_URL,
+                "batch_window_ms": EMBEDDING_BATCH_WINDOW_MS,
+                "max_batch": EMBEDDING_MAX_BATCH
+            }
         }
     }
 
@@ -410,12 +3765,41 @@ if __name__ == "__main__":
     print("="*60)
     print(f"📅 当前时间: 2025-11-19 02:06:03 UTC")
     print(f"👤 当前用户: greatabel")
-    print(f"🔗 监听地址: http://localhost:8000")
-    print(f"🌐 远程 API: {DEEPSEEK_API_URL}")
+    print(f"🔗 监听地址: http://{PROXY_HOST}:{PROXY_PORT}")
+    for backend in backend_pool.backends:
+        print(f"🌐 远程 API: {backend.url} (权重 {backend.weight:g})")
+    print(f"⚖️  负载均衡: {UPSTREAM_LB_STRATEGY} / 重试 {UPSTREAM_RETRIES} 次")
     print(f"🔑 API Key: {'✅ 已设置' if DEEPSEEK_API_KEY else '❌ 未设置'}")
     print(f"📡 流式支持: ✅ 已启用")
-    print(f"💊 健康检查: http://localhost:8000/health")
+    print(f"🔌 连接池: {UPSTREAM_MAX_CONNECTIONS} 连接 / {UPSTREAM_MAX_KEEPALIVE} keep-alive"
+          f" / HTTP/2 {'✅' if UPSTREAM_HTTP2 else '❌'}")
+    print(f"💾 响应缓存: {'✅ 已启用' if RESPONSE_CACHE else '❌ 未启用'}")
+    print(f"🔗 请求合并: {'✅ 已启用' if REQUEST_COALESCING else '❌ 未启用'}")
+    print(f"🗜️  历史压缩: {'✅ 预算 ' + str(HISTORY_TOKEN_BUDGET) + ' tokens' if HISTORY_COMPACTION else '❌ 未启用'}")
+    print(f"🚦 准入控制: {'✅ 并发 ' + str(ADMISSION_MAX_CONCURRENCY) if ADMISSION_CONTROL else '❌ 未启用'}")
+    print(f"💊 健康检查: http://localhost:{PROXY_PORT}/health")
+    print(f"📊 指标: http://localhost:{PROXY_PORT}/metrics")
+    print(f"🧮 用量: http://localhost:{PROXY_PORT}/admin/usage")
+    print(f"🧬 Embedding: {EMBEDDING_API_URL} (微批窗口 {EMBEDDING_BATCH_WINDOW_MS:g}ms, 最多 {EMBEDDING_MAX_BATCH} 条)")
+    print(f"📦 批量任务: http://localhost:{PROXY_PORT}/v1/batches (并发 {BATCH_CONCURRENCY}, 目录 {BATCH_DIR})")
+    print(f"📝 日志: {LOG_FORMAT} / {LOG_LEVEL} / 采样 {LOG_SAMPLE_RATE:g}")
+    if PROXY_WORKERS > 1 and not SHARED_STORE_URL:
+        # worker 是重新导入本模块的子进程，通过环境变量拿到同一个共享存储；
+        # 绝对路径不随启动目录变化，文件名带端口，同一台机器上的多个实例互不干扰，有内存盘时放在 /dev/shm
+        store_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        store_path = os.path.join(store_dir, f"proxy_shared-{PROXY_PORT}.sqlite")
+        os.environ["SHARED_STORE_URL"] = SHARED_STORE_URL = f"sqlite:///{store_path}"
+        log.info("🗄️  未设置 SHARED_STORE_URL，多 worker 默认共享存储: %s", store_path)
+    print(f"🧵 Worker: {PROXY_WORKERS} 个 / 共享状态: {create_shared_store(SHARED_STORE_URL).describe()}")
     print("="*60)
     print()
     
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    if PROXY_WORKERS > 1:
+        # 多进程需要以导入路径启动，每个 worker 各自执行 lifespan
+        uvicorn.run(
+            f"{os.path.splitext(os.path.basename(__file__))[0]}:app",
+            host=PROXY_HOST, port=PROXY_PORT, workers=PROXY_WORKERS,
+            app_dir=os.path.dirname(os.path.abspath(__file__))
+        )
+    else:
+        uvicorn.run(app, host=PROXY_HOST, port=PROXY_PORT)
\ No newline at end of file
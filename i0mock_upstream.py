@@ -0,0 +1,297 @@
+"""
+离线的 OpenAI 兼容模拟上游，用来在没有真实模型的环境（CI、本机）里压测代理
+
+模拟的行为：
+  - 首 token 延迟（TTFT）和生成速度（tokens/s），可加随机抖动
+  - 请求带工具时（代理注入的工具提示词，或直接带 tools 字段）输出 <function_call> XML，
+    参数按工具的 JSON schema 填充；流式时 XML 会被切散在多个块里，覆盖代理的增量解析
+  - 按比例把工具调用写坏（模型常见的 JSON 错误），检验代理的容错解析
+  - 按比例返回错误状态码，或者流到一半断开连接
+  - /v1/models、/v1/embeddings（确定性的哈希向量）
+
+配置来自环境变量，也可以在运行中 POST /mock/config 修改；GET /mock/stats 查看调用统计。
+
+运行:
+    python i0mock_upstream.py                                   # 监听 127.0.0.1:8001
+    MOCK_TTFT_MS=300 MOCK_TOKENS_PER_SECOND=30 MOCK_ERROR_RATE=0.02 python i0mock_upstream.py
+    DEEPSEEK_API_URL=http://127.0.0.1:8001/v1/chat/completions python i0deepseek_adapter_server.py
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+MOCK_HOST = os.getenv("MOCK_HOST", "127.0.0.1")
+MOCK_PORT = int(os.getenv("MOCK_PORT", "8001"))
+
+CONFIG: Dict[str, Any] = {
+    # 首 token 延迟和生成速度；抖动是相对比例，0.2 表示 ±20%
+    "ttft_ms": float(os.getenv("MOCK_TTFT_MS", "200")),
+    "tokens_per_second": float(os.getenv("MOCK_TOKENS_PER_SECOND", "50")),
+    "jitter": float(os.getenv("MOCK_JITTER", "0.1")),
+    # 请求没有 max_tokens 时生成多少个 token
+    "completion_tokens": int(os.getenv("MOCK_COMPLETION_TOKENS", "64")),
+    # 带工具的请求里有多大比例输出工具调用（其余直接回答）
+    "tool_call_rate": float(os.getenv("MOCK_TOOL_CALL_RATE", "1.0")),
+    # 工具调用里有多大比例故意写坏（尾逗号、单引号、漏掉结束标签），覆盖代理的 JSON 修复
+    "malformed_tool_rate": float(os.getenv("MOCK_MALFORMED_TOOL_RATE", "0")),
+    # 直接返回错误的比例和状态码（逗号分隔时随机挑一个）
+    "error_rate": float(os.getenv("MOCK_ERROR_RATE", "0")),
+    "error_statuses": [int(s) for s in os.getenv("MOCK_ERROR_STATUSES", "500,503").split(",")],
+    # 流式响应中途断开的比例
+    "stream_abort_rate": float(os.getenv("MOCK_STREAM_ABORT_RATE", "0")),
+    "embedding_dim": int(os.getenv("MOCK_EMBEDDING_DIM", "64")),
+}
+
+WORDS = (
+    "the proxy forwards each request to the upstream model and relays tokens back "
+    "while the agent plans its next step with tools memory and feedback"
+).split()
+
+TOOL_SECTION_RE = re.compile(r"^## (\S+)\nDescription: .*?\nParameters: ", re.MULTILINE)
+
+rng = random.Random(int(os.getenv("MOCK_SEED", "0")) or None)
+stats: Counter = Counter()
+
+app = FastAPI(title="Mock OpenAI-compatible upstream")
+
+
+def jittered(seconds: float) -> float:
+    return max(0.0, seconds * (1 + CONFIG["jitter"] * rng.uniform(-1, 1)))
+
+
+def find_tools(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """从 tools 字段，或代理注入的系统提示词里找出工具名和参数 schema"""
+    if body.get("tools"):
+        return [tool["function"] for tool in body["tools"] if "function" in tool]
+    tools = []
+    decoder = json.JSONDecoder()
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if message.get("role") != "system" or not isinstance(content, str) or "<function_call>" not in content:
+            continue
+        for match in TOOL_SECTION_RE.finditer(content):
+            try:
+                parameters, _ = decoder.raw_decode(content, match.end())
+            except ValueError:
+                parameters = {}
+            tools.append({"name": match.group(1), "parameters": parameters})
+    return tools
+
+
+def sample_value(schema: Dict[str, Any]) -> Any:
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if kind == "integer":
+        return 3
+    if kind == "number":
+        return 1.5
+    if kind == "boolean":
+        return True
+    if kind == "array":
+        return [sample_value(schema.get("items", {"type": "string"}))]
+    if kind == "object":
+        return sample_arguments(schema)
+    return "北京"
+
+
+def sample_arguments(schema: Dict[str, Any]) -> Dict[str, Any]:
+    properties = schema.get("properties", {})
+    names = schema.get("required") or list(properties)
+    return {name: sample_value(properties.get(name, {})) for name in names}
+
+
+def last_turn_is_tool_result(body: Dict[str, Any]) -> bool:
+    messages = body.get("messages") or [{}]
+    last = messages[-1]
+    content = last.get("content")
+    return last.get("role") == "tool" or (isinstance(content, str) and content.startswith("Function "))
+
+
+def malform(call: str) -> str:
+    """模仿模型常犯的错误，返回一段不合法但代理应当能修复的工具调用"""
+    mistake = rng.choice(("trailing_comma", "single_quotes", "missing_close_tag"))
+    stats[f"malformed_{mistake}"] += 1
+    if mistake == "trailing_comma":
+        return f"<function_call>\n{call[:-2]},}}}}\n</function_call>"
+    if mistake == "single_quotes":
+        return f"<function_call>\n{call.replace(chr(34), chr(39))}\n</function_call>"
+    return f"<function_call>\n{call}\n"
+
+
+def plan_completion(body: Dict[str, Any]) -> List[str]:
+    """决定这次回答的内容，按"token"切好（流式时一个 token 一个块）"""
+    tools = find_tools(body)
+    if tools and not last_turn_is_tool_result(body) and rng.random() < CONFIG["tool_call_rate"]:
+        tool = rng.choice(tools)
+        call = json.dumps(
+            {"name": tool["name"], "arguments": sample_arguments(tool.get("parameters") or {})},
+            ensure_ascii=False
+        )
+        if rng.random() < CONFIG["malformed_tool_rate"]:
+            block = malform(call)
+        else:
+            block = f"<function_call>\n{call}\n</function_call>"
+        text = f"好的，我来调用 {tool['name']}。\n{block}"
+        # 按 4~8 个字符切块，让标签和 JSON 跨块出现
+        pieces, i = [], 0
+        while i < len(text):
+            step = rng.randint(4, 8)
+            pieces.append(text[i:i + step])
+            i += step
+        stats["tool_calls"] += 1
+        return pieces
+    n = int(body.get("max_tokens") or CONFIG["completion_tokens"])
+    n = max(1, min(n, CONFIG["completion_tokens"]))
+    return [WORDS[i % len(WORDS)] + " " for i in range(n)]
+
+
+def usage_for(body: Dict[str, Any], pieces: List[str]) -> Dict[str, int]:
+    prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []) if isinstance(m.get("content"), str))
+    prompt_tokens = max(1, prompt_chars // 4)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces), "total_tokens": prompt_tokens + len(pieces)}
+
+
+def maybe_error() -> Optional[JSONResponse]:
+    if CONFIG["error_rate"] <= 0 or rng.random() >= CONFIG["error_rate"]:
+        return None
+    status = rng.choice(CONFIG["error_statuses"])
+    stats[f"error_{status}"] += 1
+    headers = {"Retry-After": "1"} if status == 429 else None
+    return JSONResponse(
+        {"error": {"message": f"mock upstream error {status}", "type": "mock_error", "code": status}},
+        status_code=status, headers=headers
+    )
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "deepseek-chat", "object": "model", "owned_by": "mock"}]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stream = bool(body.get("stream"))
+    stats["stream" if stream else "json"] += 1
+
+    error = maybe_error()
+    if error is not None:
+        return error
+
+    pieces = plan_completion(body)
+    usage = usage_for(body, pieces)
+    completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    model = body.get("model", "deepseek-chat")
+    ttft = jittered(CONFIG["ttft_ms"] / 1000)
+    interval = 1 / CONFIG["tokens_per_second"] if CONFIG["tokens_per_second"] > 0 else 0.0
+
+    if not stream:
+        await asyncio.sleep(ttft + jittered(interval * (len(pieces) - 1)))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(pieces)},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        }
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+    abort_at = rng.randrange(len(pieces)) if rng.random() < CONFIG["stream_abort_rate"] else None
+
+    def event(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+    async def generate():
+        # 按时间表发送：落后时不再额外等待，整体速率保持 tokens_per_second
+        started = time.perf_counter()
+        due = ttft
+        for i, piece in enumerate(pieces):
+            delay = started + due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if i == abort_at:
+                stats["aborted"] += 1
+                raise ConnectionResetError("mock upstream aborted the stream")
+            yield event({"role": "assistant", "content": piece} if i == 0 else {"content": piece})
+            due += jittered(interval)
+        yield event({}, "stop")
+        if include_usage:
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                     "model": model, "choices": [], "usage": usage}
+            yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+        yield b"data: [DONE]\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    stats["embeddings"] += 1
+    error = maybe_error()
+    if error is not None:
+        return error
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    data = []
+    for index, text in enumerate(inputs):
+        # 同一文本总是得到同一个向量，方便缓存类测试断言
+        digest = hashlib.sha256(str(text).encode("utf-8")).digest()
+        vector = [(digest[i % len(digest)] - 127.5) / 127.5 for i in range(CONFIG["embedding_dim"])]
+        data.append({"object": "embedding", "index": index, "embedding": vector})
+    tokens = sum(max(1, len(str(text)) // 4) for text in inputs)
+    return {"object": "list", "model": body.get("model"), "data": data,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+
+@app.get("/mock/stats")
+async def mock_stats():
+    return {"calls": dict(stats), "config": CONFIG}
+
+
+@app.post("/mock/config")
+async def update_config(request: Request):
+    """运行中调整模拟参数，例如 {"error_rate": 0.1, "ttft_ms": 500}"""
+    changes = await request.json()
+    unknown = set(changes) - set(CONFIG)
+    if unknown:
+        return JSONResponse({"error": f"unknown keys: {sorted(unknown)}"}, status_code=400)
+    CONFIG.update(changes)
+    return CONFIG
+
+
+@app.post("/mock/reset")
+async def reset_stats():
+    stats.clear()
+    return {"calls": {}}
+
+
+if __name__ == "__main__":
+    print(f"🧪 模拟上游: http://{MOCK_HOST}:{MOCK_PORT}/v1/chat/completions")
+    print(f"⏱️  TTFT {CONFIG['ttft_ms']:g}ms / {CONFIG['tokens_per_second']:g} tokens/s / 抖动 {CONFIG['jitter']:.0%}")
+    print(f"💥 错误率 {CONFIG['error_rate']:.1%} {CONFIG['error_statuses']} / 流中断 {CONFIG['stream_abort_rate']:.1%}")
+    uvicorn.run(app, host=MOCK_HOST, port=MOCK_PORT, log_level=os.getenv("MOCK_LOG_LEVEL", "warning"))
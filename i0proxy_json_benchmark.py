@@ -0,0 +1,125 @@
+"""
+代理 JSON 处理的微基准：对比每个非流式请求在 JSON 编解码上花的 CPU 时间
+
+  旧路径: request.json() -> httpx json= -> response.json() -> 修改 -> JSONResponse
+  新路径: json_loads(body) -> json_dumps_bytes -> json_loads(上游字节) -> 未改动时原样转发上游字节
+
+收益几乎全部来自 orjson（本机约 35%~50%）。JSON_BACKEND=stdlib 时没有稳定收益：多次运行在 -10% ~ +15%
+之间波动，工具调用场景通常略慢，只有原样转发上游字节省下的那次编码是实打实的。
+
+运行:
+    python i0proxy_json_benchmark.py
+    JSON_BACKEND=stdlib python i0proxy_json_benchmark.py   # 不用 orjson 时的新路径
+"""
+import json
+import os
+import time
+
+os.environ.setdefault("DEEPSEEK_OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import i0deepseek_adapter_server as proxy
+
+ITERATIONS = int(os.getenv("BENCH_ITERATIONS", "2000"))
+
+TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": f"tool_{i}",
+        "description": "查询指定城市的天气、温度和空气质量" * 2,
+        "parameters": {
+            "type": "object",
+            "properties": {"city": {"type": "string"}, "days": {"type": "integer"}},
+            "required": ["city"]
+        }
+    }
+} for i in range(5)]
+
+
+def make_request(with_tools):
+    messages = [{"role": "system", "content": "你是一个乐于助人的助手。"}]
+    for i in range(10):
+        messages.append({"role": "user", "content": f"第 {i} 个问题：" + "请详细解释一下这个概念。" * 20})
+        messages.append({"role": "assistant", "content": "好的，下面是详细的解释。" * 30})
+    body = {"model": "deepseek-chat", "messages": messages, "temperature": 0.7, "max_tokens": 2000}
+    if with_tools:
+        body["tools"] = TOOLS
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def make_upstream_response(with_tool_call):
+    content = "这是模型生成的回答。" * 100
+    if with_tool_call:
+        content += '\n<function_call>\n{"name": "tool_0", "arguments": {"city": "北京", "days": 3}}\n</function_call>'
+    return json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "deepseek-chat",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1200, "completion_tokens": 300, "total_tokens": 1500}
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def old_path(request_bytes, upstream_bytes):
+    body = json.loads(request_bytes)                                   # request.json()
+    messages = proxy.filter_messages_for_deepseek(body["messages"])
+    upstream_body = {**body, "messages": messages, "stream": False}
+    upstream_body.pop("tools", None)
+    json.dumps(upstream_body).encode("utf-8")                          # httpx json=
+    result = json.loads(upstream_bytes)                                # response.json()
+    message = result["choices"][0]["message"]
+    if body.get("tools"):
+        tool_calls = []
+        for raw in proxy.re.findall(r'<function_call>\s*(\{.*?\})\s*</function_call>', message["content"], proxy.re.DOTALL):
+            call = json.loads(raw)
+            tool_calls.append({"type": "function", "function": {
+                "name": call["name"], "arguments": json.dumps(call["arguments"])
+            }})
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+            message["content"] = ""
+    return json.dumps(result, ensure_ascii=False, separators=(",", ":")).encode("utf-8")  # JSONResponse
+
+
+def new_path(request_bytes, upstream_bytes):
+    body = proxy.json_loads(request_bytes)
+    messages = proxy.filter_messages_for_deepseek(body["messages"])
+    upstream_body = {**body, "messages": messages, "stream": False}
+    upstream_body.pop("tools", None)
+    proxy.json_dumps_bytes(upstream_body)
+    result = proxy.json_loads(upstream_bytes)
+    message = result["choices"][0]["message"]
+    if body.get("tools"):
+        tool_calls = proxy.extract_xml_tool_calls(message["content"])
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+            message["content"] = ""
+            return proxy.json_dumps_bytes(result)
+    # 没有改动：缓存和响应都直接用上游字节
+    return upstream_bytes
+
+
+def measure(fn, request_bytes, upstream_bytes, repeats=5):
+    """每次请求的 CPU 微秒数，取多轮中的最小值以减少调度噪声"""
+    for _ in range(50):
+        fn(request_bytes, upstream_bytes)
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.process_time()
+        for _ in range(ITERATIONS):
+            fn(request_bytes, upstream_bytes)
+        best = min(best, time.process_time() - started)
+    return best / ITERATIONS * 1e6
+
+
+if __name__ == "__main__":
+    print(f"JSON 后端: {proxy.JSON_IMPL}, 每组 {ITERATIONS} 次")
+    print(f"{'场景':<16}{'请求':>8}{'响应':>8}{'旧路径 µs':>12}{'新路径 µs':>12}{'节省':>8}")
+    for name, with_tools in (("普通对话", False), ("工具调用", True)):
+        request_bytes = make_request(with_tools)
+        upstream_bytes = make_upstream_response(with_tools)
+        before = measure(old_path, request_bytes, upstream_bytes)
+        after = measure(new_path, request_bytes, upstream_bytes)
+        print(f"{name:<16}{len(request_bytes) // 1024:>6}KB{len(upstream_bytes) // 1024:>6}KB"
+              f"{before:>12.1f}{after:>12.1f}{1 - after / before:>8.0%}")
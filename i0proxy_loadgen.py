@@ -0,0 +1,391 @@
+"""
+代理压测：按目标 RPS 开环发送混合流量（非流式 / 流式 / 工具调用 / 流式工具调用），
+统计 p50/p95/p99 延迟、TTFT 和吞吐
+
+默认完全离线：在空闲端口上启动 i0mock_upstream.py 和 i0deepseek_adapter_server.py，
+再用同一份到达时间表直接压一遍模拟上游作为基线，两者之差就是代理自身的开销。
+设置 LOADGEN_URL 时只压这个地址（例如已经在跑的代理），不启动任何进程。
+
+运行:
+    python i0proxy_loadgen.py
+    LOADGEN_RPS=50 LOADGEN_DURATION=60 LOADGEN_MIX=stream=0.7,tool_stream=0.3 python i0proxy_loadgen.py
+    MOCK_ERROR_RATE=0.05 LOADGEN_MAX_ERROR_RATE=0.1 python i0proxy_loadgen.py
+    PROXY_WORKERS=4 RESPONSE_CACHE=1 python i0proxy_loadgen.py     # 代理的配置照常通过环境变量传入
+
+CI 里用作回归门禁：超过 LOADGEN_MAX_ERROR_RATE 或 LOADGEN_MAX_OVERHEAD_P95_MS 时退出码为 1，
+LOADGEN_REPORT=path.json 输出完整结果。
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+LOADGEN_URL = os.getenv("LOADGEN_URL", "")
+LOADGEN_RPS = float(os.getenv("LOADGEN_RPS", "20"))
+LOADGEN_DURATION = float(os.getenv("LOADGEN_DURATION", "20"))
+# poisson（指数分布的到达间隔，更接近真实流量）或 uniform（固定间隔）
+LOADGEN_ARRIVAL = os.getenv("LOADGEN_ARRIVAL", "poisson")
+LOADGEN_MIX = os.getenv("LOADGEN_MIX", "json=0.3,stream=0.4,tool=0.15,tool_stream=0.15")
+LOADGEN_MAX_TOKENS = int(os.getenv("LOADGEN_MAX_TOKENS", "64"))
+LOADGEN_TIMEOUT = float(os.getenv("LOADGEN_TIMEOUT", "60"))
+LOADGEN_SEED = int(os.getenv("LOADGEN_SEED", "42"))
+# 离线模式下是否再直接压一遍模拟上游作为基线
+LOADGEN_BASELINE = os.getenv("LOADGEN_BASELINE", "1") == "1"
+# 回归门禁；留空表示不检查
+LOADGEN_MAX_ERROR_RATE = os.getenv("LOADGEN_MAX_ERROR_RATE", "0.01")
+LOADGEN_MAX_OVERHEAD_P95_MS = os.getenv("LOADGEN_MAX_OVERHEAD_P95_MS", "")
+LOADGEN_REPORT = os.getenv("LOADGEN_REPORT", "")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KINDS = ("json", "stream", "tool", "tool_stream")
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_weather",
+            "description": "查询指定城市未来几天的天气",
+            "parameters": {
+                "type": "object",
+                "properties": {"city": {"type": "string"}, "days": {"type": "integer"}},
+                "required": ["city", "days"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_docs",
+            "description": "在知识库里检索文档",
+            "parameters": {
+                "type": "object",
+                "properties": {"query": {"type": "string"}, "top_k": {"type": "integer"}},
+                "required": ["query"]
+            }
+        }
+    }
+]
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"LOADGEN_MIX 里的未知类型 {kind!r}，可选 {KINDS}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def make_schedule(rps: float, duration: float, mix: Dict[str, float], seed: int) -> List[tuple]:
+    """预先生成 (发送时刻, 类型) 列表，代理和基线用同一份"""
+    rng = random.Random(seed)
+    kinds, weights = list(mix), list(mix.values())
+    schedule, t = [], 0.0
+    while True:
+        t += rng.expovariate(rps) if LOADGEN_ARRIVAL == "poisson" else 1 / rps
+        if t >= duration:
+            return schedule
+        schedule.append((t, rng.choices(kinds, weights)[0]))
+
+
+def make_body(kind: str, n: int) -> Dict[str, Any]:
+    question = f"请介绍一下第 {n} 个主题。" if not kind.startswith("tool") else f"北京未来 {n % 7 + 1} 天天气怎么样？"
+    body = {
+        "model": "deepseek-chat",
+        "messages": [
+            {"role": "system", "content": "你是一个乐于助人的助手。"},
+            {"role": "user", "content": question}
+        ],
+        "max_tokens": LOADGEN_MAX_TOKENS,
+        "temperature": 0.7,
+        "stream": kind.endswith("stream"),
+    }
+    if kind.startswith("tool"):
+        body["tools"] = TOOLS
+    if body["stream"]:
+        body["stream_options"] = {"include_usage": True}
+    return body
+
+
+async def send_one(client: httpx.AsyncClient, kind: str, n: int, check_tools: bool) -> Dict[str, Any]:
+    body = make_body(kind, n)
+    result = {"kind": kind, "status": None, "latency": None, "ttft": None, "tokens": 0, "error": None}
+    started = time.perf_counter()
+    try:
+        if not body["stream"]:
+            response = await client.post("/v1/chat/completions", json=body)
+            result["status"] = response.status_code
+            if response.status_code == 200:
+                payload = response.json()
+                message = payload["choices"][0]["message"]
+                result["tokens"] = (payload.get("usage") or {}).get("completion_tokens", 0)
+                if check_tools and kind == "tool" and not message.get("tool_calls"):
+                    result["error"] = "no_tool_call"
+        else:
+            tool_seen = False
+            async with client.stream("POST", "/v1/chat/completions", json=body) as response:
+                result["status"] = response.status_code
+                if response.status_code != 200:
+                    await response.aread()
+                else:
+                    chunks = 0
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: ") or line == "data: [DONE]":
+                            continue
+                        event = json.loads(line[6:])
+                        if event.get("usage"):
+                            result["tokens"] = event["usage"].get("completion_tokens", 0)
+                        for choice in event.get("choices", []):
+                            delta = choice.get("delta") or {}
+                            if delta.get("content") or delta.get("tool_calls"):
+                                if result["ttft"] is None:
+                                    result["ttft"] = time.perf_counter() - started
+                                chunks += 1
+                                tool_seen = tool_seen or bool(delta.get("tool_calls"))
+                    result["tokens"] = result["tokens"] or chunks
+            if check_tools and kind == "tool_stream" and result["status"] == 200 and not tool_seen:
+                result["error"] = "no_tool_call"
+        if result["status"] != 200:
+            result["error"] = f"http_{result['status']}"
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        result["error"] = type(e).__name__
+    result["latency"] = time.perf_counter() - started
+    return result
+
+
+async def run_load(base_url: str, schedule: List[tuple], check_tools: bool) -> Dict[str, Any]:
+    """开环发送：按时间表发出请求，不等前一个返回；记录调度落后的程度"""
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=256)
+    async with httpx.AsyncClient(base_url=base_url, timeout=LOADGEN_TIMEOUT, limits=limits) as client:
+        tasks, lags = [], []
+        started = time.perf_counter()
+        for n, (at, kind) in enumerate(schedule):
+            delay = started + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lags.append(max(0.0, -delay))
+            tasks.append(asyncio.create_task(send_one(client, kind, n, check_tools)))
+        results = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    return {"results": results, "elapsed": elapsed, "max_lag": max(lags, default=0.0)}
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    if not values:
+        return None
+    if len(values) == 1:
+        return {"p50": values[0] * 1000, "p95": values[0] * 1000, "p99": values[0] * 1000}
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": q[49] * 1000, "p95": q[94] * 1000, "p99": q[98] * 1000}
+
+
+def summarize(run: Dict[str, Any]) -> Dict[str, Any]:
+    results = run["results"]
+    summary = {"elapsed": run["elapsed"], "max_schedule_lag_ms": run["max_lag"] * 1000, "kinds": {}}
+    for kind in ("all",) + KINDS:
+        rows = [r for r in results if kind == "all" or r["kind"] == kind]
+        if not rows:
+            continue
+        ok = [r for r in rows if r["error"] is None]
+        summary["kinds"][kind] = {
+            "requests": len(rows),
+            "errors": len(rows) - len(ok),
+            "error_rate": (len(rows) - len(ok)) / len(rows),
+            "errors_by_type": dict(Counter(r["error"] for r in rows if r["error"])),
+            "rps": len(ok) / run["elapsed"],
+            "tokens_per_second": sum(r["tokens"] for r in ok) / run["elapsed"],
+            "latency_ms": percentiles([r["latency"] for r in ok]),
+            "ttft_ms": percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        }
+    return summary
+
+
+def fmt(stats: Optional[Dict[str, float]], key: str) -> str:
+    return f"{stats[key]:.0f}" if stats else "-"
+
+
+def print_summary(title: str, summary: Dict[str, Any]):
+    print(f"\n{title}  (用时 {summary['elapsed']:.1f}s, 调度最大落后 {summary['max_schedule_lag_ms']:.0f}ms)")
+    print(f"{'类型':<12}{'请求':>7}{'错误':>6}{'req/s':>8}{'tok/s':>8}"
+          f"{'p50':>8}{'p95':>8}{'p99':>8}{'TTFT50':>8}{'TTFT95':>8}{'TTFT99':>8}")
+    for kind, s in summary["kinds"].items():
+        print(f"{kind:<12}{s['requests']:>7}{s['errors']:>6}{s['rps']:>8.1f}{s['tokens_per_second']:>8.0f}"
+              f"{fmt(s['latency_ms'], 'p50'):>8}{fmt(s['latency_ms'], 'p95'):>8}{fmt(s['latency_ms'], 'p99'):>8}"
+              f"{fmt(s['ttft_ms'], 'p50'):>8}{fmt(s['ttft_ms'], 'p95'):>8}{fmt(s['ttft_ms'], 'p99'):>8}")
+    errors = summary["kinds"]["all"]["errors_by_type"]
+    if errors:
+        print(f"错误分布: {errors}")
+
+
+def overhead(proxy: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """同一时间表下代理与直连模拟上游的延迟差（毫秒）"""
+    diff = {}
+    for kind, s in proxy["kinds"].items():
+        b = baseline["kinds"].get(kind)
+        if not b:
+            continue
+        for metric in ("latency_ms", "ttft_ms"):
+            if s[metric] and b[metric]:
+                diff.setdefault(kind, {}).update({
+                    f"{metric[:-3]}_{p}": s[metric][p] - b[metric][p] for p in ("p50", "p95", "p99")
+                })
+    return diff
+
+
+# ---------- 离线环境：启动模拟上游和代理 ----------
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, process: Optional[subprocess.Popen] = None, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"进程提前退出（退出码 {process.returncode}）: {url}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"服务没有在 {timeout}s 内就绪: {url}")
+
+
+def start_mock(port: int, log_path: str, **overrides: str) -> subprocess.Popen:
+    # 默认关掉抖动并固定随机种子，代理和基线两轮的上游耗时一致，差值才是代理开销
+    env = {"MOCK_JITTER": "0", "MOCK_SEED": str(LOADGEN_SEED), **os.environ,
+           "MOCK_HOST": "127.0.0.1", "MOCK_PORT": str(port), **overrides}
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "i0mock_upstream.py")],
+        env=env, stdout=subprocess.DEVNULL, stderr=open(log_path, "w")
+    )
+    wait_ready(f"http://127.0.0.1:{port}/v1/models", process)
+    return process
+
+
+def start_proxy(port: int, upstream_port: int, workdir: str, log_path: str, **overrides: str) -> subprocess.Popen:
+    upstream = f"http://127.0.0.1:{upstream_port}/v1/chat/completions"
+    env = {
+        "LOG_LEVEL": "WARNING",
+        **os.environ,
+        "DEEPSEEK_API_URL": upstream,
+        "DEEPSEEK_API_URLS": upstream,
+        "DEEPSEEK_OPENAI_API_KEY": "loadgen",
+        "EMBEDDING_API_URL": f"http://127.0.0.1:{upstream_port}/v1/embeddings",
+        "PROXY_HOST": "127.0.0.1",
+        "PROXY_PORT": str(port),
+        # 批次目录放进临时目录，避免续跑本机真实的批次
+        "BATCH_DIR": os.path.join(workdir, "batches"),
+        **overrides,
+    }
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "i0deepseek_adapter_server.py")],
+        env=env, cwd=workdir, stdout=subprocess.DEVNULL, stderr=open(log_path, "w")
+    )
+    wait_ready(f"http://127.0.0.1:{port}/", process)
+    return process
+
+
+def stop(process: Optional[subprocess.Popen]):
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def check_gates(proxy: Dict[str, Any], diff: Dict[str, Dict[str, float]]) -> List[str]:
+    failures = []
+    error_rate = proxy["kinds"]["all"]["error_rate"]
+    if LOADGEN_MAX_ERROR_RATE and error_rate > float(LOADGEN_MAX_ERROR_RATE):
+        failures.append(f"错误率 {error_rate:.2%} 超过 {float(LOADGEN_MAX_ERROR_RATE):.2%}")
+    if LOADGEN_MAX_OVERHEAD_P95_MS and "all" in diff:
+        extra = diff["all"]["latency_p95"]
+        if extra > float(LOADGEN_MAX_OVERHEAD_P95_MS):
+            failures.append(f"代理 p95 开销 {extra:.0f}ms 超过 {float(LOADGEN_MAX_OVERHEAD_P95_MS):g}ms")
+    return failures
+
+
+def main() -> int:
+    mix = parse_mix(LOADGEN_MIX)
+    schedule = make_schedule(LOADGEN_RPS, LOADGEN_DURATION, mix, LOADGEN_SEED)
+    print(f"🎯 目标 {LOADGEN_RPS:g} req/s × {LOADGEN_DURATION:g}s = {len(schedule)} 个请求, "
+          f"到达 {LOADGEN_ARRIVAL}, 混合 {mix}")
+
+    report: Dict[str, Any] = {"config": {"rps": LOADGEN_RPS, "duration": LOADGEN_DURATION, "mix": mix,
+                                         "arrival": LOADGEN_ARRIVAL, "requests": len(schedule)}}
+    if LOADGEN_URL:
+        print(f"🔗 目标: {LOADGEN_URL}")
+        report["proxy"] = summarize(asyncio.run(run_load(LOADGEN_URL, schedule, check_tools=True)))
+        print_summary("代理", report["proxy"])
+        diff = {}
+    else:
+        mock = proxy = None
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                mock_port, proxy_port = free_port(), free_port()
+                mock = start_mock(mock_port, os.path.join(workdir, "mock.log"))
+                proxy = start_proxy(proxy_port, mock_port, workdir, os.path.join(workdir, "proxy.log"))
+                print(f"🧪 模拟上游 :{mock_port}  🚀 代理 :{proxy_port}")
+
+                report["proxy"] = summarize(asyncio.run(
+                    run_load(f"http://127.0.0.1:{proxy_port}", schedule, check_tools=True)
+                ))
+                print_summary("经过代理", report["proxy"])
+                if LOADGEN_BASELINE:
+                    # 基线直连模拟上游：它不转换工具调用，所以不检查 tool_calls
+                    report["baseline"] = summarize(asyncio.run(
+                        run_load(f"http://127.0.0.1:{mock_port}", schedule, check_tools=False)
+                    ))
+                    print_summary("直连模拟上游（基线）", report["baseline"])
+                report["mock_stats"] = httpx.get(f"http://127.0.0.1:{mock_port}/mock/stats").json()["calls"]
+            except Exception:
+                for name in ("proxy.log", "mock.log"):
+                    path = os.path.join(workdir, name)
+                    if os.path.exists(path):
+                        print(f"--- {name} ---\n" + open(path, encoding="utf-8", errors="replace").read()[-3000:])
+                raise
+            finally:
+                stop(proxy)
+                stop(mock)
+        diff = overhead(report["proxy"], report["baseline"]) if "baseline" in report else {}
+
+    if diff:
+        report["overhead_ms"] = diff
+        print("\n代理开销（经过代理 - 基线，毫秒）")
+        print(f"{'类型':<12}{'p50':>8}{'p95':>8}{'p99':>8}{'TTFT50':>8}{'TTFT95':>8}{'TTFT99':>8}")
+        for kind, d in diff.items():
+            cells = [d.get(f"{m}_{p}") for m in ("latency", "ttft") for p in ("p50", "p95", "p99")]
+            print(f"{kind:<12}" + "".join(f"{c:>8.1f}" if c is not None else f"{'-':>8}" for c in cells))
+
+    failures = check_gates(report["proxy"], diff)
+    report["failures"] = failures
+    if LOADGEN_REPORT:
+        with open(LOADGEN_REPORT, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n📝 报告已写入 {LOADGEN_REPORT}")
+    for failure in failures:
+        print(f"❌ {failure}")
+    if not failures:
+        print("\n✅ 通过")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
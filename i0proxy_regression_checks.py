@@ -0,0 +1,124 @@
+"""
+代理的离线回归检查：不需要上游和 API key，直接调用内部组件，覆盖评审时发现过的边界情况
+
+运行:
+    python i0proxy_regression_checks.py
+"""
+import asyncio
+import os
+
+os.environ.setdefault("DEEPSEEK_OPENAI_API_KEY", "regression")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import i0deepseek_adapter_server as proxy
+
+
+async def check_history_keep_recent_zero():
+    """keep_recent=0 且最新一条消息本身超过半个预算时，不能越界，也不能把最新消息总结掉"""
+    compactor = proxy.HistoryCompactor(budget=200, keep_recent=0, summary_max_tokens=30, cache_size=16)
+
+    async def fake_generate(client, previous, messages, model):
+        return "摘要"
+    compactor._generate = fake_generate
+
+    messages = [{"role": "system", "content": "你是一个助手。"}]
+    for i in range(6):
+        messages.append({"role": "user", "content": f"问题 {i} " + "词 " * 20})
+        messages.append({"role": "assistant", "content": f"回答 {i} " + "词 " * 20})
+    messages.append({"role": "user", "content": "word " * 400})
+
+    result = await compactor.compact(None, messages, "deepseek-chat")
+    assert result[-1] == messages[-1], "最新的用户消息必须原样保留"
+    assert result[0] == messages[0]
+    assert len(result) < len(messages)
+
+
+async def check_coalesced_followers_not_counted():
+    """合并的跟随者共享领头请求的结果，但不能按又一次上游生成计 token"""
+    flight = proxy.SingleFlight()
+    usage = {"prompt_tokens": 100, "completion_tokens": 50}
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return b"{}", {"usage": usage, "content": "ok"}
+
+    before = dict(proxy.usage_log.totals)
+    results = await asyncio.gather(*(flight.do("same", fetch) for _ in range(3)))
+    assert [leader for _, leader in results] == [True, False, False]
+
+    for (payload, summary), leader in results:
+        rm = proxy.RequestMetrics(proxy.metrics, "deepseek-chat", "false")
+        if not leader:
+            rm.cache = "COALESCED"
+        rm.set_usage(summary["usage"])
+        rm.completion_text = summary["content"]
+        rm.finish("200")
+
+    totals = proxy.usage_log.totals
+    assert totals["requests"] - before["requests"] == 3
+    assert totals["coalesced"] - before["coalesced"] == 2
+    assert totals["prompt_tokens"] - before["prompt_tokens"] == 100
+    assert totals["completion_tokens"] - before["completion_tokens"] == 50
+
+
+async def check_admission_rejects_without_charging():
+    """队列满被拒（包括扣 token 期间队列被占满）的请求不能白扣限速 token"""
+    class SlowStore(proxy.LocalStore):
+        async def take_tokens(self, key, amount, rate, capacity):
+            await asyncio.sleep(0.01)
+            return await super().take_tokens(key, amount, rate, capacity)
+
+    saved = {name: getattr(proxy, name) for name in (
+        "shared_store", "RATE_LIMIT_TOKENS_PER_MINUTE", "RATE_LIMIT_BURST_TOKENS",
+        "ADMISSION_MAX_CONCURRENCY", "ADMISSION_QUEUE_SIZE", "ADMISSION_PER_KEY_CONCURRENCY")}
+    store = SlowStore()
+    proxy.shared_store = store
+    proxy.RATE_LIMIT_TOKENS_PER_MINUTE = 60
+    proxy.RATE_LIMIT_BURST_TOKENS = 1000
+    proxy.ADMISSION_MAX_CONCURRENCY = 1
+    proxy.ADMISSION_QUEUE_SIZE = 1
+    proxy.ADMISSION_PER_KEY_CONCURRENCY = 0
+    try:
+        controller = proxy.AdmissionController()
+        first = await controller.acquire("k", "m", interactive=True, tokens=100)
+
+        # 两个请求同时通过预检查并扣费，只有一个能排进队列，另一个要退款
+        waiting = [asyncio.ensure_future(controller.acquire("k", "m", interactive=True, tokens=100)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        rejected = [task for task in waiting if task.done()]
+        assert len(rejected) == 1 and isinstance(rejected[0].exception(), proxy.AdmissionRejected)
+
+        # 队列已满：直接拒绝，不扣费
+        try:
+            await controller.acquire("k", "m", interactive=True, tokens=100)
+        except proxy.AdmissionRejected:
+            pass
+        else:
+            raise AssertionError("队列满时应拒绝")
+
+        bucket = store.buckets["ratelimit:k"]
+        assert 800 <= bucket.tokens < 801, bucket.tokens
+
+        first.release()
+        queued = await next(task for task in waiting if not task.done())
+        queued.release()
+    finally:
+        for name, value in saved.items():
+            setattr(proxy, name, value)
+
+
+CHECKS = [
+    check_history_keep_recent_zero,
+    check_coalesced_followers_not_counted,
+    check_admission_rejects_without_charging,
+]
+
+
+async def main():
+    for check in CHECKS:
+        await check()
+        print(f"✅ {check.__name__}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+"""
+多 worker 压测：同一份负载分别打到 1/2/4 个 worker 的代理上，看吞吐是否随 worker 数增长
+
+每一轮启动：
+  模拟上游   i0mock_upstream.py，固定延迟后返回带 <function_call> 的回答
+  代理       python i0deepseek_adapter_server.py，PROXY_WORKERS=n，共享状态走临时 SQLite 文件
+  压测客户端 若干个进程，每个进程用 asyncio 保持固定并发，请求带工具定义和较长历史（代理的 CPU 活）
+结束后抓一次 /metrics，核对汇总的请求数与客户端发出的一致，确认各 worker 的指标都被合并。
+
+运行:
+    python i0proxy_worker_loadtest.py
+    LOADTEST_WORKERS=1,2,4,8 LOADTEST_DURATION=20 python i0proxy_worker_loadtest.py
+
+注意：压测客户端和代理在同一台机器上争用 CPU，只有在核数多于 worker 数时才能看到线性增长。
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from i0proxy_loadgen import free_port, start_mock, start_proxy, stop
+
+WORKER_COUNTS = [int(n) for n in os.getenv("LOADTEST_WORKERS", "1,2,4").split(",")]
+DURATION = float(os.getenv("LOADTEST_DURATION", "10"))
+CONCURRENCY = int(os.getenv("LOADTEST_CONCURRENCY", "64"))
+CLIENT_PROCESSES = int(os.getenv("LOADTEST_CLIENT_PROCESSES", str(max(1, min(4, (os.cpu_count() or 1) // 2)))))
+UPSTREAM_DELAY_MS = float(os.getenv("LOADTEST_UPSTREAM_DELAY_MS", "20"))
+
+TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": f"tool_{i}",
+        "description": "查询指定城市的天气、温度和空气质量",
+        "parameters": {
+            "type": "object",
+            "properties": {"city": {"type": "string"}, "days": {"type": "integer"}},
+            "required": ["city"]
+        }
+    }
+} for i in range(5)]
+
+
+# ---------- 压测客户端 ----------
+
+def make_request(nonce: int) -> bytes:
+    messages = [{"role": "system", "content": "你是一个乐于助人的助手。"}]
+    for i in range(8):
+        messages.append({"role": "user", "content": f"第 {i} 个问题：" + "请详细解释一下这个概念。" * 10})
+        messages.append({"role": "assistant", "content": "好的，下面是详细的解释。" * 15})
+    messages.append({"role": "user", "content": f"北京未来三天天气怎么样？#{nonce}"})
+    return json.dumps({
+        "model": "deepseek-chat", "messages": messages, "tools": TOOLS, "temperature": 0.7
+    }, ensure_ascii=False).encode("utf-8")
+
+
+async def drive(port: int, concurrency: int, duration: float, seed: int) -> dict:
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=30, limits=limits) as client:
+        async def loop(slot: int):
+            nonlocal errors
+            n = 0
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(
+                        "/v1/chat/completions", content=make_request(seed * 1_000_000 + slot * 10_000 + n),
+                        headers={"content-type": "application/json"}
+                    )
+                    ok = response.status_code == 200 and response.json()["choices"][0]["message"].get("tool_calls")
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+                n += 1
+        await asyncio.gather(*(loop(slot) for slot in range(concurrency)))
+    return {"latencies": latencies, "errors": errors}
+
+
+def client_process(args):
+    return asyncio.run(drive(*args))
+
+
+# ---------- 编排 ----------
+
+def scrape_total(metrics_text: str, name: str) -> float:
+    return sum(
+        float(line.rpartition(" ")[2]) for line in metrics_text.splitlines()
+        if line.startswith(name + "{") or line.startswith(name + " ")
+    )
+
+
+def run_round(workers: int, upstream_port: int, store_dir: str) -> dict:
+    port = free_port()
+    proxy = start_proxy(
+        port, upstream_port, store_dir, os.path.join(store_dir, f"proxy-{workers}.log"),
+        PROXY_WORKERS=str(workers),
+        SHARED_STORE_URL=f"sqlite:///{os.path.join(store_dir, f'shared-{workers}.sqlite')}",
+        SHARED_METRICS_INTERVAL="1",
+        UPSTREAM_HEALTH_INTERVAL="0",
+    )
+    try:
+        # 预热：让每个 worker 都建好上游连接
+        client_process((port, workers * 4, 1.0, 0))
+        time.sleep(1.5)
+        baseline = scrape_total(httpx.get(f"http://127.0.0.1:{port}/metrics").text, "proxy_requests_total")
+
+        per_process = max(1, CONCURRENCY // CLIENT_PROCESSES)
+        started = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(CLIENT_PROCESSES) as pool:
+            results = pool.map(client_process, [(port, per_process, DURATION, seed + 1) for seed in range(CLIENT_PROCESSES)])
+        elapsed = time.perf_counter() - started
+
+        # 等每个 worker 至少再发布一次指标，任意一个 worker 返回的 /metrics 都应包含全部请求
+        time.sleep(2.5)
+        text = httpx.get(f"http://127.0.0.1:{port}/metrics").text
+    finally:
+        stop(proxy)
+
+    latencies = sorted(l for r in results for l in r["latencies"])
+    errors = sum(r["errors"] for r in results)
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) >= 2 else [0.0] * 99
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50": quantiles[49] * 1000,
+        "p95": quantiles[94] * 1000,
+        "metrics_requests": scrape_total(text, "proxy_requests_total") - baseline,
+        "metrics_workers": int(scrape_total(text, "proxy_workers")),
+    }
+
+
+if __name__ == "__main__":
+    print(f"CPU: {os.cpu_count()} 核, 并发 {CONCURRENCY} ({CLIENT_PROCESSES} 个客户端进程), "
+          f"每轮 {DURATION:g}s, 上游延迟 {UPSTREAM_DELAY_MS:g}ms")
+    rows = []
+    with tempfile.TemporaryDirectory() as store_dir:
+        # 上游只有固定的首 token 延迟，没有生成耗时，吞吐的瓶颈落在代理上
+        upstream_port = free_port()
+        upstream = start_mock(
+            upstream_port, os.path.join(store_dir, "mock.log"),
+            MOCK_TTFT_MS=str(UPSTREAM_DELAY_MS), MOCK_TOKENS_PER_SECOND="0", MOCK_JITTER="0",
+            MOCK_ERROR_RATE="0", MOCK_STREAM_ABORT_RATE="0", MOCK_TOOL_CALL_RATE="1"
+        )
+        try:
+            for workers in WORKER_COUNTS:
+                rows.append(run_round(workers, upstream_port, store_dir))
+                print(f"  {workers} worker: {rows[-1]['rps']:.0f} req/s", flush=True)
+        finally:
+            stop(upstream)
+
+    print()
+    print(f"{'worker':>8}{'请求数':>10}{'错误':>8}{'req/s':>10}{'加速比':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'指标汇总':>10}{'上报 worker':>12}")
+    for row in rows:
+        print(f"{row['workers']:>8}{row['requests']:>10}{row['errors']:>8}{row['rps']:>10.0f}"
+              f"{row['rps'] / rows[0]['rps']:>8.2f}{row['p50']:>10.1f}{row['p95']:>10.1f}"
+              f"{row['metrics_requests']:>10.0f}{row['metrics_workers']:>12}")